@@ -1,3 +1,28 @@
 from django.contrib import admin
 
-# Register your models here.
+from models import InserviceStandard, InserviceSession, InserviceRecord
+
+
+class InlineAttendanceAdmin(admin.TabularInline):
+    model = InserviceRecord
+    extra = 1
+    fields = ('staff_member',)
+    raw_id_fields = ('staff_member',)
+
+
+class InserviceStandardAdmin(admin.ModelAdmin):
+    model = InserviceStandard
+    list_display = ('number', 'label')
+
+
+class InserviceSessionAdmin(admin.ModelAdmin):
+    model = InserviceSession
+    list_display = ('date', 'title', 'presenter', 'duration')
+    date_hierarchy = 'date'
+    search_fields = ('title', 'presenter')
+    filter_horizontal = ('standards',)
+    inlines = (InlineAttendanceAdmin,)
+
+
+admin.site.register(InserviceStandard, InserviceStandardAdmin)
+admin.site.register(InserviceSession, InserviceSessionAdmin)
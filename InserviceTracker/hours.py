@@ -0,0 +1,215 @@
+'''Inservice hours per staff member, standard and year.
+
+InserviceHours rows are updated by InserviceSession.mark_attendance and by the
+signal handlers below whenever an attendance record or session is saved or
+deleted or a session's standards change, so yearly totals are read from a few
+summary rows instead of aggregating every record and its standards.
+rebuild() recomputes the table from the records, for changes made without
+saving through the models.
+'''
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from models import InserviceSession, InserviceRecord, InserviceHours, BATCH_SIZE
+
+Link = InserviceSession.standards.through
+# attendee, date, duration and standard for each session standard, attendee is
+# None for sessions nobody attended
+LINK_VALUES = ('inservicesession__attendance__staff_member', 'inservicesession__date',
+               'inservicesession__duration', 'inservicestandard')
+
+
+def _deltas():
+    '''Changes to apply keyed by (staff member, standard, year), each a list of
+    [minutes, records]'''
+    return defaultdict(lambda: [0, 0])
+
+
+def _count(deltas, staff_member, standard, year, duration, sign=1):
+    deltas[(staff_member, standard, year)][0] += sign * duration
+    deltas[(staff_member, standard, year)][1] += sign
+
+
+def apply_deltas(deltas):
+    '''Add deltas to the summary. Existing rows are read in one query per batch
+    and updated with one UPDATE per distinct change, so marking a session's
+    attendance costs the same few queries however many staff attended.'''
+    deltas = dict((key, change) for key, change in deltas.items() if change[0] or change[1])
+    if not deltas:
+        return
+    keys = list(deltas)
+    existing = {}
+    with transaction.atomic():
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start:start + BATCH_SIZE]
+            rows = (InserviceHours.objects.filter(staff_member__in=set(k[0] for k in batch),
+                                                  year__in=set(k[2] for k in batch))
+                                          .values_list('pk', 'staff_member', 'standard', 'year'))
+            existing.update(((staff_member, standard, year), pk) for pk, staff_member, standard, year in rows)
+        changes = defaultdict(list)
+        for key, change in deltas.items():
+            if key in existing:
+                changes[tuple(change)].append(existing[key])
+        for (minutes, records), pks in changes.items():
+            for start in range(0, len(pks), BATCH_SIZE):
+                (InserviceHours.objects.filter(pk__in=pks[start:start + BATCH_SIZE])
+                                       .update(minutes=F('minutes') + minutes, records=F('records') + records))
+        # a missing row can only gain records, removals from it have nothing
+        # to take away
+        InserviceHours.objects.bulk_create([InserviceHours(staff_member_id=key[0], standard_id=key[1], year=key[2],
+                                                           minutes=max(minutes, 0), records=records)
+                                            for key, (minutes, records) in deltas.items()
+                                            if key not in existing and records > 0],
+                                           batch_size=BATCH_SIZE)
+        # rows taken to no records are deleted and none are left below zero
+        # minutes
+        reduced = [existing[key] for key, change in deltas.items() if key in existing and min(change) < 0]
+        for start in range(0, len(reduced), BATCH_SIZE):
+            rows = InserviceHours.objects.filter(pk__in=reduced[start:start + BATCH_SIZE])
+            rows.filter(records__lte=0).delete()
+            rows.filter(minutes__lt=0).update(minutes=0)
+
+
+def session_values(session_ids):
+    '''Map of session primary key to (year, duration, standard primary keys)'''
+    standards = defaultdict(list)
+    for session, standard in Link.objects.filter(inservicesession__in=session_ids).values_list('inservicesession',
+                                                                                               'inservicestandard'):
+        standards[session].append(standard)
+    return dict((pk, (day.year, duration, standards[pk]))
+                for pk, day, duration in InserviceSession.objects.filter(pk__in=session_ids)
+                                                                 .values_list('pk', 'date', 'duration'))
+
+
+def attendance_deltas(values, staff_ids, sign=1):
+    '''Deltas for staff_ids attending a session with values (year, duration,
+    standards) as returned by session_values'''
+    year, duration, standards = values
+    deltas = _deltas()
+    for staff_member in staff_ids:
+        for standard in [None] + list(standards):
+            _count(deltas, staff_member, standard, year, duration, sign)
+    return deltas
+
+
+def _merge(deltas, more):
+    for key, (minutes, records) in more.items():
+        deltas[key][0] += minutes
+        deltas[key][1] += records
+    return deltas
+
+
+def move_attendance_hours(removed=(), added=()):
+    '''Take the hours of the removed attendance records out of the summary and
+    add those of the added ones, each a (session, staff member) pair, for
+    records written with QuerySet.update or raw saves, which send no signals'''
+    removed, added = list(removed), list(added)
+    values = session_values(set(session for session, _ in removed + added))
+    deltas = _deltas()
+    for records, sign in [(removed, -1), (added, 1)]:
+        for session, staff_member in records:
+            _merge(deltas, attendance_deltas(values[session], [staff_member], sign))
+    apply_deltas(deltas)
+
+
+@receiver(post_save, sender=InserviceRecord)
+def update_record_hours(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    saved, current = instance._saved_hours, (instance.staff_member_id, instance.session_id)
+    instance._saved_hours = current
+    if saved == current:
+        return
+    values = session_values(set(k[1] for k in [saved, current] if k))
+    deltas = _deltas()
+    for key, sign in [(saved, -1), (current, 1)]:
+        if key is not None:
+            staff_member, session = key
+            _merge(deltas, attendance_deltas(values[session], [staff_member], sign))
+    apply_deltas(deltas)
+
+
+@receiver(pre_delete, sender=InserviceRecord)
+def remove_record_hours(sender, instance, **kwargs):
+    staff_member, session = instance._saved_hours or (instance.staff_member_id, instance.session_id)
+    apply_deltas(attendance_deltas(session_values([session])[session], [staff_member], -1))
+
+
+@receiver(post_save, sender=InserviceSession)
+def update_session_hours(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    saved, current = instance._saved_hours, instance.hours_key()
+    instance._saved_hours = current
+    if created or saved == current:
+        return
+    staff_ids = list(instance.attendance.values_list('staff_member', flat=True))
+    standards = list(instance.standards.values_list('pk', flat=True))
+    deltas = attendance_deltas(saved + (standards,), staff_ids, -1)
+    apply_deltas(_merge(deltas, attendance_deltas(current + (standards,), staff_ids)))
+
+
+@receiver(m2m_changed, sender=Link)
+def update_standard_hours(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'pre_remove', 'pre_clear') or (action != 'pre_clear' and not pk_set):
+        return
+    # the links added or about to be removed, read back from the join table as
+    # removals are also sent for standards the session does not have
+    own, other = ('inservicestandard', 'inservicesession') if reverse else ('inservicesession', 'inservicestandard')
+    links = Link.objects.filter(**{own: instance.pk})
+    if action != 'pre_clear':
+        links = links.filter(**{other + '__in': pk_set})
+    deltas = _deltas()
+    for staff_member, day, duration, standard in links.values_list(*LINK_VALUES):
+        if staff_member is not None:
+            _count(deltas, staff_member, standard, day.year, duration, 1 if action == 'post_add' else -1)
+    apply_deltas(deltas)
+
+
+def rebuild(year=None):
+    '''Recompute the summary from every record, or only the records in year.
+    Returns the number of summary rows written.'''
+    records = InserviceRecord.objects.all()
+    links = Link.objects.all()
+    rows = InserviceHours.objects.all()
+    if year is not None:
+        records = records.filter(session__date__year=year)
+        links = links.filter(inservicesession__date__year=year)
+        rows = rows.filter(year=year)
+    deltas = _deltas()
+    for staff_member, day, duration in records.values_list('staff_member', 'session__date',
+                                                           'session__duration').iterator():
+        _count(deltas, staff_member, None, day.year, duration)
+    for staff_member, day, duration, standard in links.values_list(*LINK_VALUES).iterator():
+        if staff_member is not None:
+            _count(deltas, staff_member, standard, day.year, duration)
+    with transaction.atomic():
+        rows.delete()
+        InserviceHours.objects.bulk_create([InserviceHours(staff_member_id=key[0], standard_id=key[1], year=key[2],
+                                                           minutes=minutes, records=count)
+                                            for key, (minutes, count) in deltas.items()],
+                                           batch_size=BATCH_SIZE)
+    return len(deltas)
+
+
+def staff_hours(year, staff_member=None):
+    '''Summary rows for year, with the standard selected. Rows with no standard
+    hold each staff member's total.'''
+    rows = InserviceHours.objects.filter(year=year).select_related('standard')
+    if staff_member is not None:
+        rows = rows.filter(staff_member=staff_member)
+    return rows.order_by('staff_member', 'standard__number')
+
+
+def school_hours(year):
+    '''Whole school total_minutes, total_records and staff_count for each
+    standard in year, the row with a standard of None totals every record'''
+    return (InserviceHours.objects.filter(year=year)
+                                  .values('standard', 'standard__number', 'standard__label')
+                                  .annotate(total_minutes=Sum('minutes'), total_records=Sum('records'),
+                                            staff_count=Count('staff_member'))
+                                  .order_by('standard__number'))
@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from InserviceTracker.sessions import fold_legacy_records
+
+
+class Command(BaseCommand):
+    help = ('Fold inservice records that each hold a copy of the same session into one '
+            'session attended by every staff member, then rebuild the inservice hours.')
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report how many sessions would be created without changing anything.'),
+    )
+
+    def handle(self, *args, **options):
+        records, sessions = fold_legacy_records(dry_run=options['dry_run'])
+        self.stdout.write('{} {} inservice records into {} sessions.'.format(
+            'Would fold' if options['dry_run'] else 'Folded', records, sessions))
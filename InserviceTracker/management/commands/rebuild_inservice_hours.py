@@ -0,0 +1,20 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from InserviceTracker.hours import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the inservice hours summary from the inservice records. Saves through the '
+            'models keep it up to date, this is for changes made directly in the database.')
+    option_list = BaseCommand.option_list + (
+        make_option('--year', dest='year', type='int',
+                    help='Only rebuild the summary for this calendar year.'),
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild(year=options['year'])
+        self.stdout.write('Wrote {} inservice hours rows.'.format(count))
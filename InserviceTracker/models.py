@@ -1,4 +1,6 @@
-from django.db import models
+from django.db import models, transaction
+
+BATCH_SIZE = 500
 
 
 class InserviceStandard(models.Model):
@@ -13,15 +15,171 @@ class InserviceStandard(models.Model):
         ordering = ['number']
 
 
-class InserviceRecord(models.Model):
+class InserviceSession(models.Model):
+    '''An inservice held once and attended by any number of staff'''
     date = models.DateField(help_text='The date the inservice occured.')
     duration = models.IntegerField(help_text='Duration in minutes of the inservice.')
     presenter = models.CharField(max_length=255, help_text='Name of the inservice presenter.')
     title = models.CharField(max_length=255, help_text='Title of the inservice.')
     description = models.TextField(blank=True, null=True, help_text='Optional description of the inservice.')
     venue = models.TextField(blank=True, null=True, help_text='Optional venue that the inservice occured.')
-    standards = models.ManyToManyField('InserviceStandard', related_name='records')
-    staff_member = models.ForeignKey('StaffInformation.StaffMember', related_name='inservice_records')
+    standards = models.ManyToManyField('InserviceStandard', related_name='sessions')
+
+    def __init__(self, *args, **kwargs):
+        super(InserviceSession, self).__init__(*args, **kwargs)
+        # the values last saved, so a save can move the session's minutes out of
+        # the summary rows its attendees were counted in
+        self._saved_hours = self.hours_key() if self.pk else None
+
+    def __unicode__(self):
+        return '{} {}'.format(self.date, self.title)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(InserviceSession, self).save(*args, **kwargs)
+
+    def hours_key(self):
+        '''Year and duration each attendance of this session adds to InserviceHours'''
+        return (self.date.year, self.duration)
+
+    def mark_attendance(self, staff_members):
+        '''Record that staff_members attended this session, skipping those already
+        recorded. Uses a few queries per BATCH_SIZE staff however many attend.
+        Returns the number of attendance records created.'''
+        # imported here as StaffInformation.models imports this module
+        from StaffInformation.models import StaffChange, staff_changed
+        from hours import attendance_deltas, apply_deltas, session_values
+        staff_ids = list(set(getattr(s, 'pk', s) for s in staff_members))
+        created = []
+        with transaction.atomic():
+            for start in range(0, len(staff_ids), BATCH_SIZE):
+                batch = staff_ids[start:start + BATCH_SIZE]
+                existing = set(self.attendance.filter(staff_member__in=batch).values_list('staff_member', flat=True))
+                created.extend(pk for pk in batch if pk not in existing)
+            InserviceRecord.objects.bulk_create([InserviceRecord(session=self, staff_member_id=pk) for pk in created],
+                                                batch_size=BATCH_SIZE)
+            # bulk_create sends no post_save, so update the summary here
+            apply_deltas(attendance_deltas(session_values([self.pk])[self.pk], created))
+            StaffChange.objects.record(InserviceRecord, created, 'created')
+        if created:
+            staff_changed.send(sender=InserviceRecord, staff_ids=created)
+        return len(created)
 
     class Meta:
         ordering = ['date']
+
+
+class InserviceRecord(models.Model):
+    '''A staff member's attendance at an inservice session'''
+    session = models.ForeignKey('InserviceSession', related_name='attendance')
+    staff_member = models.ForeignKey('StaffInformation.StaffMember', related_name='inservice_records')
+
+    def __init__(self, *args, **kwargs):
+        super(InserviceRecord, self).__init__(*args, **kwargs)
+        self._saved_hours = (self.staff_member_id, self.session_id) if self.pk else None
+
+    def __unicode__(self):
+        return '{} {}'.format(self.date, self.title)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(InserviceRecord, self).save(*args, **kwargs)
+
+    # The session's details, so per staff reports can keep using the record
+
+    @property
+    def date(self):
+        return self.session.date
+
+    @property
+    def duration(self):
+        return self.session.duration
+
+    @property
+    def presenter(self):
+        return self.session.presenter
+
+    @property
+    def title(self):
+        return self.session.title
+
+    @property
+    def description(self):
+        return self.session.description
+
+    @property
+    def venue(self):
+        return self.session.venue
+
+    @property
+    def standards(self):
+        return self.session.standards
+
+    class Meta:
+        db_table = 'InserviceTracker_inserviceattendance'
+        ordering = ['session__date']
+        unique_together = [('session', 'staff_member')]
+
+
+class InserviceHours(models.Model):
+    '''Inservice minutes and record count per staff member, standard and calendar
+    year, maintained from InserviceRecord and InserviceSession by the signal
+    handlers in hours.py. Rows with no standard total every record for the staff
+    member and year, so sessions with several standards are only counted once.'''
+    staff_member = models.ForeignKey('StaffInformation.StaffMember', related_name='inservice_hours')
+    standard = models.ForeignKey('InserviceStandard', related_name='hours', blank=True, null=True)
+    # standard's primary key, 0 on the rows with no standard, as unique
+    # constraints treat every NULL standard as distinct
+    standard_key = models.IntegerField(default=0)
+    year = models.IntegerField()
+    minutes = models.IntegerField(default=0)
+    records = models.IntegerField(default=0)
+
+    def __init__(self, *args, **kwargs):
+        super(InserviceHours, self).__init__(*args, **kwargs)
+        # rows are bulk created, so the key is set here rather than in save
+        self.standard_key = self.standard_id or 0
+
+    def save(self, *args, **kwargs):
+        self.standard_key = self.standard_id or 0
+        super(InserviceHours, self).save(*args, **kwargs)
+
+    @property
+    def hours(self):
+        return self.minutes / 60.0
+
+    class Meta:
+        unique_together = [('staff_member', 'standard_key', 'year')]
+        index_together = [('year', 'standard')]
+        verbose_name = 'Inservice Hours'
+        verbose_name_plural = 'Inservice Hours'
+
+
+class LegacyInserviceRecordStandard(models.Model):
+    record = models.ForeignKey('LegacyInserviceRecord', db_column='inservicerecord_id')
+    standard = models.ForeignKey('InserviceStandard', db_column='inservicestandard_id')
+
+    class Meta:
+        db_table = 'InserviceTracker_inservicerecord_standards'
+
+
+class LegacyInserviceRecord(models.Model):
+    '''Inservice records from before sessions, each holding its own copy of the
+    session details. The fold_inservice_sessions command moves them into
+    InserviceSession and InserviceRecord.'''
+    date = models.DateField()
+    duration = models.IntegerField()
+    presenter = models.CharField(max_length=255)
+    title = models.CharField(max_length=255)
+    description = models.TextField(blank=True, null=True)
+    venue = models.TextField(blank=True, null=True)
+    standards = models.ManyToManyField('InserviceStandard', through='LegacyInserviceRecordStandard',
+                                       related_name='legacy_records')
+    staff_member = models.ForeignKey('StaffInformation.StaffMember', related_name='legacy_inservice_records')
+
+    class Meta:
+        db_table = 'InserviceTracker_inservicerecord'
+
+
+# Connect the signal handlers that keep InserviceHours up to date
+import hours
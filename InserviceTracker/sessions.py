@@ -0,0 +1,62 @@
+'''Folding legacy inservice records into shared sessions.
+
+Before sessions every staff member attending an inservice had their own record
+holding a copy of its details and standards. fold_legacy_records groups those
+copies into one InserviceSession each, with an attendance record per staff
+member, and removes the legacy rows.
+'''
+from collections import defaultdict
+
+from django.db import transaction
+
+from hours import rebuild
+from models import (InserviceSession,
+                    InserviceRecord,
+                    LegacyInserviceRecord,
+                    LegacyInserviceRecordStandard,
+                    BATCH_SIZE)
+
+SESSION_FIELDS = ('date', 'duration', 'presenter', 'title', 'description', 'venue')
+
+
+def fold_legacy_records(dry_run=False):
+    '''Move every LegacyInserviceRecord into sessions and attendance. Returns the
+    number of (legacy records, sessions) folded.'''
+    standards = defaultdict(set)
+    for record, standard in LegacyInserviceRecordStandard.objects.values_list('record', 'standard').iterator():
+        standards[record].add(standard)
+    # legacy records with the same details and standards are one session, a
+    # staff member recorded twice gets a second session so no hours are lost
+    groups = defaultdict(list)
+    values = LegacyInserviceRecord.objects.order_by('pk').values_list('pk', 'staff_member', *SESSION_FIELDS)
+    count = 0
+    for row in values.iterator():
+        key = row[2:] + (frozenset(standards[row[0]]),)
+        for attendees in groups[key]:
+            if row[1] not in attendees:
+                attendees.add(row[1])
+                break
+        else:
+            groups[key].append(set([row[1]]))
+        count += 1
+    sessions = sum(len(g) for g in groups.values())
+    if dry_run:
+        return count, sessions
+    # imported here as StaffInformation.models imports the inservice models
+    from StaffInformation.models import StaffChange, staff_changed
+    with transaction.atomic():
+        attendance = []
+        for key, group in groups.items():
+            for attendees in group:
+                session = InserviceSession.objects.create(**dict(zip(SESSION_FIELDS, key)))
+                session.standards.add(*key[-1])
+                attendance.extend(InserviceRecord(session=session, staff_member_id=pk) for pk in attendees)
+        InserviceRecord.objects.bulk_create(attendance, batch_size=BATCH_SIZE)
+        LegacyInserviceRecordStandard.objects.all().delete()
+        LegacyInserviceRecord.objects.all().delete()
+        # attendance was bulk created without signals
+        rebuild()
+        staff_ids = list(set(r.staff_member_id for r in attendance))
+        StaffChange.objects.record(InserviceRecord, staff_ids, 'created')
+    staff_changed.send(sender=InserviceRecord, staff_ids=staff_ids)
+    return count, sessions
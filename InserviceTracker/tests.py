@@ -1,3 +1,146 @@
+from datetime import date
+import json
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
 from django.test import TestCase
 
-# Create your tests here.
+from hours import apply_deltas, rebuild, school_hours, staff_hours
+from models import (InserviceHours,
+                    InserviceRecord,
+                    InserviceSession,
+                    InserviceStandard,
+                    LegacyInserviceRecord,
+                    LegacyInserviceRecordStandard)
+from sessions import fold_legacy_records
+from StaffInformation.models import StaffMember
+
+
+def make_staff(n):
+    return StaffMember.objects.create(title='Ms', legal_given_name='Given{}'.format(n),
+                                      legal_surname='Surname{}'.format(n), dob=date(1980, 1, 1),
+                                      employee_number='E{}'.format(n), bluecard_number='B{}'.format(n),
+                                      bluecard_expiry=date(2030, 1, 1))
+
+
+class InserviceHoursTest(TestCase):
+    def setUp(self):
+        self.staff = [make_staff(n) for n in range(2)]
+        self.first_aid = InserviceStandard.objects.create(number=1, label='First Aid')
+        self.safety = InserviceStandard.objects.create(number=2, label='Safety')
+
+    def session(self, duration, day=date(2014, 3, 1), standards=(), staff=()):
+        session = InserviceSession.objects.create(date=day, duration=duration, presenter='Presenter',
+                                                  title='Session')
+        session.standards.add(*standards)
+        session.mark_attendance(staff)
+        return session
+
+    def summary(self):
+        return sorted((h.staff_member_id, h.standard_id, h.year, h.minutes, h.records)
+                      for h in InserviceHours.objects.all())
+
+    def assertMatchesRebuild(self):
+        summary = self.summary()
+        rebuild()
+        self.assertEqual(summary, self.summary())
+
+    def test_single_row_without_standard(self):
+        a = self.staff[0]
+        self.session(60, standards=[self.first_aid], staff=[a])
+        self.session(30, staff=[a])
+        self.assertEqual(InserviceHours.objects.filter(staff_member=a, standard__isnull=True).count(), 1)
+        # a concurrent insert of the same summary row is refused
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            InserviceHours.objects.bulk_create([InserviceHours(staff_member=a, standard=None, year=2014, minutes=30)])
+        self.assertEqual(InserviceHours.objects.get(staff_member=a, standard__isnull=True).minutes, 90)
+
+    def test_never_below_zero(self):
+        a, b = self.staff
+        self.session(60, staff=[a])
+        # removals from a missing row are dropped, rows are never left negative
+        apply_deltas({(b.pk, None, 2014): [-60, -1], (a.pk, None, 2014): [-90, 0]})
+        self.assertEqual(self.summary(), [(a.pk, None, 2014, 0, 1)])
+        apply_deltas({(a.pk, None, 2014): [-60, -1]})
+        self.assertEqual(self.summary(), [])
+
+    def test_incremental(self):
+        a, b = self.staff
+        session = self.session(60, standards=[self.first_aid, self.safety], staff=[a])
+        other = self.session(30, standards=[self.first_aid], staff=[a])
+        self.session(90, day=date(2013, 6, 1), staff=[b])
+        self.assertEqual(self.summary(), [(a.pk, None, 2014, 90, 2),
+                                          (a.pk, self.first_aid.pk, 2014, 90, 2),
+                                          (a.pk, self.safety.pk, 2014, 60, 1),
+                                          (b.pk, None, 2013, 90, 1)])
+        self.assertMatchesRebuild()
+
+        session.duration = 120
+        session.date = date(2013, 1, 1)
+        session.save()
+        self.assertMatchesRebuild()
+        session.mark_attendance([a, b])
+        self.assertMatchesRebuild()
+        session.standards.remove(self.safety, self.safety)
+        self.assertMatchesRebuild()
+        self.safety.sessions.add(*InserviceSession.objects.all())
+        self.assertMatchesRebuild()
+        self.first_aid.sessions.clear()
+        self.assertMatchesRebuild()
+        record = other.attendance.get()
+        record.staff_member = b
+        record.save()
+        self.assertMatchesRebuild()
+        record.delete()
+        self.assertMatchesRebuild()
+        session.delete()
+        self.assertMatchesRebuild()
+        InserviceSession.objects.all().delete()
+        self.assertEqual(self.summary(), [])
+
+    def test_mark_attendance(self):
+        staff = self.staff + [make_staff(n) for n in range(2, 150)]
+        session = self.session(60, standards=[self.first_aid, self.safety], staff=staff[:10])
+        # existing attendance, insert, session standards and values, summary read
+        # and insert, the change feed insert, two savepoints each taking two
+        # queries and the attendees' updated dates
+        with self.assertNumQueries(12):
+            self.assertEqual(session.mark_attendance(staff), 140)
+        self.assertEqual(session.attendance.count(), 150)
+        self.assertEqual([r.title for r in staff[0].inservice_records.all()], ['Session'])
+        self.assertMatchesRebuild()
+
+    def test_fold_legacy_records(self):
+        a, b = self.staff
+        for staff in [a, b, a]:
+            legacy = LegacyInserviceRecord.objects.create(staff_member=staff, date=date(2014, 1, 1), duration=60,
+                                                          presenter='P', title='PD Day')
+            LegacyInserviceRecordStandard.objects.create(record=legacy, standard=self.first_aid)
+        LegacyInserviceRecord.objects.create(staff_member=b, date=date(2014, 1, 1), duration=60,
+                                             presenter='P', title='PD Day')
+        self.assertEqual(fold_legacy_records(dry_run=True), (4, 3))
+        self.assertEqual(InserviceSession.objects.count(), 0)
+        self.assertEqual(fold_legacy_records(), (4, 3))
+        self.assertEqual(LegacyInserviceRecord.objects.count(), 0)
+        self.assertEqual(sorted(s.attendance.count() for s in InserviceSession.objects.all()), [1, 1, 2])
+        self.assertEqual(InserviceHours.objects.get(staff_member=a, standard=self.first_aid).minutes, 120)
+
+    def test_reports(self):
+        a, b = self.staff
+        self.session(60, standards=[self.first_aid, self.safety], staff=[a])
+        self.session(30, standards=[self.first_aid], staff=[b])
+        self.session(45, day=date(2013, 1, 1), standards=[self.first_aid], staff=[b])
+        with self.assertNumQueries(1):
+            rows = list(school_hours(2014))
+        self.assertEqual([(r['standard'], r['total_minutes'], r['total_records'], r['staff_count']) for r in rows],
+                         [(None, 90, 2, 2), (self.first_aid.pk, 90, 2, 2), (self.safety.pk, 60, 1, 1)])
+        with self.assertNumQueries(1):
+            rows = [(h.standard and h.standard.label, h.minutes) for h in staff_hours(2014, a)]
+        self.assertEqual(rows, [(None, 60), ('First Aid', 60), ('Safety', 60)])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('inservice_hours'), {'year': 2014, 'staff_member': b.pk})
+        hours = json.loads(response.content.decode('utf-8'))['hours']
+        self.assertEqual([(h['label'], h['hours']) for h in hours], [(None, 0.5), ('First Aid', 0.5)])
@@ -0,0 +1,5 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('InserviceTracker.views',
+    url(r'^hours/$', 'inservice_hours', name='inservice_hours'),
+)
@@ -1,3 +1,38 @@
-from django.shortcuts import render
+import json
+from datetime import date
 
-# Create your views here.
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from hours import staff_hours, school_hours
+
+
+@staff_member_required
+def inservice_hours(request):
+    '''Inservice hours for a year as JSON, from the InserviceHours summary.
+
+    Query parameters: year (defaults to this year) and staff_member (a staff
+    member primary key) to report one staff member by standard instead of the
+    whole school.'''
+    try:
+        year = int(request.GET.get('year', date.today().year))
+        staff_member = int(request.GET['staff_member']) if request.GET.get('staff_member') else None
+    except ValueError:
+        return HttpResponseBadRequest('year and staff_member must be numbers.')
+    if staff_member is None:
+        rows = [{'standard': row['standard'],
+                 'number': row['standard__number'],
+                 'label': row['standard__label'],
+                 'hours': round(row['total_minutes'] / 60.0, 2),
+                 'records': row['total_records'],
+                 'staff': row['staff_count']}
+                for row in school_hours(year)]
+    else:
+        rows = [{'standard': row.standard_id,
+                 'number': row.standard.number if row.standard else None,
+                 'label': row.standard.label if row.standard else None,
+                 'hours': round(row.hours, 2),
+                 'records': row.records}
+                for row in staff_hours(year, staff_member)]
+    return HttpResponse(json.dumps({'year': year, 'staff_member': staff_member, 'hours': rows}),
+                        content_type='application/json')
@@ -1,3 +1,43 @@
+from datetime import date
+
 from django.contrib import admin
+from django.db import transaction
+
+from StaffInformation.models import StaffChange, staff_changed
+from audit import kind_label
+from models import DoorKey
+
+
+class DoorKeyAdmin(admin.ModelAdmin):
+    model = DoorKey
+    list_display = ('key', 'owner', 'last_sighted', 'is_lost')
+    list_filter = ('is_lost', 'kind', 'last_sighted')
+    list_select_related = ('owner',)
+    raw_id_fields = ('owner',)
+    search_fields = ('=number',)
+    actions = ['mark_sighted_today', 'mark_lost']
+
+    def key(self, obj):
+        return '{}{}'.format(kind_label(obj.kind), obj.number)
+    key.admin_order_field = 'number'
+
+    def update_keys(self, request, queryset, message, **values):
+        '''Update the selected keys with a single UPDATE'''
+        owners = list(queryset.values_list('owner', flat=True).distinct())
+        with transaction.atomic():
+            count = queryset.update(**values)
+            StaffChange.objects.record(DoorKey, owners)
+        staff_changed.send(sender=DoorKey, staff_ids=owners)
+        self.message_user(request, message.format(count))
+
+    def mark_sighted_today(self, request, queryset):
+        self.update_keys(request, queryset, 'Marked {} keys as sighted today.', last_sighted=date.today(),
+                         is_lost=False)
+    mark_sighted_today.short_description = 'Mark selected keys as sighted today'
+
+    def mark_lost(self, request, queryset):
+        self.update_keys(request, queryset, 'Marked {} keys as lost.', is_lost=True)
+    mark_lost.short_description = 'Mark selected keys as lost'
+
 
-# Register your models here.
+admin.site.register(DoorKey, DoorKeyAdmin)
@@ -0,0 +1,127 @@
+'''Bulk key audits and key reports.
+
+An audit takes the (kind, number) pairs scanned while checking keys, marks
+every matching key as sighted with a few set based UPDATEs and reports the
+scanned keys that are not in the registry and the registered keys that have
+not been sighted. The reports filter on the last_sighted and (is_lost, owner)
+indexes and stream their rows instead of loading every key.
+'''
+from __future__ import unicode_literals
+
+import re
+from collections import defaultdict
+from datetime import date
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import Q
+
+from StaffInformation.models import StaffChange, staff_changed
+from models import DoorKey, KEY_TYPES
+
+BATCH_SIZE = 500
+
+# kind is stored as the text of the KEY_TYPES code
+KIND_LABELS = dict(('{}'.format(kind), label) for kind, label in KEY_TYPES)
+KIND_CODES = dict((label.upper(), '{}'.format(kind)) for kind, label in KEY_TYPES)
+
+# MK123, MK 123 or MK,123 using the kind's label, or 0,123 using its code
+SCAN_LINE = re.compile(r'^\s*(?:([A-Za-z]+)\s*[,;:-]?|(\d+)\s*[,;:\s-])\s*(\d+)\s*$')
+
+
+def kind_label(kind):
+    return KIND_LABELS.get('{}'.format(kind), kind)
+
+
+def parse_scan(lines):
+    '''Parse scanned key lines, returns a list of (kind, number) pairs and a list
+    of (line number, line) for lines that could not be read. Blank lines are
+    skipped.'''
+    pairs, errors = [], []
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        match = SCAN_LINE.match(line)
+        kind = None
+        if match:
+            label, code, number = match.groups()
+            kind = KIND_CODES.get(label.upper()) if label else (code if code in KIND_LABELS else None)
+        if kind is None:
+            errors.append((line_number, line.rstrip('\r\n')))
+        else:
+            pairs.append((kind, int(number)))
+    return pairs, errors
+
+
+def not_sighted(since):
+    '''Keys that are not lost and have not been sighted on or after since'''
+    return DoorKey.objects.filter(Q(last_sighted__lt=since) | Q(last_sighted__isnull=True), is_lost=False)
+
+
+class KeyAudit(object):
+    '''The result of auditing a list of scanned keys.
+
+    sighted is the number of keys matched, recovered the (kind, number) of
+    matched keys that were recorded as lost, unmatched the scanned pairs with no
+    key and missing_count the number of keys not sighted since missing_since.'''
+    def __init__(self, pairs, on=None, missing_since=None):
+        self.on = on or date.today()
+        self.missing_since = missing_since or self.on
+        self.scanned = set(pairs)
+        numbers = defaultdict(list)
+        for kind, number in self.scanned:
+            numbers[kind].append(number)
+        self.matched = []
+        for kind, kind_numbers in numbers.items():
+            for start in range(0, len(kind_numbers), BATCH_SIZE):
+                keys = DoorKey.objects.filter(kind=kind, number__in=kind_numbers[start:start + BATCH_SIZE])
+                self.matched.extend(keys.values_list('pk', 'kind', 'number', 'is_lost', 'last_sighted', 'owner'))
+        found = set((kind, number) for _, kind, number, _, _, _ in self.matched)
+        self.unmatched = sorted(self.scanned - found)
+        self.recovered = sorted((kind, number) for _, kind, number, is_lost, _, _ in self.matched if is_lost)
+        self.sighted = len(self.matched)
+        # keys matched by this audit no longer count as missing once it is saved
+        newly_sighted = sum(1 for _, _, _, is_lost, last_sighted, _ in self.matched
+                            if not is_lost and (last_sighted is None or last_sighted < self.missing_since))
+        self.missing_count = not_sighted(self.missing_since).count() - newly_sighted
+        self.marked_lost = 0
+
+    def save(self, mark_missing_lost=False):
+        '''Set last_sighted on every matched key, found keys are no longer lost.
+        With mark_missing_lost keys not sighted since missing_since are marked as
+        lost.'''
+        owners = set(owner for _, _, _, _, _, owner in self.matched)
+        pks = [pk for pk, _, _, _, _, _ in self.matched]
+        with transaction.atomic():
+            for start in range(0, len(pks), BATCH_SIZE):
+                (DoorKey.objects.filter(pk__in=pks[start:start + BATCH_SIZE])
+                                .update(last_sighted=self.on, is_lost=False))
+            if mark_missing_lost:
+                missing = not_sighted(self.missing_since)
+                owners.update(missing.values_list('owner', flat=True).distinct())
+                self.marked_lost = missing.update(is_lost=True)
+            StaffChange.objects.record(DoorKey, owners)
+        # the updates send no post_save, tell the staff caches their keys changed
+        if owners:
+            staff_changed.send(sender=DoorKey, staff_ids=list(owners))
+
+    def missing(self):
+        '''Keys not sighted since missing_since with their owners, by kind and number'''
+        return not_sighted(self.missing_since).select_related('owner').order_by('kind', 'number')
+
+
+def not_sighted_report(since):
+    '''Keys not lost and not sighted since, with their owners, oldest sighting
+    first. Keys never sighted come first.'''
+    return not_sighted(since).select_related('owner').order_by('last_sighted', 'kind', 'number').iterator()
+
+
+def lost_keys_by_owner():
+    '''Yield (owner, lost keys) for every staff member with a lost key, by owner name'''
+    keys = (DoorKey.objects.filter(is_lost=True)
+                           .select_related('owner')
+                           .order_by('owner__legal_surname', 'owner__legal_given_name', 'owner__id', 'kind', 'number'))
+    for owner_id, owner_keys in groupby(keys.iterator(), key=lambda k: k.owner_id):
+        owner_keys = list(owner_keys)
+        yield owner_keys[0].owner, owner_keys
+
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from KeyRegistry.audit import KeyAudit, kind_label, parse_scan
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('{} is not a date, use YYYY-MM-DD.'.format(value))
+
+
+class Command(BaseCommand):
+    args = '<file file ...>'
+    help = ('Mark the keys listed in scan files as sighted. Each line holds one key as its kind '
+            'and number, for example MK123 or MK,123.')
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date',
+                    help='The date the keys were sighted (YYYY-MM-DD), today when not given.'),
+        make_option('--missing-since', dest='missing_since',
+                    help='Report keys not sighted since this date (YYYY-MM-DD) as missing, '
+                         'defaults to --date so an audit spread over several scans can set it '
+                         'to the day the audit started.'),
+        make_option('--mark-missing-lost', action='store_true', dest='mark_missing_lost', default=False,
+                    help='Mark the missing keys as lost.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report what the audit would do without changing anything.'),
+        make_option('--list-missing', action='store_true', dest='list_missing', default=False,
+                    help='List every missing key and its owner.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('Give at least one scan file.')
+        pairs = []
+        for path in paths:
+            with open(path) as f:
+                path_pairs, errors = parse_scan(f)
+            for line_number, line in errors:
+                self.stderr.write('{}:{}: cannot read key "{}"'.format(path, line_number, line))
+            pairs.extend(path_pairs)
+        audit = KeyAudit(pairs,
+                         on=parse_date(options['date']) if options['date'] else None,
+                         missing_since=parse_date(options['missing_since']) if options['missing_since'] else None)
+        if not options['dry_run']:
+            audit.save(mark_missing_lost=options['mark_missing_lost'])
+        self.stdout.write('{} keys scanned, {} sighted, {} not in the registry, {} lost keys found, '
+                          '{} not sighted since {}'.format(len(audit.scanned), audit.sighted, len(audit.unmatched),
+                                                           len(audit.recovered), audit.missing_count,
+                                                           audit.missing_since))
+        if audit.marked_lost:
+            self.stdout.write('Marked {} missing keys as lost.'.format(audit.marked_lost))
+        for kind, number in audit.unmatched:
+            self.stdout.write('not in the registry\t{}{}'.format(kind_label(kind), number))
+        for kind, number in audit.recovered:
+            self.stdout.write('found\t{}{}'.format(kind_label(kind), number))
+        if options['list_missing'] and not options['dry_run']:
+            for key in audit.missing().iterator():
+                self.stdout.write('missing\t{}{}\t{}\t{}'.format(kind_label(key.kind), key.number, key.owner,
+                                                               key.last_sighted or 'never sighted'))
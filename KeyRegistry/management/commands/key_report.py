@@ -0,0 +1,34 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from KeyRegistry.audit import kind_label, lost_keys_by_owner, not_sighted_report
+
+
+class Command(BaseCommand):
+    help = 'List keys not sighted since a date, or lost keys grouped by owner.'
+    option_list = BaseCommand.option_list + (
+        make_option('--not-sighted-since', dest='since',
+                    help='List keys that are not lost and not sighted since this date (YYYY-MM-DD).'),
+        make_option('--lost', action='store_true', dest='lost', default=False,
+                    help='List lost keys by owner.'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['since'] and not options['lost']:
+            raise CommandError('Give --not-sighted-since or --lost.')
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--not-sighted-since must be a date, use YYYY-MM-DD.')
+            for key in not_sighted_report(since):
+                self.stdout.write('{}{}\t{}\t{}'.format(kind_label(key.kind), key.number, key.owner,
+                                                        key.last_sighted or 'never sighted'))
+        if options['lost']:
+            for owner, keys in lost_keys_by_owner():
+                self.stdout.write('{}\t{}'.format(owner, ', '.join('{}{}'.format(kind_label(k.kind), k.number)
+                                                                   for k in keys)))
@@ -1,16 +1,21 @@
-from django.db import models
+from django.db import models, transaction
 
 KEY_TYPES = [(0, 'MK'), (1,'ST'), (2, 'Z')]
 
 class DoorKey(models.Model):
     number = models.IntegerField()
     kind = models.CharField(max_length=255, choices=KEY_TYPES)
-    last_sighted = models.DateField(blank=True, null=True)
+    last_sighted = models.DateField(blank=True, null=True, db_index=True)
     is_lost = models.BooleanField(default=False)
     owner = models.ForeignKey('StaffInformation.StaffMember', related_name='keys')
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(DoorKey, self).save(*args, **kwargs)
+
     class Meta:
         ordering = ['kind', 'number']
         unique_together = [('kind', 'number'), ('number', 'kind', 'owner')]
+        index_together = [('is_lost', 'owner')]
         verbose_name = 'Key'
         verbose_name_plural = 'Keys'
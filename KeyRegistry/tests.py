@@ -1,3 +1,76 @@
+from datetime import date
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
 from django.test import TestCase
+from django.utils.six import StringIO
+
+from audit import KeyAudit, lost_keys_by_owner, not_sighted_report, parse_scan
+from models import DoorKey
+from StaffInformation.models import StaffMember
+
+
+def make_staff(n):
+    return StaffMember.objects.create(title='Ms', legal_given_name='Given{}'.format(n),
+                                      legal_surname='Surname{}'.format(n), dob=date(1980, 1, 1),
+                                      employee_number='E{}'.format(n), bluecard_number='B{}'.format(n),
+                                      bluecard_expiry=date(2030, 1, 1))
+
+
+class KeyAuditTest(TestCase):
+    def setUp(self):
+        self.staff = [make_staff(n) for n in range(2)]
+        for number in range(1, 6):
+            DoorKey.objects.create(owner=self.staff[number % 2], kind=0, number=number,
+                                   last_sighted=date(2013, 1, 1))
+        DoorKey.objects.create(owner=self.staff[0], kind=1, number=1, is_lost=True)
+        DoorKey.objects.create(owner=self.staff[1], kind=2, number=7, is_lost=True)
+
+    def test_parse_scan(self):
+        pairs, errors = parse_scan(['MK1', 'mk 2', 'ST,1', '', '0;3', 'XX4', 'MK'])
+        self.assertEqual(pairs, [('0', 1), ('0', 2), ('1', 1), ('0', 3)])
+        self.assertEqual(errors, [(6, 'XX4'), (7, 'MK')])
+
+    def test_audit(self):
+        pairs = [('0', 1), ('0', 2), ('0', 2), ('1', 1), ('0', 99)]
+        with self.assertNumQueries(3):
+            audit = KeyAudit(pairs, on=date(2014, 2, 1))
+        self.assertEqual((audit.sighted, audit.unmatched, audit.recovered, audit.missing_count),
+                         (3, [('0', 99)], [('1', 1)], 3))
+        audit.save(mark_missing_lost=True)
+        self.assertEqual(audit.marked_lost, 3)
+        self.assertEqual(DoorKey.objects.filter(last_sighted=date(2014, 2, 1), is_lost=False).count(), 3)
+        self.assertEqual(sorted(DoorKey.objects.filter(is_lost=True).values_list('kind', 'number')),
+                         [('0', 3), ('0', 4), ('0', 5), ('2', 7)])
+
+    def test_reports(self):
+        DoorKey.objects.filter(number=2).update(last_sighted=date(2014, 1, 1))
+        self.assertEqual([(k.kind, k.number) for k in not_sighted_report(date(2013, 6, 1))],
+                         [('0', 1), ('0', 3), ('0', 4), ('0', 5)])
+        with self.assertNumQueries(1):
+            lost = [(owner.pk, [k.number for k in keys]) for owner, keys in lost_keys_by_owner()]
+        self.assertEqual(lost, [(self.staff[0].pk, [1]), (self.staff[1].pk, [7])])
+
+    def test_commands(self):
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(b'MK1\nMK9\nbad\n')
+            f.flush()
+            out, err = StringIO(), StringIO()
+            call_command('audit_keys', f.name, date='2014-02-01', stdout=out, stderr=err)
+        self.assertIn('2 keys scanned, 1 sighted, 1 not in the registry', out.getvalue())
+        self.assertIn('cannot read key "bad"', err.getvalue())
+        self.assertEqual(DoorKey.objects.get(kind=0, number=1).last_sighted, date(2014, 2, 1))
+        out = StringIO()
+        call_command('key_report', lost=True, stdout=out)
+        self.assertIn('ST1', out.getvalue())
 
-# Create your tests here.
+    def test_admin_actions(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        keys = DoorKey.objects.filter(is_lost=True)
+        response = self.client.post(reverse('admin:KeyRegistry_doorkey_changelist'),
+                                    {'action': 'mark_sighted_today', '_selected_action': [k.pk for k in keys]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(DoorKey.objects.filter(is_lost=False, last_sighted=date.today()).count(), 2)
@@ -1,13 +1,32 @@
-from django.contrib import admin
+from collections import OrderedDict, namedtuple
+
+from django import forms
+from django.conf.urls import patterns, url
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.util import unquote
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.http import Http404
+from django.shortcuts import render
 import reversion
 
+from InserviceTracker.models import InserviceSession
+from KeyRegistry.audit import kind_label
+
+from archive import RestoreError, restore_staff, search_archive
 from models import (StaffMember,
                     Address,
                     StaffPhoneNumber,
                     NOKPhoneNumber,
                     NextOfKin,
                     Qualification,
-                    EmailAddress)
+                    EmailAddress,
+                    ArchivedStaff,
+                    COMPLIANCE_STATUSES)
+from search import search_ids
 
 
 class InlineAddressAdmin(admin.StackedInline):
@@ -20,19 +39,19 @@ class InlineAddressAdmin(admin.StackedInline):
 
 class InlineStaffPhoneNumberAdmin(admin.TabularInline):
     model = StaffPhoneNumber
-    extra = 3
+    extra = 1
     fields = ('rel', 'label', 'value', 'primary')
 
 
 class InlineQualificationAdmin(admin.TabularInline):
     model = Qualification
-    extra = 3
+    extra = 1
     fields = ('label', 'institution', 'date_awarded')
 
 
 class InlineEmailAddressAdmin(admin.TabularInline):
     model = EmailAddress
-    extra = 3
+    extra = 1
     fields = ('rel', 'label', 'address', 'primary')
 
 
@@ -42,9 +61,39 @@ class InlineNOKAdmin(admin.TabularInline):
     fields = ('title', 'given_name', 'surname', 'relationship', 'priority')
 
 
+# A related section of the staff change form. Sections with an inline are edited
+# with its formset, the others list columns of (label, value of a row), reading
+# related along with each row.
+Section = namedtuple('Section', ['title', 'inline', 'columns', 'related'])
+
+STAFF_SECTIONS = OrderedDict([
+    ('addresses', Section('Addresses', InlineAddressAdmin, None, ())),
+    ('phone_numbers', Section('Phone Numbers', InlineStaffPhoneNumberAdmin, None, ())),
+    ('email_addresses', Section('Email Addresses', InlineEmailAddressAdmin, None, ())),
+    ('next_of_kin', Section('Next of Kin', InlineNOKAdmin, None, ())),
+    ('qualifications', Section('Qualifications', InlineQualificationAdmin, None, ())),
+    ('keys', Section('Keys', None,
+                     [('Key', lambda key: '{}{}'.format(kind_label(key.kind), key.number)),
+                      ('Last Sighted', lambda key: key.last_sighted),
+                      ('Lost', lambda key: 'Yes' if key.is_lost else 'No')], ())),
+    ('inservice_records', Section('Inservice Records', None,
+                                  [('Date', lambda record: record.date),
+                                   ('Title', lambda record: record.title),
+                                   ('Minutes', lambda record: record.duration)], ('session',))),
+])
+
+
+class InserviceAttendanceForm(forms.Form):
+    session = forms.ModelChoiceField(InserviceSession.objects.order_by('-date'))
+
+
 class StaffMemberAdmin(reversion.VersionAdmin):
     model = StaffMember
     history_latest_first = True
+    list_display = ('display_name', 'employee_number', 'timetable_code', 'bluecard_status',
+                    'primary_email_address', 'primary_phone_number')
+    search_fields = ('legal_surname', 'prefered_surname', 'legal_given_name', 'prefered_given_name',
+                     'employee_number', 'timetable_code', 'bluecard_number')
     fieldsets = [('Name', {'fields':('title',
                                     'prefered_given_name',
                                     'legal_given_name',
@@ -56,40 +105,251 @@ class StaffMemberAdmin(reversion.VersionAdmin):
                 ('Teacher Registration', {'fields':('teacher_registration_number',
                                                    'teacher_registration_expiry')}),
                 ('Timetable', {'fields':('timetable_code',)}),
-                ('HR Details', {'fields':('employee_number','media_consent_form')}),
+                ('HR Details', {'fields':('employee_number','supervisor','media_consent_form')}),
                 ('Blue Card', {'fields':('bluecard_number','bluecard_expiry')}),
                 ('Vehicle Details', {'fields':('vehicle_registration',)}),
                 ('Work Schedule', {'fields':('weekly_hours_worked','works_monday','works_tuesday','works_wednesday','works_thursday','works_friday')})
     ]
+    raw_id_fields = ('supervisor',)
     inlines = (InlineAddressAdmin,
                InlineStaffPhoneNumberAdmin,
                InlineQualificationAdmin,
                InlineEmailAddressAdmin,
                InlineNOKAdmin)
+    actions = ['deactivate_selected', 'mark_inservice_attendance']
+    change_form_template = 'StaffInformation/admin/staffmember_change_form.html'
+    sections = STAFF_SECTIONS
+    section_per_page = 20
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        section_urls = patterns('',
+                                url(r'^(.+)/section/(\w+)/$', self.admin_site.admin_view(self.section_view),
+                                    name='{}_{}_section'.format(*info)))
+        return section_urls + super(StaffMemberAdmin, self).get_urls()
+
+    def get_inline_instances(self, request, obj=None):
+        '''New staff are added with the inlines, existing staff have them edited
+        a section at a time by section_view'''
+        if obj is not None:
+            return []
+        return super(StaffMemberAdmin, self).get_inline_instances(request, obj)
+
+    def section_url(self, object_id, section):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return reverse('admin:{}_{}_section'.format(*info), args=(object_id, section),
+                       current_app=self.admin_site.name)
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        '''The change form shows the core fieldsets, its related sections are
+        fetched from section_view when opened'''
+        sections = [{'name': name, 'title': section.title, 'url': self.section_url(object_id, name)}
+                    for name, section in self.sections.items()]
+        extra_context = dict(extra_context or {}, sections=sections)
+        return super(StaffMemberAdmin, self).change_view(request, object_id, form_url, extra_context)
+
+    def section_rows(self, staff, name):
+        '''The rows of one of staff's sections, in the order they are paged'''
+        section = self.sections[name]
+        rows = getattr(staff, name).all()
+        if section.related:
+            rows = rows.select_related(*section.related)
+        return rows if rows.ordered else rows.order_by('pk')
+
+    def section_page(self, staff, name, number):
+        '''The Page of primary keys numbered number of one of staff's sections,
+        and its rows'''
+        paginator = Paginator(self.section_rows(staff, name).values_list('pk', flat=True), self.section_per_page)
+        page = paginator.page(number)
+        # formsets cannot filter a sliced queryset, so the rows are read by
+        # their primary keys
+        return page, self.section_rows(staff, name).filter(pk__in=list(page.object_list))
+
+    def section_view(self, request, object_id, name):
+        '''One page of a staff member's related section, as a fragment of the
+        change form. Saving a page only saves and versions its edited rows.'''
+        section = self.sections.get(name)
+        staff = self.get_object(request, unquote(object_id))
+        if not self.has_change_permission(request, staff):
+            raise PermissionDenied
+        if staff is None or section is None:
+            raise Http404
+        try:
+            page, rows = self.section_page(staff, name, request.GET.get('page', 1))
+        except (PageNotAnInteger, EmptyPage):
+            raise Http404
+        context = {'title': section.title, 'url': self.section_url(object_id, name), 'saved': False}
+        if section.inline is None:
+            context.update(page=page,
+                           columns=[label for label, _ in section.columns],
+                           rows=[[value(row) for _, value in section.columns] for row in rows])
+            return render(request, 'StaffInformation/admin/staff_section.html', context)
+        FormSet = section.inline(self.model, self.admin_site).get_formset(request, staff)
+        if request.method == 'POST':
+            formset = FormSet(request.POST, request.FILES, instance=staff, prefix=name, queryset=rows)
+            if formset.is_valid():
+                if formset.has_changed():
+                    with transaction.atomic(), reversion.create_revision():
+                        formset.save()
+                        message = self.construct_change_message(request, forms.Form(), [formset])
+                        reversion.set_user(request.user)
+                        reversion.set_comment(message)
+                        # VersionAdmin.log_change would also version the
+                        # unchanged staff member
+                        admin.ModelAdmin.log_change(self, request, staff, message)
+                context['saved'] = True
+                try:
+                    page, rows = self.section_page(staff, name, page.number)
+                except EmptyPage:
+                    # the last page's rows were deleted
+                    page, rows = self.section_page(staff, name, page.number - 1)
+                formset = FormSet(instance=staff, prefix=name, queryset=rows)
+        else:
+            formset = FormSet(instance=staff, prefix=name, queryset=rows)
+        context.update(page=page, formset=formset)
+        return render(request, 'StaffInformation/admin/staff_section.html', context)
+
+    def get_queryset(self, request):
+        '''Statuses and primary contacts shown in the changelist are annotated so the
+        page costs the same number of queries however many rows it shows'''
+        queryset = super(StaffMemberAdmin, self).get_queryset(request)
+        return queryset.with_compliance_status().with_primary_contacts()
+
+    def get_search_results(self, request, queryset, search_term):
+        '''Search with the staff search index rather than LIKE scans of search_fields'''
+        if not search_term:
+            return queryset, False
+        return queryset.filter(pk__in=search_ids(search_term)), False
+
+    def display_name(self, obj):
+        return obj.display_name
+    display_name.short_description = 'Name'
+    display_name.admin_order_field = 'legal_surname'
+
+    def bluecard_status(self, obj):
+        return dict(COMPLIANCE_STATUSES)[obj.bluecard_status]
+    bluecard_status.short_description = 'Blue Card'
+    bluecard_status.admin_order_field = 'bluecard_expiry'
+
+    def primary_email_address(self, obj):
+        return obj.primary_email_address
+    primary_email_address.short_description = 'Email Address'
+
+    def primary_phone_number(self, obj):
+        return obj.primary_phone_number
+    primary_phone_number.short_description = 'Phone Number'
+
+    def get_actions(self, request):
+        '''Staff members are soft deleted, replace the stock delete action with deactivate_selected'''
+        actions = super(StaffMemberAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        if not self.has_delete_permission(request):
+            actions.pop('deactivate_selected', None)
+        return actions
+
+    def deactivate_selected(self, request, queryset):
+        count = queryset.deactivate(user=request.user, comment='Deactivated from the staff list.')
+        self.message_user(request, 'Deactivated {} staff.'.format(count))
+    deactivate_selected.short_description = 'Deactivate selected staff'
+
+    def mark_inservice_attendance(self, request, queryset):
+        '''Ask for an inservice session, then record that every selected staff
+        member attended it'''
+        form = InserviceAttendanceForm(request.POST if 'apply' in request.POST else None)
+        if form.is_valid():
+            session = form.cleaned_data['session']
+            count = session.mark_attendance(queryset.values_list('pk', flat=True))
+            self.message_user(request, 'Recorded {} staff attending {}.'.format(count, session))
+            return None
+        return render(request, 'StaffInformation/mark_inservice_attendance.html',
+                      {'form': form,
+                       'opts': self.model._meta,
+                       'count': queryset.count(),
+                       'selected': request.POST.getlist(ACTION_CHECKBOX_NAME),
+                       'select_across': request.POST.get('select_across', '0'),
+                       'action_checkbox_name': ACTION_CHECKBOX_NAME})
+    mark_inservice_attendance.short_description = 'Record selected staff attending an inservice'
 
 
 class AddressAdmin(admin.ModelAdmin):
     model = Address
+    list_display = ('staff_member', 'label', 'number', 'street', 'suburb', 'primary')
+    list_select_related = ('staff_member',)
+    raw_id_fields = ('staff_member',)
 
 
 class StaffPhoneNumberAdmin(admin.ModelAdmin):
     model = StaffPhoneNumber
+    list_display = ('staff_member', 'rel', 'label', 'value', 'primary')
+    list_select_related = ('staff_member',)
+    raw_id_fields = ('staff_member',)
 
 
 class NOKPhoneNumberAdmin(admin.ModelAdmin):
     model = NOKPhoneNumber
+    list_display = ('next_of_kin', 'rel', 'label', 'value', 'primary')
+    list_select_related = ('next_of_kin',)
+    raw_id_fields = ('next_of_kin',)
 
 
 class NextOfKinAdmin(admin.ModelAdmin):
     model = NextOfKin
+    list_display = ('staff_member', 'title', 'given_name', 'surname', 'relationship', 'priority')
+    list_select_related = ('staff_member',)
+    raw_id_fields = ('staff_member',)
 
 
 class QualificationAdmin(admin.ModelAdmin):
     model = Qualification
+    list_display = ('staff_member', 'label', 'institution', 'date_awarded')
+    list_select_related = ('staff_member',)
+    raw_id_fields = ('staff_member',)
 
 
 class EmailAddressAdmin(admin.ModelAdmin):
     model = EmailAddress
+    list_display = ('staff_member', 'label', 'address', 'primary')
+    list_select_related = ('staff_member',)
+    raw_id_fields = ('staff_member',)
+
+
+class ArchivedStaffAdmin(admin.ModelAdmin):
+    '''Archived staff can be found and restored but not edited'''
+    model = ArchivedStaff
+    list_display = ('display_name', 'employee_number', 'dob', 'departed', 'archived')
+    fields = ('title', 'prefered_given_name', 'legal_given_name', 'prefered_surname', 'legal_surname',
+              'employee_number', 'dob', 'departed', 'archived')
+    readonly_fields = fields
+    search_fields = ('employee_number',)
+    actions = ['restore_selected']
+
+    def get_search_results(self, request, queryset, search_term):
+        '''Prefix match every word rather than LIKE scans of search_fields'''
+        if not search_term:
+            return queryset, False
+        return search_archive(search_term, queryset), False
+
+    def display_name(self, obj):
+        return obj.display_name
+    display_name.short_description = 'Name'
+    display_name.admin_order_field = 'legal_surname'
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_actions(self, request):
+        actions = super(ArchivedStaffAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def restore_selected(self, request, queryset):
+        try:
+            count = restore_staff(queryset, user=request.user)
+        except RestoreError as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return
+        self.message_user(request, 'Restored {} staff, they are still inactive.'.format(count))
+    restore_selected.short_description = 'Restore selected staff'
 
 
 admin.site.register(StaffMember, StaffMemberAdmin)
@@ -98,4 +358,5 @@ admin.site.register(StaffPhoneNumber, StaffPhoneNumberAdmin)
 admin.site.register(NOKPhoneNumber, NOKPhoneNumberAdmin)
 admin.site.register(NextOfKin, NextOfKinAdmin)
 admin.site.register(Qualification, QualificationAdmin)
-admin.site.register(EmailAddress, EmailAddressAdmin)
\ No newline at end of file
+admin.site.register(EmailAddress, EmailAddressAdmin)
+admin.site.register(ArchivedStaff, ArchivedStaffAdmin)
\ No newline at end of file
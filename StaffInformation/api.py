@@ -0,0 +1,193 @@
+'''Read only JSON API over active staff members and their related records.
+
+Pages are read with keyset pagination on ORDERING, so the cursor for the next
+page names the last row seen and every page costs the same however deep it is.
+Each page's ETag is built from its staff members' updated dates and latest
+change feed sequence numbers, so every process gives the same page the same
+ETag, and its Last-Modified from their updated dates. Answering a conditional
+request with 304 Not Modified costs a single query.
+
+The change feed lists StaffChange entries after a sequence number, so a
+consumer that keeps the cursor of its last page only reads what changed since,
+then fetches the staff members named. Sequence numbers are given out when an
+entry is written but become visible when its transaction commits, so entries
+from the last CHANGE_FEED_SETTLE_SECONDS are held back until any transaction
+given an earlier number has committed.
+'''
+from __future__ import unicode_literals
+
+import base64
+import calendar
+import hashlib
+import json
+from datetime import date
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from exporter import (COMPUTED_COLUMNS,
+                      FIELD_COLUMNS,
+                      RELATED_COLUMNS,
+                      ORDERING,
+                      keyset_after,
+                      related_dict,
+                      _json_value)
+from models import StaffMember, StaffChange, BULK_BATCH_SIZE, staff_changed
+
+
+class ApiError(ValueError):
+    pass
+
+
+DEFAULT_FIELDS = ['title', 'legal_given_name', 'legal_surname', 'prefered_given_name', 'prefered_surname',
+                  'display_name', 'employee_number', 'timetable_code', 'updated']
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+# Longer than the longest transaction writing staff changes
+SETTLE_SECONDS = 60
+
+# The model fields each computed column reads, so they can be loaded with only()
+COMPUTED_SOURCES = {'display_name': ['title', 'prefered_given_name', 'legal_given_name',
+                                     'prefered_surname', 'legal_surname'],
+                    'valid_bluecard': ['bluecard_expiry'],
+                    'age': ['dob']}
+# The model field of each field column, foreign keys are columns by attname
+FIELD_NAMES = dict((f.attname, f.name) for f in StaffMember._meta.fields)
+
+
+def parse_fields(value):
+    '''Field names from a comma separated list, DEFAULT_FIELDS when empty'''
+    fields = [f for f in (value or '').split(',') if f] or list(DEFAULT_FIELDS)
+    for field in fields:
+        if field not in FIELD_COLUMNS and field not in COMPUTED_COLUMNS and field not in RELATED_COLUMNS:
+            raise ApiError('Unknown field {}.'.format(field))
+    return fields
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ApiError('Invalid cursor.')
+    if not isinstance(values, list) or len(values) != len(ORDERING):
+        raise ApiError('Invalid cursor.')
+    return values
+
+
+def timestamp(day):
+    '''Seconds since the epoch at the start of day in UTC'''
+    return calendar.timegm(day.timetuple())
+
+
+def staff_record(staff, fields):
+    record = {'id': staff.pk}
+    for field in fields:
+        if field in RELATED_COLUMNS:
+            record[field] = [related_dict(r) for r in getattr(staff, field).all()]
+        elif field in COMPUTED_COLUMNS:
+            record[field] = COMPUTED_COLUMNS[field](staff)
+        else:
+            record[field] = _json_value(getattr(staff, field))
+    return record
+
+
+class StaffResource(object):
+    '''Validators and records for a list of staff members, checking the
+    validators costs one query and loading the records only happens for full
+    responses'''
+    def __init__(self, fields, rows, key):
+        '''rows are the (pk, updated, change_sequence) of each staff member'''
+        self.fields = fields
+        self.pks = [pk for pk, updated, sequence in rows]
+        updated = [updated for pk, updated, sequence in rows]
+        self.last_modified = max(updated) if updated else None
+        # every change appends to the change feed in the transaction making it
+        validators = [[pk, _json_value(updated), sequence] for pk, updated, sequence in rows]
+        self.etag = hashlib.md5(json.dumps([fields, key, validators]).encode('utf-8')).hexdigest()
+
+    def not_modified(self, if_none_match=None, if_modified_since=None, today=None):
+        '''Whether a request with these conditional headers, already parsed, can
+        be answered with 304'''
+        if if_none_match is not None:
+            return self.etag in if_none_match or '*' in if_none_match
+        # updated is a date, so a change later on the same day as the last one
+        # cannot be told apart and only earlier days are trusted
+        if if_modified_since is None or self.last_modified is None:
+            return False
+        return self.last_modified < (today or date.today()) and if_modified_since >= timestamp(self.last_modified)
+
+    def records(self):
+        only = set(['pk', 'updated'])
+        prefetch = []
+        for field in self.fields:
+            if field in RELATED_COLUMNS:
+                prefetch.append(field)
+                prefetch.extend(RELATED_COLUMNS[field][0])
+            else:
+                only.update(COMPUTED_SOURCES.get(field) or [FIELD_NAMES[field]])
+        staff = StaffMember.objects.only(*only).prefetch_related(*prefetch).in_bulk(self.pks)
+        return [staff_record(staff[pk], self.fields) for pk in self.pks if pk in staff]
+
+
+class StaffPage(StaffResource):
+    '''One page of active staff after cursor, in ORDERING'''
+    def __init__(self, fields=None, cursor=None, limit=DEFAULT_LIMIT):
+        queryset = StaffMember.objects.order_by(*ORDERING).with_change_sequence()
+        if cursor:
+            queryset = queryset.filter(keyset_after(ORDERING, decode_cursor(cursor)))
+        # the ordering values of each row to build the next cursor from, ending
+        # with the primary key
+        rows = list(queryset.values_list('pk', 'updated', 'change_sequence', *ORDERING[:-1])[:limit + 1])
+        self.next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            self.next_cursor = encode_cursor(list(rows[-1][3:]) + [rows[-1][0]])
+        super(StaffPage, self).__init__(fields or list(DEFAULT_FIELDS), [r[:3] for r in rows], [cursor, limit])
+
+
+class StaffDetail(StaffResource):
+    '''A single active staff member'''
+    def __init__(self, pk, fields=None):
+        rows = list(StaffMember.objects.filter(pk=pk).with_change_sequence()
+                                       .values_list('pk', 'updated', 'change_sequence'))
+        super(StaffDetail, self).__init__(fields or list(DEFAULT_FIELDS), rows, pk)
+        self.exists = bool(rows)
+
+
+class ChangePage(object):
+    '''Up to limit change feed entries after the sequence number since, read
+    with one query on the primary key'''
+    def __init__(self, since=0, limit=DEFAULT_LIMIT, settle_seconds=None):
+        if since < 0:
+            raise ApiError('Invalid cursor.')
+        if settle_seconds is None:
+            settle_seconds = getattr(settings, 'CHANGE_FEED_SETTLE_SECONDS', SETTLE_SECONDS)
+        rows = list(StaffChange.objects.since(since, settle_seconds)
+                                       .values_list('pk', 'staff_id', 'model', 'object_id', 'action',
+                                                    'created')[:limit + 1])
+        self.more = len(rows) > limit
+        rows = rows[:limit]
+        # the cursor to read the next page from, unchanged when there is nothing new
+        self.cursor = rows[-1][0] if rows else since
+        self.records = [{'sequence': pk, 'staff_id': staff_id, 'model': model, 'object_id': object_id,
+                         'action': action, 'created': _json_value(created)}
+                        for pk, staff_id, model, object_id, action, created in rows]
+
+
+@receiver(staff_changed)
+def touch_updated(sender, staff_ids, **kwargs):
+    '''A change to a staff member's related rows counts as a change to the staff
+    member, so updated and Last-Modified cover them too. Saves of the staff
+    member set updated themselves.'''
+    if sender is StaffMember:
+        return
+    staff_ids = list(staff_ids)
+    today = date.today()
+    for start in range(0, len(staff_ids), BULK_BATCH_SIZE):
+        (StaffMember.all_objects.filter(pk__in=staff_ids[start:start + BULK_BATCH_SIZE])
+                                .exclude(updated=today)
+                                .update(updated=today))
@@ -0,0 +1,287 @@
+'''Archive tier for staff who left long ago.
+
+Staff members are never deleted, so after years of turnover most staff rows,
+and most of their contacts, attendance and versions, belong to departed staff.
+archive_staff moves staff who have been inactive and unchanged for
+ARCHIVE_AFTER_DAYS into ArchivedStaff, one row each holding their rows from
+every table in ARCHIVED_ROWS and the reversion versions of those rows as
+serialized JSON, and deletes them from the live tables. Staff are archived
+batch_size at a time, each batch in its own transaction costing a few queries
+per table, so a long first run can be stopped and resumed.
+
+restore_staff moves archived staff back with their original primary keys,
+still inactive, and rebuilds their search terms and inservice hours.
+Attendance at sessions since deleted and keys since reissued are left out, as
+is a supervisor no longer on staff. search_archive finds archived staff by the
+words of their names, identifiers and email addresses.
+
+Staff who supervise active staff are never archived, inactive staff they
+supervise lose their supervisor when they are. Archived staff keep their
+StaffSnapshot rows, so rosters for dates when they were employed still list
+them.
+'''
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import date, timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.db import router, transaction
+import reversion
+from reversion.models import Revision, Version
+
+from models import (StaffMember,
+                    Address,
+                    StaffPhoneNumber,
+                    NOKPhoneNumber,
+                    NextOfKin,
+                    Qualification,
+                    EmailAddress,
+                    SearchTerm,
+                    ExpiryNotification,
+                    ArchivedStaff,
+                    StaffChange,
+                    staff_changed,
+                    BULK_BATCH_SIZE)
+from search import index_staff, words, NAME_FIELDS, IDENTIFIER_FIELDS
+from InserviceTracker.hours import move_attendance_hours
+from InserviceTracker.models import (InserviceHours,
+                                     InserviceRecord,
+                                     InserviceSession,
+                                     LegacyInserviceRecord,
+                                     LegacyInserviceRecordStandard)
+from KeyRegistry.models import DoorKey
+
+
+ARCHIVE_AFTER_DAYS = 2 * 365
+ARCHIVE_BATCH_SIZE = 100
+
+# The tables archived with each staff member and the lookup from their rows to
+# the staff member, parents first as they are restored in this order
+ARCHIVED_ROWS = [(StaffMember, 'pk'),
+                 (Address, 'staff_member'),
+                 (StaffPhoneNumber, 'staff_member'),
+                 (EmailAddress, 'staff_member'),
+                 (NextOfKin, 'staff_member'),
+                 (NOKPhoneNumber, 'next_of_kin__staff_member'),
+                 (Qualification, 'staff_member'),
+                 (ExpiryNotification, 'staff_member'),
+                 (DoorKey, 'owner'),
+                 (InserviceRecord, 'staff_member'),
+                 (LegacyInserviceRecord, 'staff_member'),
+                 (LegacyInserviceRecordStandard, 'record__staff_member')]
+# Tables built from the archived rows, deleted on archiving and rebuilt on restore
+DERIVED_ROWS = [(SearchTerm, 'staff_member'), (InserviceHours, 'staff_member')]
+
+# Unique staff identifiers that may have been given to someone else while a
+# staff member was archived
+UNIQUE_FIELDS = ('employee_number', 'bluecard_number', 'teacher_registration_number')
+
+
+class RestoreError(ValueError):
+    pass
+
+
+def archive_after_days():
+    return getattr(settings, 'ARCHIVE_AFTER_DAYS', ARCHIVE_AFTER_DAYS)
+
+
+def archivable(on=None, days=None):
+    '''Inactive staff unchanged in the days before on, who supervise no active
+    staff'''
+    on = on or date.today()
+    days = archive_after_days() if days is None else days
+    return (StaffMember.all_objects.filter(active=False, updated__lt=on - timedelta(days=days))
+                                   .exclude(supervised_staff__active=True))
+
+
+def staff_rows(model, lookup, staff_ids):
+    '''(staff member primary key, row) of each row of model belonging to
+    staff_ids, in primary key order'''
+    path = lookup.split('__')
+    rows = model._base_manager.filter(**{lookup + '__in': staff_ids}).order_by('pk')
+    if len(path) > 1:
+        rows = rows.select_related('__'.join(path[:-1]))
+    for row in rows:
+        owner = reduce(getattr, path[:-1], row)
+        yield owner.pk if path[-1] == 'pk' else getattr(owner, path[-1] + '_id'), row
+
+
+def row_versions(rows):
+    '''(staff member primary key, version) of each saved version of rows, a map
+    of staff member primary key to their rows'''
+    owners = defaultdict(dict)
+    for staff_id, owned in rows.items():
+        for row in owned:
+            if reversion.is_registered(type(row)):
+                owners[type(row)][row.pk] = staff_id
+    for model, pks in owners.items():
+        content_type = ContentType.objects.get_for_model(model)
+        object_ids = sorted(pks)
+        for start in range(0, len(object_ids), BULK_BATCH_SIZE):
+            # object_id_int is indexed, object_id is not
+            versions = Version.objects.filter(content_type=content_type,
+                                              object_id_int__in=object_ids[start:start + BULK_BATCH_SIZE])
+            for version in versions.order_by('pk'):
+                yield pks[version.object_id_int], version
+
+
+def archive_record(rows, versions):
+    '''An unsaved ArchivedStaff from a staff member's rows, their StaffMember
+    first, and the versions of those rows'''
+    staff = rows[0]
+    text = [getattr(staff, field) for field in NAME_FIELDS + IDENTIFIER_FIELDS]
+    text.extend(row.address for row in rows if isinstance(row, EmailAddress))
+    search_words = words(' '.join('{}'.format(value) for value in text if value))
+    return ArchivedStaff(staff_id=staff.pk,
+                         employee_number=staff.employee_number,
+                         title=staff.title,
+                         prefered_given_name=staff.prefered_given_name,
+                         legal_given_name=staff.legal_given_name,
+                         prefered_surname=staff.prefered_surname,
+                         legal_surname=staff.legal_surname,
+                         dob=staff.dob,
+                         departed=staff.updated,
+                         search_text=''.join(' ' + word for word in search_words),
+                         rows=serializers.serialize('json', rows),
+                         versions=serializers.serialize('json', versions, use_natural_keys=True))
+
+
+def archive_batch(staff_ids):
+    '''Archive staff_ids in one transaction'''
+    with transaction.atomic():
+        rows = defaultdict(list)
+        for model, lookup in ARCHIVED_ROWS:
+            for staff_id, row in staff_rows(model, lookup, staff_ids):
+                rows[staff_id].append(row)
+        versions = defaultdict(list)
+        for staff_id, version in row_versions(rows):
+            versions[staff_id].append(version)
+        ArchivedStaff.objects.bulk_create([archive_record(rows[pk], versions[pk]) for pk in staff_ids],
+                                          batch_size=BULK_BATCH_SIZE)
+        version_ids = [v.pk for staff_versions in versions.values() for v in staff_versions]
+        for start in range(0, len(version_ids), BULK_BATCH_SIZE):
+            Version.objects.filter(pk__in=version_ids[start:start + BULK_BATCH_SIZE]).delete()
+        # inactive staff supervised by those archived lose their supervisor,
+        # as restorable clears one no longer on staff
+        supervised = list(StaffMember.all_objects.filter(supervisor__in=staff_ids).exclude(pk__in=staff_ids))
+        if supervised:
+            StaffMember.all_objects.filter(pk__in=[s.pk for s in supervised]).update(supervisor=None)
+            for member in supervised:
+                member.supervisor_id = None
+            reversion.default_revision_manager.save_revision(supervised, comment='Supervisor archived.')
+            StaffChange.objects.record(StaffMember, [s.pk for s in supervised])
+        # children first, every row is already in the archive so the deletes
+        # skip the per row signals and cascades of QuerySet.delete. What their
+        # handlers maintain is covered here: DERIVED_ROWS, such as the
+        # InserviceHours and SearchTerm rows, are deleted with the rows, and
+        # the change feed entry and staff_changed replace the per row ones
+        for model, lookup in DERIVED_ROWS + ARCHIVED_ROWS[::-1]:
+            doomed = model._base_manager.filter(**{lookup + '__in': staff_ids})
+            doomed._raw_delete(using=router.db_for_write(model))
+        StaffChange.objects.record(StaffMember, staff_ids, 'archived')
+    staff_changed.send(sender=StaffMember, staff_ids=staff_ids + [s.pk for s in supervised])
+
+
+def archive_staff(on=None, days=None, batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    '''Archive every archivable staff member, batch_size at a time. Returns
+    the number of staff archived.'''
+    queryset = archivable(on, days).order_by('pk')
+    if dry_run:
+        return queryset.count()
+    count = 0
+    last_pk = 0
+    while True:
+        staff_ids = list(queryset.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+        if not staff_ids:
+            break
+        last_pk = staff_ids[-1]
+        archive_batch(staff_ids)
+        count += len(staff_ids)
+    return count
+
+
+def restorable(objects):
+    '''The deserialized objects that can be restored, supervisors no longer on
+    staff are cleared. Raises RestoreError when an archived staff member's
+    identifiers have since been given to someone else.'''
+    by_model = defaultdict(list)
+    for obj in objects:
+        by_model[type(obj.object)].append(obj.object)
+    staff = by_model[StaffMember]
+    for field in UNIQUE_FIELDS:
+        values = [getattr(s, field) for s in staff if getattr(s, field) is not None]
+        taken = set(StaffMember.all_objects.filter(**{field + '__in': values}).values_list(field, flat=True))
+        if taken:
+            raise RestoreError('{} {} is in use by another staff member.'.format(
+                StaffMember._meta.get_field(field).verbose_name, ', '.join('{}'.format(v) for v in sorted(taken))))
+    codes = [s.timetable_code for s in staff if s.timetable_code]
+    codes = set(StaffMember.all_objects.filter(timetable_code__in=codes).values_list('timetable_code', flat=True))
+    supervisors = [s.supervisor_id for s in staff if s.supervisor_id]
+    supervisors = set(StaffMember.all_objects.filter(pk__in=supervisors).values_list('pk', flat=True))
+    supervisors.update(s.pk for s in staff)
+    for member in staff:
+        if member.timetable_code in codes:
+            member.timetable_code = None
+        if member.supervisor_id not in supervisors:
+            member.supervisor_id = None
+    sessions = set(InserviceSession.objects.filter(pk__in=set(r.session_id for r in by_model[InserviceRecord]))
+                                           .values_list('pk', flat=True))
+    keys = by_model[DoorKey]
+    issued = set(DoorKey.objects.filter(number__in=[k.number for k in keys]).values_list('kind', 'number'))
+    dropped = set()
+    for obj in objects:
+        row = obj.object
+        if ((isinstance(row, InserviceRecord) and row.session_id not in sessions) or
+                (isinstance(row, DoorKey) and (row.kind, row.number) in issued)):
+            dropped.add((type(row), row.pk))
+    return [obj for obj in objects if (type(obj.object), obj.object.pk) not in dropped]
+
+
+def restore_staff(archived, user=None, comment='Restored from the archive.'):
+    '''Move archived staff back into the live tables with their original
+    primary keys, still inactive. Versions whose revision has been deleted are
+    added to a new revision. Returns the number of staff restored.'''
+    archived = list(archived)
+    if not archived:
+        return 0
+    staff_ids = [a.staff_id for a in archived]
+    with transaction.atomic():
+        objects = restorable([obj for a in archived for obj in serializers.deserialize('json', a.rows)])
+        for obj in objects:
+            obj.save()
+        restored = set((type(obj.object), obj.object.pk) for obj in objects)
+        versions = [obj.object for a in archived for obj in serializers.deserialize('json', a.versions)]
+        versions = [v for v in versions if (v.content_type.model_class(), v.object_id_int) in restored]
+        revisions = set(Revision.objects.filter(pk__in=set(v.revision_id for v in versions))
+                                        .values_list('pk', flat=True))
+        if any(v.revision_id not in revisions for v in versions):
+            revision = Revision.objects.create(user=user, comment=comment)
+            for version in versions:
+                if version.revision_id not in revisions:
+                    version.revision = revision
+        for version in versions:
+            version.save(force_insert=True)
+        # raw saves send no signals, so add back what was derived from the rows
+        move_attendance_hours(added=[(obj.object.session_id, obj.object.staff_member_id) for obj in objects
+                                     if isinstance(obj.object, InserviceRecord)])
+        index_staff(StaffMember.all_objects.filter(pk__in=staff_ids))
+        ArchivedStaff.objects.filter(pk__in=[a.pk for a in archived]).delete()
+        StaffChange.objects.record(StaffMember, staff_ids, 'restored')
+    staff_changed.send(sender=StaffMember, staff_ids=staff_ids)
+    return len(archived)
+
+
+def search_archive(query, queryset=None):
+    '''Archived staff with a word starting with each word of query among their
+    names, identifiers and email addresses'''
+    queryset = ArchivedStaff.objects.all() if queryset is None else queryset
+    query_words = words(query)
+    if not query_words:
+        return queryset.none()
+    for word in query_words:
+        queryset = queryset.filter(search_text__contains=' ' + word)
+    return queryset
@@ -0,0 +1,207 @@
+'''Latency and query count benchmarks for the staff admin, its history pages,
+bulk operations and the API.
+
+Scenarios run against the staff already in the database, use generate_staff
+to fill a database for benchmarking. Each run goes through the test client as a
+superuser inside a transaction that is rolled back, so saves and bulk
+operations leave the data as it was and every run sees the same data.
+'''
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from datetime import datetime
+from timeit import default_timer
+
+import django
+from django.contrib import admin
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.util import flatten_fieldsets
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.forms.models import model_to_dict
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+import reversion
+
+from models import StaffMember, EmailAddress
+from InserviceTracker.models import InserviceSession
+
+BENCHMARK_USER = 'staff-benchmark'
+
+
+class BenchmarkError(ValueError):
+    pass
+
+
+def form_value(value):
+    '''The value a browser would post for a form field, None when it posts nothing'''
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'on' if value else None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return '{}'.format(value)
+
+
+def post_data(values):
+    data = {}
+    for name, value in values.items():
+        value = form_value(value)
+        if value is not None:
+            data[name] = value
+    return data
+
+
+def change_form_data(staff):
+    '''POST data for saving staff through StaffMemberAdmin's change form, which
+    holds their core fields, their related rows are saved by section'''
+    model_admin = admin.site._registry[StaffMember]
+    return post_data(model_to_dict(staff, fields=flatten_fieldsets(model_admin.fieldsets)))
+
+
+def section_form_data(staff, section, label='Benchmark'):
+    '''POST data for saving the first page of one of staff's related sections
+    through StaffMemberAdmin's section view, every row with a label is
+    relabelled so the section has changes to save'''
+    model_admin = admin.site._registry[StaffMember]
+    inline = model_admin.sections[section].inline
+    _, rows = model_admin.section_page(staff, section, 1)
+    rows = list(rows)
+    values = {section + '-TOTAL_FORMS': len(rows), section + '-INITIAL_FORMS': len(rows),
+              section + '-MAX_NUM_FORMS': 1000}
+    for index, row in enumerate(rows):
+        row_values = model_to_dict(row, fields=list(inline.fields) + ['id', 'staff_member'])
+        if 'label' in row_values:
+            row_values['label'] = label
+        values.update(('{}-{}-{}'.format(section, index, name), value) for name, value in row_values.items())
+    return post_data(values)
+
+
+class Benchmark(object):
+    '''Run each scenario repeat times after an unmeasured warm up run.
+
+    The change and history scenarios use the first active staff member, bulk
+    operations the first batch_size active staff members.'''
+    def __init__(self, repeat=5, batch_size=100):
+        self.repeat = repeat
+        self.batch_size = batch_size
+        self.scenarios = OrderedDict([('changelist', self.changelist),
+                                      ('changelist_search', self.changelist_search),
+                                      ('change_view', self.change_view),
+                                      ('change_save', self.change_save),
+                                      ('section_view', self.section_view),
+                                      ('section_save', self.section_save),
+                                      ('history', self.history),
+                                      ('revision', self.revision),
+                                      ('deactivate_action', self.deactivate_action),
+                                      ('mark_attendance_action', self.mark_attendance_action),
+                                      ('set_primary', self.set_primary),
+                                      ('api_page', self.api_page)])
+
+    # Scenarios return the response status, or None when they make no request
+
+    def changelist(self):
+        return self.client.get(reverse('admin:StaffInformation_staffmember_changelist')).status_code
+
+    def changelist_search(self):
+        return self.client.get(reverse('admin:StaffInformation_staffmember_changelist'),
+                               {'q': self.staff.legal_surname}).status_code
+
+    def change_view(self):
+        return self.client.get(reverse('admin:StaffInformation_staffmember_change', args=(self.staff.pk,))).status_code
+
+    def change_save(self):
+        return self.client.post(reverse('admin:StaffInformation_staffmember_change', args=(self.staff.pk,)),
+                                change_form_data(self.staff)).status_code
+
+    def section_view(self):
+        return self.client.get(reverse('admin:StaffInformation_staffmember_section',
+                                       args=(self.staff.pk, 'email_addresses'))).status_code
+
+    def section_save(self):
+        return self.client.post(reverse('admin:StaffInformation_staffmember_section',
+                                        args=(self.staff.pk, 'email_addresses')),
+                                section_form_data(self.staff, 'email_addresses')).status_code
+
+    def history(self):
+        return self.client.get(reverse('admin:StaffInformation_staffmember_history', args=(self.staff.pk,))).status_code
+
+    def revision(self):
+        version = reversion.get_for_object(self.staff).values_list('pk', flat=True)[0]
+        return self.client.get(reverse('admin:StaffInformation_staffmember_revision',
+                                       args=(self.staff.pk, version))).status_code
+
+    def deactivate_action(self):
+        return self.client.post(reverse('admin:StaffInformation_staffmember_changelist'),
+                                {'action': 'deactivate_selected', ACTION_CHECKBOX_NAME: self.batch}).status_code
+
+    def mark_attendance_action(self):
+        session = InserviceSession.objects.order_by('-date', '-pk').first()
+        if session is None:
+            return None
+        return self.client.post(reverse('admin:StaffInformation_staffmember_changelist'),
+                                {'action': 'mark_inservice_attendance', 'apply': '1', 'session': session.pk,
+                                 ACTION_CHECKBOX_NAME: self.batch}).status_code
+
+    def set_primary(self):
+        EmailAddress.objects.set_primary(EmailAddress.objects.filter(staff_member__in=self.batch, primary=False))
+
+    def api_page(self):
+        return self.client.get(reverse('api_staff'), {'limit': self.batch_size}).status_code
+
+    def measure(self, scenario):
+        '''Time one run of scenario, rolling back whatever it wrote'''
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                start = default_timer()
+                status = scenario()
+                elapsed = default_timer() - start
+            transaction.set_rollback(True)
+        return {'status': status,
+                'ms': elapsed * 1000,
+                'queries': len(queries),
+                'sql_ms': sum(float(q['time']) for q in queries.captured_queries) * 1000}
+
+    def run(self, names=None):
+        '''Run the named scenarios, all of them by default, returns the results as
+        a dict ready to be written as JSON'''
+        names = names or list(self.scenarios)
+        for name in names:
+            if name not in self.scenarios:
+                raise BenchmarkError('Unknown scenario {}.'.format(name))
+        self.staff = StaffMember.objects.order_by('pk').first()
+        if self.staff is None:
+            raise BenchmarkError('There are no staff to benchmark.')
+        self.batch = list(StaffMember.objects.order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+        results = OrderedDict([('started', datetime.now().isoformat()),
+                               ('django', django.get_version()),
+                               ('database', connection.vendor),
+                               ('staff', StaffMember.all_objects.count()),
+                               ('repeat', self.repeat),
+                               ('batch_size', self.batch_size),
+                               ('scenarios', OrderedDict())])
+        # the benchmark user and its session are rolled back with everything else
+        with override_settings(ALLOWED_HOSTS=['testserver']), transaction.atomic():
+            User.objects.create_superuser(BENCHMARK_USER, 'benchmark@example.com', BENCHMARK_USER)
+            self.client = Client()
+            self.client.login(username=BENCHMARK_USER, password=BENCHMARK_USER)
+            for name in names:
+                self.measure(self.scenarios[name])
+                runs = [self.measure(self.scenarios[name]) for _ in range(self.repeat)]
+                results['scenarios'][name] = summarise(runs)
+            transaction.set_rollback(True)
+        return results
+
+
+def summarise(runs):
+    times = sorted(run['ms'] for run in runs)
+    return OrderedDict([('status', runs[0]['status']),
+                        ('min_ms', times[0]),
+                        ('median_ms', times[len(times) // 2]),
+                        ('mean_ms', sum(times) / len(times)),
+                        ('max_ms', times[-1]),
+                        ('queries', max(run['queries'] for run in runs)),
+                        ('sql_ms', sum(run['sql_ms'] for run in runs) / len(runs)),
+                        ('runs', runs)])
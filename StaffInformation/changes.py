@@ -0,0 +1,107 @@
+'''Sends staff_changed for every change to a staff member or their related rows.
+
+Saves and deletes of staff members, their contacts, next of kin, qualifications,
+keys and inservice attendance are mapped to the staff members they belong to,
+so anything holding per staff data, such as the profile cache, only needs to
+listen for staff_changed. Bulk operations that bypass these signals send
+staff_changed themselves.
+
+Each change is also appended to the StaffChange feed. Django 1.6 sends
+post_delete inside the delete's transaction but post_save after the save's has
+committed, so the models written here save inside transaction.atomic and their
+feed entries commit with the change they describe. Bulk operations record their
+entries inside their own transactions. Saves of a staff member that change
+active are recorded as deactivations or reactivations, since staff members are
+never deleted.
+'''
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from models import (StaffMember,
+                    Address,
+                    StaffPhoneNumber,
+                    NOKPhoneNumber,
+                    NextOfKin,
+                    Qualification,
+                    EmailAddress,
+                    StaffChange,
+                    staff_changed)
+from InserviceTracker.models import InserviceSession, InserviceRecord, InserviceStandard
+from KeyRegistry.models import DoorKey
+
+
+STAFF_OWNED = (Address, StaffPhoneNumber, EmailAddress, NextOfKin, Qualification, InserviceRecord)
+
+
+def changed(sender, staff_ids, action='updated', object_id=None):
+    staff_ids = [pk for pk in set(staff_ids) if pk is not None]
+    if staff_ids:
+        StaffChange.objects.record(sender, staff_ids, action, object_id)
+        staff_changed.send(sender=sender, staff_ids=staff_ids)
+
+
+def row_action(signal, created=False):
+    if signal is post_delete:
+        return 'deleted'
+    return 'created' if created else 'updated'
+
+
+@receiver(post_save, sender=StaffMember)
+@receiver(post_delete, sender=StaffMember)
+def staff_saved(sender, instance, signal, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    action = row_action(signal, created)
+    if action == 'updated' and instance._saved_active not in (None, instance.active):
+        action = 'reactivated' if instance.active else 'deactivated'
+    changed(sender, [instance.pk], action, instance.pk)
+
+
+def owned_row_saved(sender, instance, signal, created=False, raw=False, **kwargs):
+    if not raw:
+        changed(sender, [instance.staff_member_id], row_action(signal, created), instance.pk)
+
+for model in STAFF_OWNED:
+    post_save.connect(owned_row_saved, sender=model, dispatch_uid='changes_{}_saved'.format(model.__name__))
+    post_delete.connect(owned_row_saved, sender=model, dispatch_uid='changes_{}_deleted'.format(model.__name__))
+
+
+@receiver(post_save, sender=NOKPhoneNumber)
+@receiver(post_delete, sender=NOKPhoneNumber)
+def next_of_kin_phone_saved(sender, instance, signal, created=False, raw=False, **kwargs):
+    if not raw:
+        changed(sender, NOKPhoneNumber.owner_staff_ids([instance]), row_action(signal, created), instance.pk)
+
+
+@receiver(post_save, sender=DoorKey)
+@receiver(post_delete, sender=DoorKey)
+def key_saved(sender, instance, signal, created=False, raw=False, **kwargs):
+    if not raw:
+        changed(sender, [instance.owner_id], row_action(signal, created), instance.pk)
+
+
+def attendees(**filters):
+    return InserviceRecord.objects.filter(**filters).values_list('staff_member', flat=True)
+
+
+@receiver(post_save, sender=InserviceSession)
+def session_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw and not created:
+        changed(sender, attendees(session=instance), object_id=instance.pk)
+
+
+@receiver(m2m_changed, sender=InserviceSession.standards.through)
+def session_standards_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            changed(InserviceSession, attendees(session=instance))
+    elif action == 'pre_clear':
+        changed(InserviceSession, attendees(session__standards=instance))
+    elif action.startswith('post_') and pk_set:
+        changed(InserviceSession, attendees(session__in=pk_set))
+
+
+@receiver(pre_delete, sender=InserviceStandard)
+def standard_deleted(sender, instance, **kwargs):
+    # the sessions lose the standard without an m2m_changed signal
+    changed(sender, attendees(session__standards=instance))
@@ -0,0 +1,46 @@
+'''Blue card and teacher registration compliance for the whole school.
+
+A ComplianceReport is built from two queries, one grouped count of staff by
+blue card and registration status and one listing the staff who need
+attention, both using the status annotations from
+StaffMemberQuerySet.with_compliance_status.
+'''
+from datetime import date, timedelta
+
+from django.db.models import Count, Q
+
+from models import StaffMember, COMPLIANCE_STATUSES, EXPIRY_WARNING_DAYS
+
+
+class ComplianceReport(object):
+    def __init__(self, days=EXPIRY_WARNING_DAYS, on=None, queryset=None):
+        self.days = days
+        self.on = on or date.today()
+        queryset = queryset if queryset is not None else StaffMember.objects.all()
+        self.queryset = queryset.with_compliance_status(days=days, on=self.on)
+        self.bluecard = dict((status, 0) for status, _ in COMPLIANCE_STATUSES)
+        self.registration = dict((status, 0) for status, _ in COMPLIANCE_STATUSES)
+        self.total = 0
+        counts = (self.queryset.order_by()
+                               .values('bluecard_status', 'registration_status')
+                               .annotate(count=Count('pk')))
+        for row in counts:
+            self.bluecard[row['bluecard_status']] += row['count']
+            self.registration[row['registration_status']] += row['count']
+            self.total += row['count']
+
+    def attention(self):
+        '''Staff with an expired, expiring or missing blue card or registration,
+        annotated with their statuses and ordered by name'''
+        warning = self.on + timedelta(days=self.days)
+        return self.queryset.filter(Q(bluecard_expiry__lte=warning) |
+                                    Q(teacher_registration_expiry__lte=warning) |
+                                    Q(teacher_registration_expiry__isnull=True,
+                                      timetable_code__isnull=False) |
+                                    Q(teacher_registration_expiry__isnull=True,
+                                      teacher_registration_number__isnull=False))
+
+    def summary(self):
+        '''Rows of (label, bluecard count, registration count) for each status'''
+        return [(label, self.bluecard[status], self.registration[status])
+                for status, label in COMPLIANCE_STATUSES]
@@ -0,0 +1,16 @@
+'''Counters kept in a cache, so every process sharing the cache adds to the
+same totals.'''
+from __future__ import unicode_literals
+
+
+def incr_counter(cache, key, n):
+    '''Add n to the counter stored at key, creating it if it is missing. The
+    counter never expires.'''
+    if not n:
+        return
+    try:
+        cache.incr(key, n)
+    except ValueError:
+        # another process may have created it since incr failed
+        if not cache.add(key, n, None):
+            cache.incr(key, n)
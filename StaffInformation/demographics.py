@@ -0,0 +1,86 @@
+'''Age, length of service and birthday reports for HR.
+
+A DemographicsReport is built from two grouped queries, staff counted by age
+and by whole years of service, both computed in SQL by
+StaffMemberQuerySet.with_age and with_service. There are only a few dozen
+distinct ages and lengths of service, so the report costs the same however many
+staff there are, and the counts are put into bands in Python.
+'''
+from collections import OrderedDict
+from datetime import date, timedelta
+
+from django.db.models import Count
+
+from models import StaffMember, RETIREMENT_AGE
+
+# (lowest value, label) of each band, in order
+AGE_BANDS = [(0, 'Under 25'),
+             (25, '25 to 34'),
+             (35, '35 to 44'),
+             (45, '45 to 54'),
+             (55, '55 to 64'),
+             (65, '65 and over')]
+
+SERVICE_BANDS = [(0, 'Under 1 year'),
+                 (1, '1 to 4 years'),
+                 (5, '5 to 9 years'),
+                 (10, '10 to 19 years'),
+                 (20, '20 years or more')]
+
+# Days ahead that upcoming birthdays are listed
+BIRTHDAY_DAYS = 7
+
+
+def band(value, bands):
+    label = bands[0][1]
+    for lowest, band_label in bands:
+        if value >= lowest:
+            label = band_label
+    return label
+
+
+class DemographicsReport(object):
+    def __init__(self, on=None, queryset=None, retirement_age=RETIREMENT_AGE):
+        self.on = on or date.today()
+        self.retirement_age = retirement_age
+        self.queryset = queryset if queryset is not None else StaffMember.objects.all()
+        self.age_bands = OrderedDict((label, 0) for _, label in AGE_BANDS)
+        self.service_bands = OrderedDict((label, 0) for _, label in SERVICE_BANDS)
+        self.total = 0
+        self.retirement_eligible = 0
+        self.mean_age = None
+        self.mean_service = None
+        ages = (self.queryset.order_by()
+                             .with_age(on=self.on)
+                             .values('age_years')
+                             .annotate(count=Count('pk')))
+        age_total = 0
+        for row in ages:
+            age = int(row['age_years'])
+            self.age_bands[band(age, AGE_BANDS)] += row['count']
+            if age >= retirement_age:
+                self.retirement_eligible += row['count']
+            self.total += row['count']
+            age_total += age * row['count']
+        services = (self.queryset.order_by()
+                                 .with_service(on=self.on)
+                                 .values('service_years')
+                                 .annotate(count=Count('pk')))
+        service_total = 0
+        for row in services:
+            years = int(row['service_years'])
+            self.service_bands[band(years, SERVICE_BANDS)] += row['count']
+            service_total += years * row['count']
+        if self.total:
+            self.mean_age = float(age_total) / self.total
+            self.mean_service = float(service_total) / self.total
+
+    def birthdays(self, days=BIRTHDAY_DAYS):
+        '''Staff with a birthday in the days from on, in birthday order, annotated
+        with the age they turn'''
+        end = self.on + timedelta(days=days - 1)
+        return self.queryset.birthdays_between(self.on, end).with_age(on=end)
+
+    def retiring(self):
+        '''Staff at or over the retirement age, oldest first'''
+        return self.queryset.aged(minimum=self.retirement_age, on=self.on).with_age(on=self.on).order_by('dob')
@@ -0,0 +1,306 @@
+'''Finds staff members entered more than once and merges them.
+
+Scoring every pair of staff is quadratic, so candidate pairs are only drawn
+from blocks of staff that share a blocking key: date of birth with a
+normalised surname, the Soundex codes of a surname and given name, an email
+address or a phone number. Each staff member has a handful of keys, so finding
+candidates grows close to linearly with the number of staff. Blocks larger
+than MAX_BLOCK_SIZE, such as a shared office phone, are skipped as they say
+little about who someone is. Candidates are scored on how alike their names
+are, their dates of birth and shared contacts, and pairs scoring at least
+MIN_SCORE are reported.
+
+merge_staff moves everything belonging to duplicates onto the staff member
+kept with an UPDATE per related table, then deactivates the duplicates.
+'''
+from __future__ import unicode_literals
+
+from collections import defaultdict, namedtuple
+from itertools import combinations
+
+from django.db import transaction
+from django.db.models import Max
+import reversion
+
+from models import (StaffMember,
+                    Address,
+                    StaffPhoneNumber,
+                    NextOfKin,
+                    Qualification,
+                    EmailAddress,
+                    ExpiryNotification,
+                    StaffChange,
+                    staff_changed,
+                    BULK_BATCH_SIZE)
+from search import index_staff, similarity, words, MIN_FUZZY_LENGTH, PREFIX_SCORE
+from InserviceTracker.hours import move_attendance_hours
+from InserviceTracker.models import InserviceRecord, LegacyInserviceRecord
+from KeyRegistry.models import DoorKey
+
+
+MIN_SCORE = 0.7
+MAX_BLOCK_SIZE = 50
+# Share of the score from each kind of evidence
+WEIGHTS = {'given_name': 0.25, 'surname': 0.25, 'dob': 0.3, 'contact': 0.2}
+
+SOUNDEX_CODES = dict((letter, code) for letters, code in [('bfpv', '1'), ('cgjkqsxz', '2'), ('dt', '3'),
+                                                          ('l', '4'), ('mn', '5'), ('r', '6')]
+                     for letter in letters)
+
+Match = namedtuple('Match', ['first', 'second', 'score', 'reasons'])
+
+
+def name_key(name):
+    '''A name lower cased without accents, spaces or punctuation'''
+    return ''.join(words(name or ''))
+
+
+def soundex(name):
+    '''The American Soundex code of a name_key, R163 for robert and rupert'''
+    letters = [c for c in name if 'a' <= c <= 'z']
+    if not letters:
+        return ''
+    code = [letters[0].upper()]
+    previous = SOUNDEX_CODES.get(letters[0], '')
+    for letter in letters[1:]:
+        digit = SOUNDEX_CODES.get(letter, '')
+        if digit and digit != previous:
+            code.append(digit)
+        # h and w do not separate letters with the same code, vowels do
+        if letter not in 'hw':
+            previous = digit
+    return (''.join(code) + '000')[:4]
+
+
+def name_similarity(a, b):
+    '''similarity of two name_keys, at least PREFIX_SCORE when one starts the
+    other, so shortened names such as Rob for Robert match'''
+    shorter, longer = sorted((a, b), key=len)
+    if len(shorter) >= MIN_FUZZY_LENGTH and shorter != longer and longer.startswith(shorter):
+        return max(PREFIX_SCORE, similarity(a, b))
+    return similarity(a, b)
+
+
+def dob_similarity(a, b):
+    '''1 for the same date, 0.5 for dates differing in one of day, month and
+    year or with the day and month swapped'''
+    if a is None or b is None:
+        return 0.0
+    if a == b:
+        return 1.0
+    same = (a.year == b.year) + (a.month == b.month) + (a.day == b.day)
+    if same == 2 or (a.year == b.year and a.month == b.day and a.day == b.month):
+        return 0.5
+    return 0.0
+
+
+class StaffRecord(object):
+    '''The details of a staff member that duplicates are found from. key
+    identifies the staff member and label describes them in reports.'''
+    def __init__(self, key, label, given_names, surnames, dob, emails=(), phones=()):
+        self.key = key
+        self.label = label
+        self.given_names = set(filter(None, (name_key(n) for n in given_names)))
+        self.surnames = set(filter(None, (name_key(n) for n in surnames)))
+        self.dob = dob
+        self.emails = set(e.strip().lower() for e in emails if e)
+        self.phones = set('{}'.format(p) for p in phones if p is not None)
+
+    @classmethod
+    def from_staff(cls, key, label, staff, emails=(), phones=()):
+        return cls(key, label, [staff.prefered_given_name, staff.legal_given_name],
+                   [staff.prefered_surname, staff.legal_surname], staff.dob, emails, phones)
+
+    def blocking_keys(self):
+        keys = set()
+        for surname in self.surnames:
+            if self.dob is not None:
+                keys.add(('dob', self.dob, surname))
+            for given_name in self.given_names:
+                keys.add(('soundex', soundex(surname), soundex(given_name)))
+        keys.update(('email', email) for email in self.emails)
+        keys.update(('phone', phone) for phone in self.phones)
+        return keys
+
+
+def score(a, b):
+    '''The similarity of StaffRecords a and b from 0 to 1 with the reasons for it'''
+    given_name = max([name_similarity(x, y) for x in a.given_names for y in b.given_names] or [0.0])
+    surname = max([name_similarity(x, y) for x in a.surnames for y in b.surnames] or [0.0])
+    dob = dob_similarity(a.dob, b.dob)
+    shared_emails = a.emails & b.emails
+    shared_phones = a.phones & b.phones
+    contact = 1.0 if shared_emails or shared_phones else 0.0
+    reasons = []
+    if given_name == 1 and surname == 1:
+        reasons.append('same name')
+    elif given_name + surname >= 1.5:
+        reasons.append('similar name')
+    if dob == 1:
+        reasons.append('same date of birth')
+    elif dob:
+        reasons.append('similar date of birth')
+    if shared_emails:
+        reasons.append('shared email address')
+    if shared_phones:
+        reasons.append('shared phone number')
+    total = (WEIGHTS['given_name'] * given_name + WEIGHTS['surname'] * surname +
+             WEIGHTS['dob'] * dob + WEIGHTS['contact'] * contact)
+    return round(total, 3), reasons
+
+
+class DuplicateFinder(object):
+    def __init__(self, min_score=MIN_SCORE, max_block_size=MAX_BLOCK_SIZE):
+        self.min_score = min_score
+        self.max_block_size = max_block_size
+        self.records = {}
+        self.blocks = defaultdict(list)
+
+    def add(self, record):
+        if record.key in self.records:
+            return
+        self.records[record.key] = record
+        for key in record.blocking_keys():
+            self.blocks[key].append(record.key)
+
+    def load(self, queryset=None):
+        '''Add the staff in queryset, every staff member when not given, with
+        three queries however many there are. Records are keyed by primary
+        key.'''
+        queryset = queryset if queryset is not None else StaffMember.all_objects.all()
+        staff_ids = queryset.values('pk')
+        emails = defaultdict(list)
+        for staff_member, address in (EmailAddress.objects.filter(staff_member__in=staff_ids)
+                                                          .values_list('staff_member', 'address').iterator()):
+            emails[staff_member].append(address)
+        phones = defaultdict(list)
+        for staff_member, value in (StaffPhoneNumber.objects.filter(staff_member__in=staff_ids)
+                                                            .values_list('staff_member', 'value').iterator()):
+            phones[staff_member].append(value)
+        for staff in queryset.only('title', 'prefered_given_name', 'legal_given_name', 'prefered_surname',
+                                   'legal_surname', 'dob', 'employee_number').iterator():
+            self.add(StaffRecord.from_staff(staff.pk, '{} ({})'.format(staff.display_name, staff.employee_number),
+                                            staff, emails[staff.pk], phones[staff.pk]))
+        return self
+
+    def candidates(self, keys):
+        '''The record keys sharing a block with any of keys, a set of blocking
+        keys, skipping blocks larger than max_block_size'''
+        found = set()
+        for key in keys:
+            block = self.blocks.get(key, ())
+            if len(block) <= self.max_block_size:
+                found.update(block)
+        return found
+
+    def matches(self):
+        '''Every pair of added records scoring at least min_score, best first'''
+        pairs = set()
+        for block in self.blocks.values():
+            if len(block) <= self.max_block_size:
+                pairs.update(combinations(sorted(block), 2))
+        return self._scored((self.records[a], self.records[b]) for a, b in pairs)
+
+    def matches_for(self, record):
+        '''Added records scoring at least min_score against record, which need
+        not have been added itself, best first'''
+        keys = self.candidates(record.blocking_keys()) - set([record.key])
+        return self._scored((record, self.records[key]) for key in keys)
+
+    def _scored(self, pairs):
+        matches = []
+        for a, b in pairs:
+            total, reasons = score(a, b)
+            if total >= self.min_score:
+                matches.append(Match(a, b, total, reasons))
+        return sorted(matches, key=lambda m: (-m.score, '{}'.format(m.first.key), '{}'.format(m.second.key)))
+
+
+def find_duplicates(queryset=None, min_score=MIN_SCORE):
+    '''Matches between staff in queryset, every staff member when not given'''
+    return DuplicateFinder(min_score=min_score).load(queryset).matches()
+
+
+def merge_staff(keep, duplicates, user=None):
+    '''Move the contacts, next of kin, qualifications, keys, inservice
+    attendance, reminders and supervised staff of duplicates onto keep, then
+    deactivate the duplicates. keep's primary contacts stay primary and
+    attendance keep already has is dropped. Returns the number of rows moved.'''
+    keep = keep if isinstance(keep, StaffMember) else StaffMember.all_objects.get(pk=keep)
+    duplicate_ids = [pk for pk in set(getattr(d, 'pk', d) for d in duplicates) if pk != keep.pk]
+    if not duplicate_ids:
+        return 0
+    moved = 0
+    with transaction.atomic():
+        for model in (Address, StaffPhoneNumber, EmailAddress):
+            rows = model.objects.filter(staff_member__in=duplicate_ids)
+            primary = list(rows.filter(primary=True).order_by('pk').values_list('pk', flat=True))
+            if model.objects.filter(staff_member=keep, primary=True).exists():
+                demoted = primary
+            else:
+                demoted = primary[1:]
+            model.objects.filter(pk__in=demoted).update(primary=False)
+            moved += rows.update(staff_member=keep)
+        # next of kin priorities are unique per staff member, so follow keep's
+        priority = NextOfKin.objects.filter(staff_member=keep).aggregate(top=Max('priority'))['top'] or 0
+        next_of_kin = (NextOfKin.objects.filter(staff_member__in=duplicate_ids)
+                                        .order_by('staff_member', 'priority')
+                                        .values_list('pk', flat=True))
+        for pk in next_of_kin:
+            priority += 1
+            moved += NextOfKin.objects.filter(pk=pk).update(staff_member=keep, priority=priority)
+        for model in (Qualification, LegacyInserviceRecord):
+            moved += model.objects.filter(staff_member__in=duplicate_ids).update(staff_member=keep)
+        moved += DoorKey.objects.filter(owner__in=duplicate_ids).update(owner=keep)
+        moved += merge_rows(ExpiryNotification, keep, duplicate_ids, ('kind', 'expiry', 'days'))
+        moved += merge_attendance(keep, duplicate_ids)
+        StaffMember.all_objects.filter(pk=keep.pk, supervisor__in=duplicate_ids).update(supervisor=None)
+        moved += StaffMember.all_objects.filter(supervisor__in=duplicate_ids).update(supervisor=keep)
+        StaffMember.all_objects.filter(pk__in=duplicate_ids).deactivate(
+            user=user, comment='Merged into {} ({}).'.format(keep.display_name, keep.employee_number))
+        versioned = [keep]
+        for model in (Address, StaffPhoneNumber, EmailAddress, NextOfKin, Qualification):
+            versioned.extend(model.objects.filter(staff_member=keep))
+        reversion.default_revision_manager.save_revision(versioned, user=user,
+                                                         comment='Merged duplicate staff records.')
+        index_staff(StaffMember.all_objects.filter(pk__in=[keep.pk] + duplicate_ids))
+        # the duplicates' deactivation is recorded by deactivate
+        StaffChange.objects.record(StaffMember, [keep.pk] + duplicate_ids)
+    staff_changed.send(sender=StaffMember, staff_ids=[keep.pk] + duplicate_ids)
+    return moved
+
+
+def merge_rows(model, keep, duplicate_ids, fields):
+    '''Move duplicates' rows of model onto keep, deleting those that would
+    repeat fields of a row keep already has'''
+    seen = set(model.objects.filter(staff_member=keep).values_list(*fields))
+    moving, clashing = [], []
+    for row in model.objects.filter(staff_member__in=duplicate_ids).order_by('pk').values_list('pk', *fields):
+        if row[1:] in seen:
+            clashing.append(row[0])
+        else:
+            seen.add(row[1:])
+            moving.append(row[0])
+    for start in range(0, len(clashing), BULK_BATCH_SIZE):
+        model.objects.filter(pk__in=clashing[start:start + BULK_BATCH_SIZE]).delete()
+    moved = 0
+    for start in range(0, len(moving), BULK_BATCH_SIZE):
+        moved += model.objects.filter(pk__in=moving[start:start + BULK_BATCH_SIZE]).update(staff_member=keep)
+    return moved
+
+
+def merge_attendance(keep, duplicate_ids):
+    '''Move duplicates' inservice attendance onto keep, dropping sessions keep
+    attended, and move their inservice hours with it'''
+    records = dict((pk, (session, staff_member)) for pk, session, staff_member in
+                   InserviceRecord.objects.filter(staff_member__in=duplicate_ids)
+                                          .values_list('pk', 'session', 'staff_member'))
+    if not records:
+        return 0
+    moved = merge_rows(InserviceRecord, keep, duplicate_ids, ('session',))
+    # clashing records were deleted through the models, which took out their
+    # hours, but updates send no signals so move the hours of the rest here
+    moved_pks = InserviceRecord.objects.filter(pk__in=list(records), staff_member=keep).values_list('pk', flat=True)
+    removed = [records[pk] for pk in moved_pks]
+    move_attendance_hours(removed=removed, added=[(session, keep.pk) for session, _ in removed])
+    return moved
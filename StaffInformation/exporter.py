@@ -0,0 +1,224 @@
+'''Streaming export of staff members and their related records as CSV or JSON.
+
+Staff are read in keyset ordered batches with the related records for each
+batch prefetched, so memory use and the number of queries per batch stay the
+same however many staff are exported.
+'''
+from __future__ import unicode_literals
+
+import csv
+import json
+from datetime import date
+
+from django.db.models import Q
+from django.utils import six
+from django.utils.encoding import force_text
+
+from models import StaffMember, BULK_BATCH_SIZE
+
+
+class ExportError(ValueError):
+    pass
+
+
+def _address(a):
+    return '{} {}, {} {} {} {}'.format(a.number, a.street, a.suburb, a.city, a.state, a.postcode)
+
+
+def _phone(p):
+    return '{}: {}'.format(p.label or p.get_rel_display(), p.value)
+
+
+def _next_of_kin(n):
+    phones = ', '.join(str(p.value) for p in n.phone_numbers.all())
+    return '{} {} {} ({}){}'.format(n.title, n.given_name, n.surname, n.relationship,
+                                    ' {}'.format(phones) if phones else '')
+
+
+def _qualification(q):
+    return '{}, {} ({})'.format(q.label, q.institution, q.date_awarded)
+
+
+def _key(k):
+    # kind is stored as text, which get_kind_display cannot match to KEY_TYPES
+    from KeyRegistry.audit import kind_label
+    return '{}{}{}'.format(kind_label(k.kind), k.number, ' (lost)' if k.is_lost else '')
+
+
+def _inservice_record(r):
+    return '{} {} ({} min)'.format(r.date, r.title, r.duration)
+
+
+# Related columns, mapped to the extra relations they need prefetched and a
+# function rendering one related object as text for CSV output
+RELATED_COLUMNS = {'addresses': ([], _address),
+                   'phone_numbers': ([], _phone),
+                   'email_addresses': ([], lambda e: e.address),
+                   'next_of_kin': (['next_of_kin__phone_numbers'], _next_of_kin),
+                   'qualifications': ([], _qualification),
+                   'keys': ([], _key),
+                   'inservice_records': (['inservice_records__session__standards'], _inservice_record)}
+
+COMPUTED_COLUMNS = {'display_name': lambda s: s.display_name,
+                    'valid_bluecard': lambda s: s.valid_bluecard,
+                    'age': lambda s: s.age.years}
+
+# foreign keys are exported as the related primary key, supervisor_id
+FIELD_COLUMNS = [f.attname for f in StaffMember._meta.fields]
+
+DEFAULT_COLUMNS = ['employee_number', 'title', 'legal_given_name', 'legal_surname', 'display_name',
+                   'timetable_code', 'bluecard_number', 'bluecard_expiry', 'teacher_registration_number',
+                   'teacher_registration_expiry', 'email_addresses', 'phone_numbers']
+
+ORDERING = ('legal_surname', 'legal_given_name', 'pk')
+
+
+def staff_queryset(active='active', bluecard_expires_within=None, bluecard_expired=False,
+                   registration_expires_within=None):
+    '''Staff members matching the export filters, active is one of active,
+    inactive or all'''
+    if active == 'active':
+        queryset = StaffMember.objects.all()
+    elif active == 'inactive':
+        queryset = StaffMember.all_objects.filter(active=False)
+    elif active == 'all':
+        queryset = StaffMember.all_objects.all()
+    else:
+        raise ExportError('active must be one of active, inactive or all.')
+    if bluecard_expires_within is not None:
+        queryset = queryset.bluecard_expiring(int(bluecard_expires_within))
+    if bluecard_expired:
+        queryset = queryset.bluecard_expired()
+    if registration_expires_within is not None:
+        queryset = queryset.registration_expiring(int(registration_expires_within))
+    return queryset
+
+
+def keyset_batches(queryset, ordering=ORDERING, batch_size=BULK_BATCH_SIZE):
+    '''Yield lists of objects from queryset in ordering, each batch is fetched by
+    filtering past the last row of the previous batch rather than with OFFSET'''
+    queryset = queryset.order_by(*ordering)
+    last = None
+    while True:
+        batch = queryset
+        if last is not None:
+            batch = batch.filter(keyset_after(ordering, [getattr(last, f) for f in ordering]))
+        batch = list(batch[:batch_size])
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        last = batch[-1]
+
+
+def keyset_after(ordering, values):
+    '''A Q object matching rows that sort after values in ascending ordering'''
+    condition = Q()
+    for index, (field, value) in enumerate(zip(ordering, values)):
+        step = Q(**{field + '__gt': value})
+        for previous, previous_value in zip(ordering[:index], values[:index]):
+            step &= Q(**{previous: previous_value})
+        condition |= step
+    return condition
+
+
+class StaffExporter(object):
+    def __init__(self, columns=None, batch_size=BULK_BATCH_SIZE, **filters):
+        self.columns = list(columns or DEFAULT_COLUMNS)
+        for column in self.columns:
+            if column not in FIELD_COLUMNS and column not in RELATED_COLUMNS and column not in COMPUTED_COLUMNS:
+                raise ExportError('Unknown column {}.'.format(column))
+        self.batch_size = batch_size
+        self.queryset = staff_queryset(**filters)
+
+    def prefetch(self):
+        relations = []
+        for column in self.columns:
+            if column in RELATED_COLUMNS:
+                relations.append(column)
+                relations.extend(RELATED_COLUMNS[column][0])
+        return relations
+
+    def staff(self):
+        '''Yield the exported staff members one batch at a time'''
+        queryset = self.queryset.prefetch_related(*self.prefetch())
+        for batch in keyset_batches(queryset, batch_size=self.batch_size):
+            for staff in batch:
+                yield staff
+
+    def value(self, staff, column):
+        if column in COMPUTED_COLUMNS:
+            return COMPUTED_COLUMNS[column](staff)
+        return getattr(staff, column)
+
+    def csv(self):
+        '''Yield CSV lines, related records are rendered as text joined by "; "'''
+        writer = csv.writer(Echo())
+        yield writer.writerow([_csv_value(c) for c in self.columns])
+        for staff in self.staff():
+            row = []
+            for column in self.columns:
+                if column in RELATED_COLUMNS:
+                    render = RELATED_COLUMNS[column][1]
+                    row.append('; '.join(render(r) for r in getattr(staff, column).all()))
+                else:
+                    row.append(self.value(staff, column))
+            yield writer.writerow([_csv_value(v) for v in row])
+
+    def json(self):
+        '''Yield a JSON list of staff members with related records nested as lists'''
+        yield '['
+        separator = '\n'
+        for staff in self.staff():
+            record = {}
+            for column in self.columns:
+                if column in RELATED_COLUMNS:
+                    record[column] = [related_dict(r) for r in getattr(staff, column).all()]
+                else:
+                    record[column] = _json_value(self.value(staff, column))
+            yield separator + json.dumps(record, sort_keys=True)
+            separator = ',\n'
+        yield '\n]\n'
+
+
+class Echo(object):
+    '''File like object that returns what is written, lets csv.writer produce
+    lines for a generator'''
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    value = '' if value is None else force_text(value)
+    return value.encode('utf-8') if six.PY2 else value
+
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def related_dict(obj):
+    '''Field values of a related object, excluding its primary and foreign keys'''
+    record = {}
+    for field in obj._meta.fields:
+        if field.primary_key or field.rel:
+            continue
+        if field.choices:
+            record[field.name] = force_text(getattr(obj, 'get_{}_display'.format(field.name))())
+        else:
+            record[field.name] = _json_value(getattr(obj, field.attname))
+    for field in obj._meta.many_to_many:
+        record[field.name] = [o.pk for o in getattr(obj, field.name).all()]
+    if hasattr(obj, 'phone_numbers'):
+        record['phone_numbers'] = [related_dict(p) for p in obj.phone_numbers.all()]
+    if hasattr(obj, 'session'):
+        # inservice attendance, with the details of the session attended
+        record.update(related_dict(obj.session))
+    return record
+
+
+FORMATS = {'csv': ('text/csv', StaffExporter.csv),
+           'json': ('application/json', StaffExporter.json)}
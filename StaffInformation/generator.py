@@ -0,0 +1,208 @@
+'''Generates synthetic staff populations for development and benchmarking.
+
+Staff are built as import records and written with StaffImporter, so they get
+the same revisions and search terms as imported staff. Keys and inservice
+attendance are then added with bulk inserts. A given seed always generates the
+same population.
+'''
+from __future__ import unicode_literals
+
+import random
+from datetime import date, timedelta
+
+from django.db import transaction
+from django.db.models import Max
+
+from importer import StaffImporter, filter_in
+from models import StaffMember, StaffChange, BULK_BATCH_SIZE, staff_changed
+from InserviceTracker.models import InserviceSession, InserviceStandard
+from KeyRegistry.models import DoorKey, KEY_TYPES
+
+
+GIVEN_NAMES = ['Olivia', 'Charlotte', 'Amelia', 'Isla', 'Mia', 'Ava', 'Grace', 'Chloe', 'Emily', 'Sophie',
+               'Ruby', 'Zoe', 'Hannah', 'Jessica', 'Sarah', 'Rebecca', 'Megan', 'Kate', 'Leanne', 'Michelle',
+               'Oliver', 'William', 'Jack', 'Noah', 'Thomas', 'James', 'Lucas', 'Henry', 'Ethan', 'Samuel',
+               'Daniel', 'Matthew', 'Andrew', 'Peter', 'David', 'Michael', 'Benjamin', 'Joshua', 'Luke', 'Ryan']
+SURNAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Johnson', 'White', 'Martin', 'Anderson',
+            'Thompson', 'Nguyen', 'Thomas', 'Walker', 'Harris', 'Lee', 'Ryan', 'Robinson', 'Kelly', 'King',
+            'Davis', 'Wright', 'Evans', 'Roberts', 'Green', 'Hall', 'Wood', 'Jackson', 'Clarke', 'Patel',
+            'Khan', 'Lewis', 'James', 'Phillips', 'Mitchell', "O'Brien", 'Murphy', 'Campbell', 'Kennedy', 'Walsh']
+RELIGIONS = ['Catholic', 'Anglican', 'Uniting', 'Presbyterian', 'Lutheran', 'Baptist', 'Orthodox', 'None']
+STREETS = ['Main Street', 'Queen Street', 'George Street', 'Church Street', 'Station Road', 'Park Road',
+           'Hill Street', 'Railway Terrace', 'Victoria Avenue', 'Beach Road', 'Gympie Road', 'Boundary Street']
+# (suburb, city, state, postcode)
+SUBURBS = [('Toowong', 'Brisbane', 'QLD', 4066), ('Indooroopilly', 'Brisbane', 'QLD', 4068),
+           ('Chermside', 'Brisbane', 'QLD', 4032), ('Carindale', 'Brisbane', 'QLD', 4152),
+           ('Southport', 'Gold Coast', 'QLD', 4215), ('Maroochydore', 'Sunshine Coast', 'QLD', 4558),
+           ('Ipswich', 'Ipswich', 'QLD', 4305), ('Toowoomba', 'Toowoomba', 'QLD', 4350),
+           ('Tweed Heads', 'Tweed Heads', 'NSW', 2485), ('Parramatta', 'Sydney', 'NSW', 2150)]
+RELATIONSHIPS = ['Spouse', 'Partner', 'Mother', 'Father', 'Sister', 'Brother', 'Daughter', 'Son', 'Friend']
+QUALIFICATIONS = ['Bachelor of Education', 'Bachelor of Arts', 'Bachelor of Science', 'Graduate Diploma of Education',
+                  'Master of Education', 'Master of Teaching', 'Certificate IV in Training and Assessment',
+                  'Diploma of Early Childhood Education', 'Senior First Aid Certificate']
+INSTITUTIONS = ['Queensland University of Technology', 'University of Queensland', 'Griffith University',
+                'Australian Catholic University', 'University of the Sunshine Coast', 'James Cook University',
+                'TAFE Queensland']
+INSERVICE_TITLES = ['Child Protection', 'Senior First Aid', 'CPR Refresher', 'Workplace Health and Safety',
+                    'Differentiated Learning', 'Student Wellbeing', 'Curriculum Planning', 'Anaphylaxis Management',
+                    'Code of Conduct', 'Assessment and Moderation', 'ICT in the Classroom', 'Fire Warden Training']
+INSERVICE_STANDARDS = ['Professional Knowledge', 'Professional Practice', 'Professional Engagement',
+                       'Workplace Health and Safety', 'Child Protection']
+PRESENTERS = ['Regional Office', 'Brisbane Catholic Education', 'St John Ambulance', 'Queensland College of Teachers',
+              'Leadership Team']
+VENUES = ['Library', 'Staff Room', 'Hall', 'Regional Office']
+DURATIONS = [30, 60, 60, 90, 120, 180, 360]
+
+
+class StaffGenerator(object):
+    '''Build and insert synthetic staff, their keys and inservice attendance.
+
+    Around teacher_ratio of the staff are teachers with a timetable code,
+    registration and qualifications, the rest are support staff.'''
+    def __init__(self, seed=0, today=None, teacher_ratio=0.6, chunk_size=BULK_BATCH_SIZE):
+        self.random = random.Random(seed)
+        self.today = today or date.today()
+        self.teacher_ratio = teacher_ratio
+        self.chunk_size = chunk_size
+
+    def days(self, low, high):
+        return self.today + timedelta(days=self.random.randint(low, high))
+
+    def chance(self, p):
+        return self.random.random() < p
+
+    def record(self, n):
+        '''An import record for the nth generated staff member, n must not have
+        been used before as it makes the unique identifiers'''
+        r = self.random
+        given, surname = r.choice(GIVEN_NAMES), r.choice(SURNAMES)
+        teacher = self.chance(self.teacher_ratio)
+        part_time = self.chance(0.2)
+        days_worked = sorted(r.sample(range(5), r.randint(2, 4))) if part_time else range(5)
+        record = {'title': r.choice(['Ms', 'Mrs', 'Miss', 'Mr', 'Dr']),
+                  'legal_given_name': given,
+                  'prefered_given_name': given[:3] if self.chance(0.1) else None,
+                  'middle_name': r.choice(GIVEN_NAMES) if self.chance(0.5) else None,
+                  'legal_surname': surname,
+                  'dob': self.days(-65 * 365, -21 * 365),
+                  'religion': r.choice(RELIGIONS) if self.chance(0.6) else None,
+                  'employee_number': 'S{:06d}'.format(n),
+                  'bluecard_number': '{:07d}/{}'.format(n, r.randint(1, 9)),
+                  'bluecard_expiry': self.days(-90, 3 * 365),
+                  'vehicle_registration': '{:03d}{}'.format(r.randint(0, 999), ''.join(
+                      r.choice('ABCDEFGHJKLMNPRSTUVWXYZ') for _ in range(3))) if self.chance(0.7) else None,
+                  'media_consent_form': self.chance(0.8),
+                  'weekly_hours_worked': len(days_worked) * 7 if part_time else 38}
+        for day, name in enumerate(['monday', 'tuesday', 'wednesday', 'thursday', 'friday']):
+            record['works_' + name] = day in days_worked
+        if teacher:
+            record.update(timetable_code='{}{}{}'.format(given[0], surname[0], n).upper(),
+                          teacher_registration_number=100000 + n,
+                          teacher_registration_expiry=self.days(-60, 5 * 365) if self.chance(0.95) else None)
+        email_name = '{}.{}{}'.format(given, surname, n).lower().replace("'", '')
+        record['email_addresses'] = [{'address': email_name + '@school.example.edu.au', 'label': 'Work',
+                                      'rel': 2, 'primary': True}]
+        if self.chance(0.5):
+            record['email_addresses'].append({'address': email_name + '@example.com', 'label': 'Personal',
+                                              'rel': 1, 'primary': False})
+        record['phone_numbers'] = [{'rel': r.choice([7, 7, 6, 14]), 'label': r.choice([None, 'Mobile', 'Home']),
+                                    'value': r.randint(400000000, 499999999), 'primary': index == 0}
+                                   for index in range(r.randint(1, 3))]
+        record['addresses'] = [self.address(index) for index in range(1 if self.chance(0.8) else 2)]
+        record['next_of_kin'] = [{'title': r.choice(['Ms', 'Mrs', 'Mr']), 'given_name': r.choice(GIVEN_NAMES),
+                                  'surname': r.choice([surname, r.choice(SURNAMES)]),
+                                  'relationship': r.choice(RELATIONSHIPS), 'priority': priority,
+                                  'phone_numbers': [{'rel': 7, 'value': r.randint(400000000, 499999999),
+                                                     'primary': True}]}
+                                 for priority in range(1, r.randint(1, 2) + 1)]
+        record['qualifications'] = [{'label': r.choice(QUALIFICATIONS), 'institution': r.choice(INSTITUTIONS),
+                                     'date_awarded': self.days(-30 * 365, -30)}
+                                    for _ in range(r.randint(1, 3) if teacher else r.randint(0, 1))]
+        return record
+
+    def address(self, index):
+        suburb, city, state, postcode = self.random.choice(SUBURBS)
+        postal = index > 0
+        return {'rel': 1, 'label': 'Postal' if postal else 'Home', 'primary': index == 0, 'postal': postal,
+                'pobox': postal and self.chance(0.5), 'number': '{}{}'.format(self.random.randint(1, 300),
+                                                                               self.random.choice(['', '', 'A'])),
+                'street': self.random.choice(STREETS), 'suburb': suburb, 'city': city, 'state': state,
+                'postcode': postcode}
+
+    def staff(self, count):
+        '''Import count new staff members, returns the ImportResult and the new
+        staff members' primary keys'''
+        start = StaffMember.all_objects.count() + 1
+        employee_numbers = {}
+
+        def records():
+            for n in range(start, start + count):
+                record = self.record(n)
+                employee_numbers[n] = record['employee_number']
+                yield n, record
+        importer = StaffImporter(chunk_size=self.chunk_size, comment='Generated staff.', check_duplicates=False)
+        result = importer.run(records())
+        for error in result.errors:
+            employee_numbers.pop(error.line, None)
+        pks = [pk for pk, in filter_in(StaffMember.all_objects.values_list('pk'), 'employee_number',
+                                       employee_numbers.values())]
+        return result, pks
+
+    def keys(self, staff_ids, per_staff):
+        '''Issue each staff member around per_staff keys numbered after the
+        existing keys of each kind, a few of them lost. Returns the number of
+        keys created.'''
+        kinds = ['{}'.format(kind) for kind, _ in KEY_TYPES]
+        numbers = dict((kind, DoorKey.objects.filter(kind=kind).aggregate(n=Max('number'))['n'] or 0)
+                       for kind in kinds)
+        keys = []
+        for pk in staff_ids:
+            for _ in range(self.random.randint(0, 2 * per_staff)):
+                kind = self.random.choice(kinds)
+                numbers[kind] += 1
+                keys.append(DoorKey(owner_id=pk, kind=kind, number=numbers[kind],
+                                    last_sighted=self.days(-2 * 365, 0) if self.chance(0.9) else None,
+                                    is_lost=self.chance(0.05)))
+        owners = list(set(k.owner_id for k in keys))
+        with transaction.atomic():
+            DoorKey.objects.bulk_create(keys, batch_size=BULK_BATCH_SIZE)
+            # bulk_create sends no post_save
+            StaffChange.objects.record(DoorKey, owners, 'created')
+        if keys:
+            staff_changed.send(sender=DoorKey, staff_ids=owners)
+        return len(keys)
+
+    def standards(self):
+        '''The inservice standards, INSERVICE_STANDARDS are created when there are none'''
+        standards = list(InserviceStandard.objects.all())
+        if not standards:
+            standards = [InserviceStandard.objects.create(number=number, label=label)
+                         for number, label in enumerate(INSERVICE_STANDARDS, 1)]
+        return standards
+
+    def sessions(self, staff_ids, count):
+        '''Create count inservice sessions over the last three years, each
+        attended by a random share of staff_ids. Returns the number of
+        attendance records created.'''
+        standards = self.standards()
+        attended = 0
+        for _ in range(count):
+            session = InserviceSession.objects.create(date=self.days(-3 * 365, 0),
+                                                      duration=self.random.choice(DURATIONS),
+                                                      presenter=self.random.choice(PRESENTERS),
+                                                      title=self.random.choice(INSERVICE_TITLES),
+                                                      venue=self.random.choice(VENUES))
+            session.standards.add(*self.random.sample(standards, min(len(standards), self.random.randint(1, 2))))
+            share = self.random.uniform(0.05, 0.5)
+            attended += session.mark_attendance(self.random.sample(staff_ids, int(len(staff_ids) * share)))
+        return attended
+
+    def generate(self, count, keys_per_staff=2, sessions=20):
+        '''Generate count staff with keys and inservice attendance, returns a dict
+        of the numbers created and the import errors'''
+        result, staff_ids = self.staff(count)
+        return {'staff': len(staff_ids),
+                'keys': self.keys(staff_ids, keys_per_staff),
+                'sessions': sessions if staff_ids else 0,
+                'attendance': self.sessions(staff_ids, sessions) if staff_ids else 0,
+                'errors': result.errors}
@@ -0,0 +1,149 @@
+'''Keeps the reversion history from growing without bound.
+
+Versions identical to the object's previous version are left out of new
+revisions, unless that would leave the revision empty, so the history still
+records a save that changed nothing versioned. Set REVERSION_SKIP_UNCHANGED to
+False to keep every version.
+
+compact_history thins old versions with a RetentionPolicy: every version from
+the last keep_all_days days is kept, then the last version of each object on
+each day until keep_daily_days, then the last version of each object in each
+month. The latest version of every object is always kept, so objects can still
+be reverted and recovered. Revisions left without versions are deleted.
+'''
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Max
+from django.dispatch import receiver
+from django.utils import timezone
+from reversion.models import Revision, Version, pre_revision_commit
+
+from models import BULK_BATCH_SIZE
+
+
+class RetentionPolicy(object):
+    def __init__(self, keep_all_days=90, keep_daily_days=365):
+        if keep_all_days < 0 or keep_daily_days < keep_all_days:
+            raise ValueError('keep_daily_days must be at least keep_all_days, which must not be negative.')
+        self.keep_all_days = keep_all_days
+        self.keep_daily_days = keep_daily_days
+
+    @classmethod
+    def from_settings(cls):
+        '''The policy set by the REVERSION_RETENTION setting, a dict of keyword
+        arguments'''
+        return cls(**getattr(settings, 'REVERSION_RETENTION', {}))
+
+    def bucket(self, created, today):
+        '''The period a version created at created is kept for, only the last
+        version of an object in each period is kept. None when every version is
+        kept.'''
+        day = timezone.localtime(created).date() if timezone.is_aware(created) else created.date()
+        age = (today - day).days
+        if age < self.keep_all_days:
+            return None
+        if age < self.keep_daily_days:
+            return day
+        return (day.year, day.month)
+
+
+def compact_history(policy=None, today=None, batch_size=BULK_BATCH_SIZE, dry_run=False):
+    '''Delete the versions policy does not keep, reading and deleting batch_size
+    versions at a time. Holds the last version seen of each object, not every
+    version. Returns the number of versions and revisions deleted.'''
+    policy = policy or RetentionPolicy.from_settings()
+    today = today or date.today()
+    # (content type, object id) to the (bucket, pk, revision) of its last version
+    # seen, versions are read in pk order which is the order they were saved
+    last = {}
+    doomed = []
+    counts = {'versions': 0, 'revisions': 0}
+    last_pk = 0
+    while True:
+        batch = list(Version.objects.filter(pk__gt=last_pk)
+                                    .order_by('pk')
+                                    .values_list('pk', 'content_type', 'object_id', 'revision',
+                                                 'revision__date_created')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        for pk, content_type, object_id, revision, created in batch:
+            bucket = policy.bucket(created, today)
+            key = (content_type, object_id)
+            previous = last.get(key)
+            if bucket is not None and previous is not None and previous[0] == bucket:
+                doomed.append(previous[1:])
+            last[key] = (bucket, pk, revision)
+        if len(doomed) >= batch_size:
+            delete_versions(doomed, counts, dry_run)
+            doomed = []
+    delete_versions(doomed, counts, dry_run)
+    return counts
+
+
+def delete_versions(versions, counts, dry_run=False):
+    '''Delete (pk, revision) versions and any of their revisions left empty'''
+    if not versions:
+        return
+    pks = [pk for pk, _ in versions]
+    revisions = list(set(revision for _, revision in versions))
+    counts['versions'] += len(pks)
+    if dry_run:
+        # revisions that would be emptied are not counted
+        return
+    with transaction.atomic():
+        for start in range(0, len(pks), BULK_BATCH_SIZE):
+            Version.objects.filter(pk__in=pks[start:start + BULK_BATCH_SIZE]).delete()
+        for start in range(0, len(revisions), BULK_BATCH_SIZE):
+            empty = list(Revision.objects.filter(pk__in=revisions[start:start + BULK_BATCH_SIZE],
+                                                 version__isnull=True)
+                                         .values_list('pk', flat=True))
+            Revision.objects.filter(pk__in=empty).delete()
+            counts['revisions'] += len(empty)
+
+
+def latest_serialized_data(versions, using=None):
+    '''The serialized data of the latest saved version of the object of each
+    of versions, by (content type id, object id), read from the database
+    using'''
+    by_content_type = defaultdict(list)
+    for version in versions:
+        by_content_type[version.content_type_id].append(version)
+    latest = {}
+    for content_type, content_versions in by_content_type.items():
+        # object_id_int is indexed, object_id is not
+        if all(v.object_id_int is not None for v in content_versions):
+            field, ids = 'object_id_int', list(set(v.object_id_int for v in content_versions))
+        else:
+            field, ids = 'object_id', list(set(v.object_id for v in content_versions))
+        for start in range(0, len(ids), BULK_BATCH_SIZE):
+            pks = (Version.objects.using(using)
+                                  .filter(content_type=content_type,
+                                          **{field + '__in': ids[start:start + BULK_BATCH_SIZE]})
+                                  .values(field)
+                                  .annotate(latest=Max('pk'))
+                                  .values_list('latest', flat=True))
+            for object_id, data in (Version.objects.using(using)
+                                                   .filter(pk__in=list(pks))
+                                                   .values_list('object_id', 'serialized_data')):
+                latest[(content_type, object_id)] = data
+    return latest
+
+
+@receiver(pre_revision_commit)
+def skip_unchanged_versions(sender, instances, revision, versions, **kwargs):
+    '''Leave out versions identical to the latest saved version of the same
+    object, save_revision saves the versions list it sent'''
+    if not getattr(settings, 'REVERSION_SKIP_UNCHANGED', True) or not versions:
+        return
+    # the signal does not say which database the revision is saved to, read
+    # where versions are written rather than from a replica that may lag
+    latest = latest_serialized_data(versions, using=router.db_for_write(Version))
+    changed = [v for v in versions if latest.get((v.content_type_id, v.object_id)) != v.serialized_data]
+    if changed and len(changed) < len(versions):
+        versions[:] = changed
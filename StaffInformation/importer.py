@@ -0,0 +1,401 @@
+'''Bulk loading of staff members and their related records from CSV or JSON.
+
+Records are nested dictionaries, one per staff member, holding StaffMember
+field values plus lists of related records under the keys in NESTED_MODELS.
+Next of kin records may in turn hold a list of phone_numbers. CSV files
+flatten the nesting into dotted column names such as addresses.0.street or
+next_of_kin.1.phone_numbers.0.value, JSON files hold either a list of records
+or one record per line. Lists are decoded a record at a time as the file is
+read, so large files of either kind are never held in memory.
+
+Records are validated and inserted in chunks, each chunk is written with
+bulk_create inside a single transaction and versioned as a single revision.
+Records that look like a staff member already in the database or earlier in
+the import, by the scoring in StaffInformation.duplicates, are rejected unless
+check_duplicates is turned off.
+'''
+import csv
+import json
+from collections import namedtuple
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.encoding import force_text
+import reversion
+
+from models import (StaffMember,
+                    Address,
+                    StaffPhoneNumber,
+                    NOKPhoneNumber,
+                    NextOfKin,
+                    Qualification,
+                    EmailAddress,
+                    StaffChange,
+                    BULK_BATCH_SIZE)
+from duplicates import DuplicateFinder, StaffRecord, MIN_SCORE
+from search import index_staff
+
+
+NESTED_MODELS = [('addresses', Address),
+                 ('phone_numbers', StaffPhoneNumber),
+                 ('email_addresses', EmailAddress),
+                 ('next_of_kin', NextOfKin),
+                 ('qualifications', Qualification)]
+
+STAFF_UNIQUE_FIELDS = [f.name for f in StaffMember._meta.fields if f.unique and not f.primary_key]
+
+EXCLUDED_FIELDS = ('id', 'created', 'updated', 'staff_member', 'next_of_kin')
+
+RowError = namedtuple('RowError', ['line', 'field', 'message'])
+
+
+class ImportFileError(ValueError):
+    pass
+
+
+# Bytes read at a time from JSON arrays
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+def model_fields(model):
+    '''Names of the fields that may be supplied for a model in an import file'''
+    return set(f.name for f in model._meta.fields if f.name not in EXCLUDED_FIELDS)
+
+
+def unflatten(row):
+    '''Turn a flat mapping with dotted keys into nested dicts and lists, empty
+    values are dropped so unused column groups do not produce records'''
+    record = {}
+    for key, value in row.items():
+        if value is None or value == '':
+            continue
+        parts = key.split('.')
+        target = record
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = value
+    return _listify(record)
+
+
+def _listify(value):
+    '''Convert dicts keyed by indexes into lists ordered by index'''
+    if not isinstance(value, dict):
+        return value
+    if value and all(key.isdigit() for key in value):
+        return [_listify(value[key]) for key in sorted(value, key=int)]
+    return dict((key, _listify(item)) for key, item in value.items())
+
+
+def filter_in(queryset, field, values):
+    '''Yield the rows of queryset where field is in values, querying in batches
+    of BULK_BATCH_SIZE values'''
+    values = list(values)
+    for start in range(0, len(values), BULK_BATCH_SIZE):
+        for row in queryset.filter(**{field + '__in': values[start:start + BULK_BATCH_SIZE]}):
+            yield row
+
+
+def read_csv(fileobj):
+    '''Yield (line, record) pairs from a CSV file with a header row'''
+    reader = csv.reader(fileobj)
+    header = [force_text(column).strip() for column in next(reader)]
+    for row in reader:
+        yield reader.line_num, unflatten(dict(zip(header, [force_text(value) for value in row])))
+
+
+def read_json_array(fileobj, chunk_size=JSON_CHUNK_SIZE, offset=0):
+    '''Yield the items of a JSON array whose opening bracket has been read
+    from fileobj, decoding them one at a time from reads of chunk_size so the
+    array is never held in memory. Raises ImportFileError giving the offset in
+    the file, offset characters having been read before the array's items,
+    where the array is malformed.'''
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # what comes next: the first item or the end, a separator, or an item
+    expect = 'first'
+    while True:
+        stripped = buffer.lstrip()
+        offset += len(buffer) - len(stripped)
+        buffer = stripped
+        if buffer and expect == 'separator':
+            if buffer[0] not in ',]':
+                raise ImportFileError('Expected , or ] in JSON array at offset {}.'.format(offset))
+            if buffer[0] == ']':
+                return
+            buffer, expect, offset = buffer[1:], 'item', offset + 1
+            continue
+        if expect == 'first' and buffer[:1] == ']':
+            return
+        try:
+            # fails until the buffer holds the whole of the next item
+            record, end = decoder.raw_decode(buffer)
+        except ValueError:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                raise ImportFileError('Invalid or unterminated JSON array at offset {}.'.format(offset))
+            buffer += chunk
+            continue
+        buffer, expect, offset = buffer[end:], 'separator', offset + end
+        yield record
+
+
+def read_json(fileobj):
+    '''Yield (line, record) pairs from a JSON list of records or a file with one
+    JSON record per line. A line that is not valid JSON gives a RowError in
+    place of its record.'''
+    first = fileobj.read(1)
+    offset = 1
+    while first and first.isspace():
+        first = fileobj.read(1)
+        offset += 1
+    if first == '[':
+        for index, record in enumerate(read_json_array(fileobj, offset=offset), 1):
+            yield index, record
+        return
+    for line_num, line in enumerate(fileobj, 1):
+        if line_num == 1:
+            line = first + line
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = RowError(line_num, None, 'Invalid JSON: {}'.format(e))
+            yield line_num, record
+
+
+READERS = {'csv': read_csv, 'json': read_json, 'jsonl': read_json}
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.created = dict((model, 0) for model in (StaffMember, NOKPhoneNumber) + tuple(m for _, m in NESTED_MODELS))
+        self.errors = []
+        self.valid = 0
+
+    @property
+    def staff_created(self):
+        return self.created[StaffMember]
+
+
+class PendingStaff(object):
+    '''A validated staff member and its unsaved related records'''
+    def __init__(self, line, staff):
+        self.line = line
+        self.staff = staff
+        self.related = dict((name, []) for name, _ in NESTED_MODELS)
+        self.nok_phone_numbers = []
+        self.errors = []
+
+    def unique_value(self, field):
+        '''The value of a unique StaffMember field, None if it is unset or invalid'''
+        if self.staff is None or any(error.field == field for error in self.errors):
+            return None
+        return getattr(self.staff, field)
+
+
+class StaffImporter(object):
+    '''Validate and insert staff records in chunks.
+
+    With dry_run set every record is validated, including uniqueness checks
+    against the database, but nothing is written. Records with errors are
+    skipped and reported in the result. Records scoring at least
+    duplicate_score against an existing staff member or an earlier record are
+    errors when check_duplicates is set.'''
+    def __init__(self, chunk_size=BULK_BATCH_SIZE, dry_run=False, user=None, comment='Imported staff.',
+                 check_duplicates=True, duplicate_score=MIN_SCORE):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.user = user
+        self.comment = comment
+        self.check_duplicates = check_duplicates
+        self.duplicate_score = duplicate_score
+
+    def run(self, records):
+        '''Import an iterable of (line, record) pairs, returns an ImportResult'''
+        result = ImportResult()
+        seen = dict((field, set()) for field in STAFF_UNIQUE_FIELDS)
+        finder = DuplicateFinder(min_score=self.duplicate_score)
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, self.chunk_size))
+            if not chunk:
+                break
+            built = [self.build(line, record) for line, record in chunk]
+            for staff in built:
+                self.check_file_duplicates(staff, seen)
+            self.check_existing(built)
+            if self.check_duplicates:
+                self.check_similar(built, finder)
+            pending = []
+            for staff in built:
+                result.errors.extend(staff.errors)
+                if not staff.errors:
+                    pending.append(staff)
+            result.valid += len(pending)
+            if pending and not self.dry_run:
+                self.write(pending, result)
+        return result
+
+    def _instance(self, model, line, prefix, values, exclude=()):
+        errors = []
+        unknown = set(values) - model_fields(model)
+        for field in sorted(unknown):
+            errors.append(RowError(line, prefix + field, 'Unknown field.'))
+        instance = model(**dict((k, v) for k, v in values.items() if k not in unknown))
+        try:
+            instance.full_clean(exclude=list(exclude), validate_unique=False)
+        except ValidationError as e:
+            for field, messages in sorted(e.message_dict.items()):
+                for message in messages:
+                    errors.append(RowError(line, prefix + field, message))
+        return instance, errors
+
+    def build(self, line, record):
+        '''Build unsaved model instances for a record, problems are collected in the
+        errors of the returned PendingStaff'''
+        if isinstance(record, RowError):
+            # the reader could not parse the record
+            staff = PendingStaff(line, None)
+            staff.errors.append(record)
+            return staff
+        if not isinstance(record, dict):
+            staff = PendingStaff(line, None)
+            staff.errors.append(RowError(line, None, 'Record must be an object.'))
+            return staff
+        record = dict(record)
+        nested = dict((name, record.pop(name, None) or []) for name, _ in NESTED_MODELS)
+        instance, errors = self._instance(StaffMember, line, '', record)
+        staff = PendingStaff(line, instance)
+        staff.errors = errors
+        for name, model in NESTED_MODELS:
+            if not is_record_list(nested[name]):
+                errors.append(RowError(line, name, 'Must be a list of objects.'))
+                continue
+            for index, values in enumerate(nested[name]):
+                prefix = '{}.{}.'.format(name, index)
+                values = dict(values)
+                phone_numbers = (values.pop('phone_numbers', None) or []) if model is NextOfKin else []
+                related, related_errors = self._instance(model, line, prefix, values, exclude=['staff_member'])
+                errors.extend(related_errors)
+                staff.related[name].append(related)
+                if not is_record_list(phone_numbers):
+                    errors.append(RowError(line, prefix + 'phone_numbers', 'Must be a list of objects.'))
+                    continue
+                for phone_index, phone_values in enumerate(phone_numbers):
+                    phone, phone_errors = self._instance(NOKPhoneNumber, line,
+                                                         '{}phone_numbers.{}.'.format(prefix, phone_index),
+                                                         phone_values, exclude=['next_of_kin'])
+                    errors.extend(phone_errors)
+                    staff.nok_phone_numbers.append((related, phone))
+        priorities = [nok.priority for nok in staff.related['next_of_kin']]
+        if len(priorities) != len(set(priorities)):
+            errors.append(RowError(line, 'next_of_kin', 'Next of kin priorities must be unique.'))
+        resolve_primary(staff.related['addresses'])
+        resolve_primary(staff.related['phone_numbers'])
+        resolve_primary(staff.related['email_addresses'])
+        for nok in staff.related['next_of_kin']:
+            resolve_primary([phone for parent, phone in staff.nok_phone_numbers if parent is nok])
+        return staff
+
+    def check_file_duplicates(self, staff, seen):
+        '''Report unique values repeated within the import'''
+        for field in STAFF_UNIQUE_FIELDS:
+            value = staff.unique_value(field)
+            if value is None:
+                continue
+            if value in seen[field]:
+                staff.errors.append(RowError(staff.line, field, 'Duplicate value {} in import.'.format(value)))
+            seen[field].add(value)
+
+    def check_existing(self, built):
+        '''Report unique values that already exist, one query per unique field'''
+        for field in STAFF_UNIQUE_FIELDS:
+            checked = [p for p in built if p.unique_value(field) is not None]
+            existing = set(filter_in(StaffMember.all_objects.values_list(field, flat=True), field,
+                                     [p.unique_value(field) for p in checked]))
+            for p in checked:
+                if p.unique_value(field) in existing:
+                    p.errors.append(RowError(p.line, field, 'Staff with this {} already exists.'.format(
+                        StaffMember._meta.get_field(field).verbose_name)))
+
+    def check_similar(self, built, finder):
+        '''Report records that look like existing staff or earlier records.
+        Existing staff sharing a date of birth, email address or phone number
+        with the chunk are loaded into finder first, three queries per
+        BULK_BATCH_SIZE values.'''
+        checked = [p for p in built if p.staff is not None and not p.errors]
+        dobs = list(set(p.staff.dob for p in checked if p.staff.dob is not None))
+        emails = list(set(e.address for p in checked for e in p.related['email_addresses']))
+        phones = list(set(n.value for p in checked for n in p.related['phone_numbers']))
+        for start in range(0, len(dobs), BULK_BATCH_SIZE):
+            finder.load(StaffMember.all_objects.filter(dob__in=dobs[start:start + BULK_BATCH_SIZE]))
+        for start in range(0, len(emails), BULK_BATCH_SIZE):
+            owners = EmailAddress.objects.filter(address__in=emails[start:start + BULK_BATCH_SIZE])
+            finder.load(StaffMember.all_objects.filter(pk__in=owners.values('staff_member')))
+        for start in range(0, len(phones), BULK_BATCH_SIZE):
+            owners = StaffPhoneNumber.objects.filter(value__in=phones[start:start + BULK_BATCH_SIZE])
+            finder.load(StaffMember.all_objects.filter(pk__in=owners.values('staff_member')))
+        for p in checked:
+            record = StaffRecord.from_staff(('line', p.line), 'line {}'.format(p.line), p.staff,
+                                            [e.address for e in p.related['email_addresses']],
+                                            [n.value for n in p.related['phone_numbers']])
+            matches = finder.matches_for(record)
+            if matches:
+                best = matches[0]
+                p.errors.append(RowError(p.line, None, 'Possibly the same person as {}, scoring {:.2f} ({}).'.format(
+                    best.second.label, best.score, ', '.join(best.reasons))))
+            finder.add(record)
+
+    def write(self, pending, result):
+        '''Insert a chunk of validated staff and their related records'''
+        with transaction.atomic():
+            StaffMember.objects.bulk_create([p.staff for p in pending])
+            # bulk_create does not return primary keys, fetch them back by a unique field
+            staff = dict((s.employee_number, s) for s in filter_in(StaffMember.all_objects.all(), 'employee_number',
+                                                                    [p.staff.employee_number for p in pending]))
+            versioned = list(staff.values())
+            for name, model in NESTED_MODELS:
+                related = []
+                for p in pending:
+                    for instance in p.related[name]:
+                        instance.staff_member = staff[p.staff.employee_number]
+                        related.append(instance)
+                model.objects.bulk_create(related)
+                result.created[model] += len(related)
+            saved_nok = {}
+            for nok in filter_in(NextOfKin.objects.all(), 'staff_member', staff.values()):
+                saved_nok[(nok.staff_member_id, nok.priority)] = nok
+            phones = []
+            for p in pending:
+                for nok, phone in p.nok_phone_numbers:
+                    phone.next_of_kin = saved_nok[(nok.staff_member.pk, nok.priority)]
+                    phones.append(phone)
+            NOKPhoneNumber.objects.bulk_create(phones)
+            result.created[NOKPhoneNumber] += len(phones)
+            result.created[StaffMember] += len(versioned)
+            for _, model in NESTED_MODELS:
+                versioned.extend(filter_in(model.objects.all(), 'staff_member', staff.values()))
+            versioned.extend(filter_in(NOKPhoneNumber.objects.all(), 'next_of_kin', saved_nok.values()))
+            reversion.default_revision_manager.save_revision(versioned, user=self.user, comment=self.comment)
+            # bulk_create sends no signals, so index the new staff and record
+            # them in the change feed here
+            index_staff(staff.values())
+            StaffChange.objects.record(StaffMember, [s.pk for s in staff.values()], 'created')
+
+
+def is_record_list(value):
+    return isinstance(value, list) and all(isinstance(item, dict) for item in value)
+
+
+def resolve_primary(contacts):
+    '''Leave at most one contact marked primary, the last one wins as it would
+    if the contacts were saved one after another'''
+    primary = [c for c in contacts if c.primary]
+    for contact in contacts:
+        contact.primary = bool(primary) and contact is primary[-1]
+
+
+def import_staff(fileobj, format='csv', **kwargs):
+    '''Import staff from an open file, extra arguments are passed to StaffImporter'''
+    return StaffImporter(**kwargs).run(READERS[format](fileobj))
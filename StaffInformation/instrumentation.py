@@ -0,0 +1,228 @@
+'''Per request timing and query instrumentation.
+
+RequestInstrumentationMiddleware records each request's wall time, query
+count, SQL time, repeated queries and the time spent writing reversion
+revisions. Requests slower than the SLOW_REQUEST_MS setting are logged to the
+StaffInformation.instrumentation logger with their slowest and most repeated
+SQL, with placeholders rather than the parameters, which hold staff details.
+
+Queries are timed by a thin cursor wrapper that keeps the unformatted SQL and
+its parameters, so it costs two clock reads and an append per query. Totals
+per URL pattern are kept in memory and added to the cache named by the
+REQUEST_STATS_CACHE setting every STATS_FLUSH_SECONDS, so the stats of every
+process can be read with request_stats().
+'''
+from __future__ import unicode_literals
+
+import logging
+import threading
+from collections import Counter, defaultdict
+from time import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+from reversion.models import pre_revision_commit, post_revision_commit
+
+from counters import incr_counter
+
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'request_stats'
+INDEX_KEY = KEY_PREFIX + ':views'
+STAT_FIELDS = ('requests', 'ms', 'queries', 'sql_ms', 'duplicates', 'revisions', 'revision_ms', 'slow')
+STATS_FLUSH_SECONDS = 10
+# Number of queries and repeated statements written to the slow request log
+SLOW_LOG_QUERIES = 10
+
+_active = threading.local()
+
+
+def stats_cache():
+    return get_cache(getattr(settings, 'REQUEST_STATS_CACHE', 'default'))
+
+
+def _key(view_name, field):
+    return '{}:{}:{}'.format(KEY_PREFIX, view_name, field)
+
+
+class InstrumentedCursor(CursorWrapper):
+    '''Times every statement run through the wrapped cursor'''
+    def __init__(self, cursor, db, recorder):
+        super(InstrumentedCursor, self).__init__(cursor, db)
+        self.recorder = recorder
+
+    def execute(self, sql, params=None):
+        start = time()
+        try:
+            return super(InstrumentedCursor, self).execute(sql, params)
+        finally:
+            self.recorder.queries.append((sql, params, time() - start))
+
+    def executemany(self, sql, param_list):
+        start = time()
+        try:
+            return super(InstrumentedCursor, self).executemany(sql, param_list)
+        finally:
+            self.recorder.queries.append((sql, None, time() - start))
+
+
+class RequestRecorder(object):
+    '''The queries and revisions of one request'''
+    def __init__(self):
+        self.start = time()
+        self.queries = []
+        self.revisions = 0
+        self.revision_time = 0.0
+        self.revision_start = None
+        self.patched = []
+
+    def install(self):
+        '''Wrap the cursors of every database connection of this thread, on top of
+        any debug cursor so connection.queries and CaptureQueriesContext keep
+        working'''
+        for connection in connections.all():
+            def cursor(connection=connection, make_cursor=connection.cursor):
+                return InstrumentedCursor(make_cursor(), connection, self)
+            connection.cursor = cursor
+            self.patched.append(connection)
+
+    def uninstall(self):
+        for connection in self.patched:
+            del connection.cursor
+        self.patched = []
+
+    def summary(self):
+        '''Totals for the request, with the statements run more than once and
+        the number of queries repeating an earlier one exactly'''
+        statements = Counter(sql for sql, _, _ in self.queries)
+        exact = Counter((sql, repr(params)) for sql, params, _ in self.queries if params is not None)
+        return {'ms': (time() - self.start) * 1000,
+                'queries': len(self.queries),
+                'sql_ms': sum(duration for _, _, duration in self.queries) * 1000,
+                'duplicates': sum(n - 1 for n in exact.values()),
+                'repeated': [(sql, n) for sql, n in statements.most_common() if n > 1],
+                'revisions': self.revisions,
+                'revision_ms': self.revision_time * 1000}
+
+
+class RequestStats(object):
+    '''Totals per view name for this process, added to the stats cache in the
+    background of later requests'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(Counter)
+        self.flushed = time()
+
+    def add(self, view_name, summary, slow):
+        with self.lock:
+            totals = self.pending[view_name]
+            totals['requests'] += 1
+            for field in ('ms', 'queries', 'sql_ms', 'duplicates', 'revisions', 'revision_ms'):
+                totals[field] += summary[field]
+            totals['slow'] += int(slow)
+        if time() - self.flushed >= STATS_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(Counter)
+            self.flushed = time()
+        if not pending:
+            return
+        cache = stats_cache()
+        # the index is read and written without a lock, a view first seen by two
+        # processes at once can be left out until one of them sees it again
+        views = cache.get(INDEX_KEY) or []
+        if set(pending) - set(views):
+            cache.set(INDEX_KEY, sorted(set(views) | set(pending)), None)
+        for view_name, totals in pending.items():
+            for field in STAT_FIELDS:
+                incr_counter(cache, _key(view_name, field), int(round(totals[field])))
+
+
+_stats = RequestStats()
+
+
+def request_stats():
+    '''Totals and means per view name across every process, slowest total first'''
+    _stats.flush()
+    cache = stats_cache()
+    views = cache.get(INDEX_KEY) or []
+    values = cache.get_many([_key(view_name, field) for view_name in views for field in STAT_FIELDS])
+    rows = []
+    for view_name in views:
+        row = dict((field, values.get(_key(view_name, field), 0)) for field in STAT_FIELDS)
+        if not row['requests']:
+            continue
+        row['view'] = view_name
+        for field in ('ms', 'queries', 'sql_ms', 'duplicates', 'revision_ms'):
+            row['mean_' + field] = float(row[field]) / row['requests']
+        rows.append(row)
+    return sorted(rows, key=lambda row: -row['ms'])
+
+
+def reset_request_stats():
+    _stats.flush()
+    cache = stats_cache()
+    views = cache.get(INDEX_KEY) or []
+    cache.delete_many([INDEX_KEY] + [_key(view_name, field) for view_name in views for field in STAT_FIELDS])
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else '<unresolved>'
+
+
+def log_slow_request(request, response, recorder, summary):
+    lines = ['Slow request {} {} {}: {:.0f} ms, {} queries, {:.0f} ms SQL, {} duplicates, '
+             '{:.0f} ms writing {} revisions'.format(request.method, request.path, response.status_code,
+                                                     summary['ms'], summary['queries'], summary['sql_ms'],
+                                                     summary['duplicates'], summary['revision_ms'],
+                                                     summary['revisions'])]
+    for sql, n in summary['repeated'][:SLOW_LOG_QUERIES]:
+        lines.append('  {} times: {}'.format(n, sql))
+    for sql, _, duration in sorted(recorder.queries, key=lambda q: -q[2])[:SLOW_LOG_QUERIES]:
+        lines.append('  {:.1f} ms: {}'.format(duration * 1000, sql))
+    logger.warning('\n'.join(lines), extra={'request': request, 'summary': summary})
+
+
+class RequestInstrumentationMiddleware(object):
+    '''Place first in MIDDLEWARE_CLASSES so the time of every other middleware,
+    including the revisions written by RevisionMiddleware, is counted'''
+    def process_request(self, request):
+        recorder = RequestRecorder()
+        recorder.install()
+        _active.recorder = recorder
+
+    def process_response(self, request, response):
+        recorder = getattr(_active, 'recorder', None)
+        if recorder is None:
+            return response
+        recorder.uninstall()
+        summary = recorder.summary()
+        slow = summary['ms'] >= getattr(settings, 'SLOW_REQUEST_MS', 1000)
+        if slow:
+            log_slow_request(request, response, recorder, summary)
+        _active.recorder = None
+        _stats.add(view_name(request), summary, slow)
+        return response
+
+
+def revision_started(sender, **kwargs):
+    recorder = getattr(_active, 'recorder', None)
+    if recorder is not None:
+        recorder.revision_start = time()
+
+
+def revision_saved(sender, **kwargs):
+    recorder = getattr(_active, 'recorder', None)
+    if recorder is not None and recorder.revision_start is not None:
+        recorder.revisions += 1
+        recorder.revision_time += time() - recorder.revision_start
+        recorder.revision_start = None
+
+pre_revision_commit.connect(revision_started, dispatch_uid='instrumentation_revision_started')
+post_revision_commit.connect(revision_saved, dispatch_uid='instrumentation_revision_saved')
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.archive import ARCHIVE_BATCH_SIZE, archive_after_days, archive_staff
+
+
+class Command(BaseCommand):
+    help = ('Move staff inactive and unchanged for a number of days, default set by the ARCHIVE_AFTER_DAYS '
+            'setting, and all of their records into the archive.')
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int',
+                    help='Archive staff inactive and unchanged for at least this many days.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=ARCHIVE_BATCH_SIZE,
+                    help='Number of staff archived in each transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Count the staff that would be archived without archiving them.'),
+    )
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else archive_after_days()
+        count = archive_staff(days=days, batch_size=options['batch_size'], dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write('Would archive {} staff inactive for {} days.'.format(count, days))
+        else:
+            self.stdout.write('Archived {} staff inactive for {} days.'.format(count, days))
@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.benchmark import Benchmark, BenchmarkError
+
+
+class Command(BaseCommand):
+    args = '<scenario scenario ...>'
+    help = ('Measure the latency and query counts of the staff admin, history pages, bulk operations and '
+            'API against the staff in the database. Runs every scenario when none are given.')
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=5,
+                    help='Number of measured runs of each scenario.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+                    help='Number of staff members used by bulk operations and API pages.'),
+        make_option('--output', dest='output',
+                    help='File to write the results to as JSON.'),
+    )
+
+    def handle(self, *names, **options):
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+        try:
+            results = Benchmark(repeat=options['repeat'], batch_size=options['batch_size']).run(list(names))
+        except BenchmarkError as e:
+            raise CommandError(str(e))
+        for name, result in results['scenarios'].items():
+            self.stdout.write('{:<24} {:>9.1f} ms median {:>9.1f} ms max {:>6} queries'.format(
+                name, result['median_ms'], result['max_ms'], result['queries']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,38 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.history import RetentionPolicy, compact_history
+from StaffInformation.models import BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Thin old reversion history to daily and then monthly snapshots of each object, '
+            'defaults are set by the REVERSION_RETENTION setting.')
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-all-days', dest='keep_all_days', type='int',
+                    help='Keep every version saved within this many days.'),
+        make_option('--keep-daily-days', dest='keep_daily_days', type='int',
+                    help='Keep one version per object per day within this many days, monthly after that.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE,
+                    help='Number of versions read and deleted at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Count the versions that would be deleted without deleting them.'),
+    )
+
+    def handle(self, *args, **options):
+        defaults = RetentionPolicy.from_settings()
+        for name in ('keep_all_days', 'keep_daily_days'):
+            if options[name] is None:
+                options[name] = getattr(defaults, name)
+        try:
+            policy = RetentionPolicy(keep_all_days=options['keep_all_days'], keep_daily_days=options['keep_daily_days'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        counts = compact_history(policy, batch_size=options['batch_size'], dry_run=options['dry_run'])
+        if options['dry_run']:
+            self.stdout.write('Would delete {versions} versions.'.format(**counts))
+        else:
+            self.stdout.write('Deleted {versions} versions and {revisions} revisions.'.format(**counts))
@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.compliance import ComplianceReport
+from StaffInformation.models import EXPIRY_WARNING_DAYS
+
+
+class Command(BaseCommand):
+    help = 'Report expired, expiring and missing blue cards and teacher registrations.'
+    option_list = BaseCommand.option_list + (
+        make_option('--days', dest='days', type='int', default=EXPIRY_WARNING_DAYS,
+                    help='Report expiries within this many days as expiring soon.'),
+        make_option('--summary', action='store_true', dest='summary', default=False,
+                    help='Only print the counts for each status.'),
+    )
+
+    def handle(self, *args, **options):
+        report = ComplianceReport(days=options['days'])
+        self.stdout.write('{} active staff as at {}'.format(report.total, report.on))
+        self.stdout.write('{:<15} {:>10} {:>13}'.format('Status', 'Blue Card', 'Registration'))
+        for label, bluecard, registration in report.summary():
+            self.stdout.write('{:<15} {:>10} {:>13}'.format(label, bluecard, registration))
+        if options['summary']:
+            return
+        self.stdout.write('')
+        for staff in report.attention():
+            self.stdout.write('{}\t{}\tblue card {} {}\tregistration {} {}'.format(
+                staff.employee_number, staff.display_name,
+                staff.bluecard_status, staff.bluecard_expiry,
+                staff.registration_status, staff.teacher_registration_expiry or ''))
@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six
+
+from StaffInformation.exporter import FORMATS, StaffExporter
+from StaffInformation.models import BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Export staff members and their related records as CSV or JSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=sorted(FORMATS), default='csv'),
+        make_option('--output', dest='output',
+                    help='File to write to, defaults to standard output.'),
+        make_option('--columns', dest='columns', default='',
+                    help='Comma separated list of columns to export.'),
+        make_option('--active', dest='active', choices=['active', 'inactive', 'all'], default='active'),
+        make_option('--bluecard-expires-within', dest='bluecard_expires_within', type='int',
+                    help='Only staff whose blue card expires within this many days.'),
+        make_option('--bluecard-expired', action='store_true', dest='bluecard_expired', default=False,
+                    help='Only staff whose blue card has expired.'),
+        make_option('--registration-expires-within', dest='registration_expires_within', type='int',
+                    help='Only staff whose teacher registration expires within this many days.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            exporter = StaffExporter(columns=[c for c in options['columns'].split(',') if c],
+                                     batch_size=options['batch_size'],
+                                     active=options['active'],
+                                     bluecard_expires_within=options['bluecard_expires_within'],
+                                     bluecard_expired=options['bluecard_expired'],
+                                     registration_expires_within=options['registration_expires_within'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        render = FORMATS[options['format']][1]
+        if not options['output']:
+            for chunk in render(exporter):
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'wb') as output:
+            for chunk in render(exporter):
+                output.write(chunk.encode('utf-8') if isinstance(chunk, six.text_type) else chunk)
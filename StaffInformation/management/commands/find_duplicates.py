@@ -0,0 +1,26 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.duplicates import find_duplicates, MIN_SCORE
+from StaffInformation.models import StaffMember
+
+
+class Command(BaseCommand):
+    help = 'List pairs of staff that may be the same person, best match first.'
+    option_list = BaseCommand.option_list + (
+        make_option('--min-score', dest='min_score', type='float', default=MIN_SCORE,
+                    help='How alike a pair must be to be listed, from 0 to 1.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Include inactive staff.'),
+    )
+
+    def handle(self, *args, **options):
+        staff = StaffMember.all_objects.all() if options['all'] else StaffMember.objects.all()
+        matches = find_duplicates(staff, min_score=options['min_score'])
+        for match in matches:
+            self.stdout.write('{:.2f}\t{}\t{}\t{}'.format(match.score, match.first.label, match.second.label,
+                                                          ', '.join(match.reasons)))
+        self.stdout.write('{} possible duplicates.'.format(len(matches)))
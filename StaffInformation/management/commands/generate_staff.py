@@ -0,0 +1,33 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.generator import StaffGenerator
+from StaffInformation.models import BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Generate synthetic staff members with contacts, next of kin, qualifications, keys and '
+            'inservice attendance, for development and benchmarking.')
+    option_list = BaseCommand.option_list + (
+        make_option('--count', dest='count', type='int', default=100,
+                    help='Number of staff members to generate.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+                    help='Random seed, the same seed generates the same staff.'),
+        make_option('--keys', dest='keys', type='int', default=2,
+                    help='Average number of keys issued to each staff member.'),
+        make_option('--sessions', dest='sessions', type='int', default=20,
+                    help='Number of inservice sessions to generate attendance for.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=BULK_BATCH_SIZE,
+                    help='Number of staff members inserted per transaction and revision.'),
+    )
+
+    def handle(self, *args, **options):
+        generator = StaffGenerator(seed=options['seed'], chunk_size=options['chunk_size'])
+        counts = generator.generate(options['count'], keys_per_staff=options['keys'], sessions=options['sessions'])
+        for error in counts['errors']:
+            self.stderr.write('{}: {}: {}'.format(error.line, error.field or '-', error.message))
+        self.stdout.write('Generated {staff} staff, {keys} keys and {attendance} attendance records at '
+                          '{sessions} inservice sessions.'.format(**counts))
@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.importer import READERS, ImportFileError, StaffImporter
+from StaffInformation.models import BULK_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    args = '<file file ...>'
+    help = 'Import staff members and their related records from CSV or JSON files.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Validate the files and report every error without writing anything.'),
+        make_option('--format', dest='format', choices=sorted(READERS),
+                    help='File format, guessed from the file extension when not given.'),
+        make_option('--allow-duplicates', action='store_false', dest='check_duplicates', default=True,
+                    help='Import records that look like existing staff or earlier records.'),
+        make_option('--chunk-size', dest='chunk_size', type='int', default=BULK_BATCH_SIZE,
+                    help='Number of staff members inserted per transaction and revision.'),
+    )
+
+    def handle(self, *paths, **options):
+        if not paths:
+            raise CommandError('Give at least one file to import.')
+        importer = StaffImporter(chunk_size=options['chunk_size'], dry_run=options['dry_run'],
+                                 check_duplicates=options['check_duplicates'])
+        error_count = 0
+        for path in paths:
+            format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+            if format not in READERS:
+                raise CommandError('Unknown format for {}, use --format.'.format(path))
+            try:
+                with open(path, 'rb') as f:
+                    result = importer.run(READERS[format](f))
+            except ImportFileError as e:
+                raise CommandError('{}: {}'.format(path, e))
+            for error in result.errors:
+                self.stderr.write('{}:{}: {}: {}'.format(path, error.line, error.field or '-', error.message))
+            error_count += len(result.errors)
+            if options['dry_run']:
+                self.stdout.write('{}: {} valid records, {} errors'.format(path, result.valid, len(result.errors)))
+            else:
+                counts = ', '.join('{} {}'.format(count, model._meta.verbose_name_plural)
+                                   for model, count in result.created.items() if count)
+                self.stdout.write('{}: imported {}'.format(path, counts or 'nothing'))
+        if error_count:
+            raise CommandError('{} errors found.'.format(error_count))
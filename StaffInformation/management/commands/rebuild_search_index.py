@@ -0,0 +1,25 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.models import StaffMember, BULK_BATCH_SIZE
+from StaffInformation.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the staff search index. Saves through the models keep it up to date, '
+            'this is for changes made with bulk updates or directly in the database.')
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since',
+                    help='Only reindex staff updated on or after this date (YYYY-MM-DD).'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        queryset = None
+        if options['since']:
+            queryset = StaffMember.all_objects.filter(updated__gte=options['since'])
+        count = rebuild_index(queryset, batch_size=options['batch_size'])
+        self.stdout.write('Indexed {} staff.'.format(count))
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.instrumentation import request_stats, reset_request_stats
+
+
+class Command(BaseCommand):
+    help = ('Print request counts, mean time, queries, SQL time, duplicated queries and revision writing '
+            'time for each URL pattern, as recorded by RequestInstrumentationMiddleware.')
+    option_list = BaseCommand.option_list + (
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='Reset the stats after printing them.'),
+        make_option('--limit', dest='limit', type='int', default=None,
+                    help='Only print the URL patterns with the most total time.'),
+    )
+
+    def handle(self, *args, **options):
+        rows = request_stats()[:options['limit']]
+        self.stdout.write('{:<50} {:>8} {:>9} {:>8} {:>9} {:>6} {:>11} {:>6}'.format(
+            'view', 'requests', 'mean ms', 'queries', 'sql ms', 'dups', 'revision ms', 'slow'))
+        for row in rows:
+            self.stdout.write('{view:<50} {requests:>8} {mean_ms:>9.1f} {mean_queries:>8.1f} {mean_sql_ms:>9.1f} '
+                              '{mean_duplicates:>6.1f} {mean_revision_ms:>11.1f} {slow:>6}'.format(**row))
+        if options['reset']:
+            reset_request_stats()
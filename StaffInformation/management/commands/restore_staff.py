@@ -0,0 +1,24 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.archive import RestoreError, restore_staff
+from StaffInformation.models import ArchivedStaff
+
+
+class Command(BaseCommand):
+    args = '<employee_number employee_number ...>'
+    help = 'Move archived staff back into the staff list, they stay inactive until reactivated.'
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give the employee numbers of the staff to restore.')
+        archived = list(ArchivedStaff.objects.filter(employee_number__in=args))
+        missing = sorted(set(args) - set(a.employee_number for a in archived))
+        if missing:
+            raise CommandError('No archived staff with employee number {}.'.format(', '.join(missing)))
+        try:
+            count = restore_staff(archived)
+        except RestoreError as e:
+            raise CommandError(str(e))
+        self.stdout.write('Restored {} staff.'.format(count))
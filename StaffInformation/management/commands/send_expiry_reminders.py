@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.models import BULK_BATCH_SIZE
+from StaffInformation.notifications import ExpiryNotifier
+
+
+class Command(BaseCommand):
+    help = ('Email staff and their supervisors about blue cards and teacher registrations that are about to expire. '
+            'Reminders already sent are not sent again, run daily.')
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date', default=None,
+                    help='Send the reminders due on this date, YYYY-MM-DD, instead of today.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE,
+                    help='Number of staff read and emailed at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Count the reminders that are due without sending or recording them.'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            on = datetime.strptime(options['date'], '%Y-%m-%d').date() if options['date'] else None
+        except ValueError:
+            raise CommandError('--date must be YYYY-MM-DD.')
+        counts = ExpiryNotifier(on=on, batch_size=options['batch_size']).send(dry_run=options['dry_run'])
+        self.stdout.write('{} {} emails with {} reminders, {} staff have no email address to send to.'.format(
+            'Would send' if options['dry_run'] else 'Sent', counts['messages'], counts['reminders'],
+            counts['unreachable']))
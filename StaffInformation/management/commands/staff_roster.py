@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+
+from datetime import date, datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.models import BULK_BATCH_SIZE, EXPIRY_WARNING_DAYS
+from StaffInformation.roster import compliance_as_of, rebuild_snapshots, roster_as_of
+
+
+class Command(BaseCommand):
+    help = 'Print the staff roster, with blue card and registration statuses, as it stood on a date.'
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date',
+                    help='Date of the roster as YYYY-MM-DD, defaults to today.'),
+        make_option('--days', dest='days', type='int', default=EXPIRY_WARNING_DAYS,
+                    help='Report expiries within this many days of the date as expiring soon.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Include staff who were inactive on the date.'),
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+                    help='Rebuild the staff snapshots from the reversion history first.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            day = datetime.strptime(options['date'], '%Y-%m-%d').date() if options['date'] else date.today()
+        except ValueError:
+            raise CommandError('--date must be YYYY-MM-DD.')
+        if options['rebuild']:
+            self.stdout.write('Rebuilt {} staff snapshots.'.format(rebuild_snapshots(batch_size=options['batch_size'])))
+        report = compliance_as_of(day, days=options['days'])
+        self.stdout.write('{} active staff as at {}'.format(report.total, day))
+        self.stdout.write('{:<15} {:>10} {:>13}'.format('Status', 'Blue Card', 'Registration'))
+        for label, bluecard, registration in report.summary():
+            self.stdout.write('{:<15} {:>10} {:>13}'.format(label, bluecard, registration))
+        self.stdout.write('')
+        roster = roster_as_of(day).with_compliance_status(days=options['days'], on=day)
+        if not options['all']:
+            roster = roster.filter(active=True)
+        for staff in roster:
+            self.stdout.write('{}\t{}\t{}\tblue card {} {} {}\tregistration {} {}'.format(
+                staff.employee_number, staff.display_name, 'active' if staff.active else 'inactive',
+                staff.bluecard_number, staff.bluecard_status, staff.bluecard_expiry,
+                staff.registration_status, staff.teacher_registration_expiry or ''))
@@ -0,0 +1,14 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.models import StaffMember
+
+
+class Command(BaseCommand):
+    help = ('Recompute every staff member\'s schedule from the works_monday to works_friday columns and birthday '
+            'from dob. Run after adding those columns and after bulk updates of the columns they come from.')
+
+    def handle(self, *args, **options):
+        count = StaffMember.all_objects.all().sync_computed_columns()
+        self.stdout.write('Updated the computed columns of {} staff.'.format(count))
@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from StaffInformation.timetabler import TimetablerSync, read_export
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Update teacher codes, names and working days from a Timetabler CSV export, '
+            'only staff that differ from the export are written.')
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Report the differences without changing anything.'),
+        make_option('--deactivate-departures', action='store_true', dest='deactivate_departures', default=False,
+                    help='Deactivate staff whose codes are no longer in the export, not just clear their codes.'),
+        make_option('--ignore-errors', action='store_true', dest='ignore_errors', default=False,
+                    help='Sync the rows that could be read when others could not, leaving the teachers of '
+                         'unreadable rows unchanged.'),
+    )
+
+    def handle(self, *paths, **options):
+        if len(paths) != 1:
+            raise CommandError('Give the Timetabler export file to sync from.')
+        with open(paths[0], 'rb') as f:
+            teachers, errors, unreadable = read_export(f)
+        for error in errors:
+            self.stderr.write('{}:{}: {}: {}'.format(paths[0], error.line, error.field or '-', error.message))
+        if errors and (not teachers or not options['ignore_errors']):
+            raise CommandError('{} errors found, nothing was synced.'.format(len(errors)))
+        sync = TimetablerSync(deactivate_departures=options['deactivate_departures'])
+        diff = sync.diff(teachers, unreadable)
+        for change in diff.changes:
+            self.stdout.write('{}\t{}\t{}\t{}'.format(change.kind, change.code, change.staff.display_name,
+                                                      ', '.join('{} {} -> {}'.format(field, old, new)
+                                                                for field, (old, new) in change.fields.items())))
+        for teacher in diff.unmatched:
+            self.stdout.write('unmatched\t{}\t{} {}'.format(teacher.code, teacher.given_name, teacher.surname))
+        counts = '{} new, {} changed, {} departed, {} unmatched, {} unchanged'.format(
+            len(diff.kind('new')), len(diff.kind('changed')), len(diff.kind('departed')), len(diff.unmatched),
+            diff.unchanged)
+        if options['dry_run']:
+            self.stdout.write('Dry run: {}.'.format(counts))
+        else:
+            sync.apply(diff)
+            self.stdout.write('Synced: {}.'.format(counts))
@@ -0,0 +1,30 @@
+from __future__ import unicode_literals
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from StaffInformation.models import BULK_BATCH_SIZE
+from StaffInformation.profiles import warm, stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = ('Build and cache the profile of every active staff member. Use with a cache shared '
+            'between processes, such as memcached, set by the STAFF_PROFILE_CACHE setting.')
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=BULK_BATCH_SIZE),
+        make_option('--stats', action='store_true', dest='stats', default=False,
+                    help='Only print the profile cache hit and miss counts.'),
+        make_option('--reset-stats', action='store_true', dest='reset_stats', default=False,
+                    help='Reset the hit and miss counts after printing them.'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            count = warm(batch_size=options['batch_size'])
+            self.stdout.write('Cached {} staff profiles.'.format(count))
+        counts = stats()
+        rate = '-' if counts['hit_rate'] is None else '{:.1%}'.format(counts['hit_rate'])
+        self.stdout.write('{} hits, {} misses, hit rate {}'.format(counts['hits'], counts['misses'], rate))
+        if options['reset_stats']:
+            reset_stats()
@@ -1,5 +1,8 @@
-from django.db import models
-from datetime import date
+from django.db import connections, models, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+from collections import OrderedDict
+from datetime import date, timedelta
 from dateutil.relativedelta import relativedelta
 import reversion
 
@@ -48,11 +51,323 @@ STATES = [('QLD', 'Queensland'),
           ('NT', 'Northern Territory'),
           ('OTHER', 'Outside Australia')]
 
+# Number of primary keys sent to the database in a single statement, keeps
+# bulk operations under the SQLite host parameter limit
+BULK_BATCH_SIZE = 500
 
-class StaffMemberQuerySet(models.query.QuerySet):
-    def delete(self):
-        # TODO: this should generate sql that sets the active attribute to false rather than deleting records
-        pass
+# Days ahead of expiry that a blue card or teacher registration is reported
+# as expiring
+EXPIRY_WARNING_DAYS = 60
+
+NOTIFICATION_KINDS = [('bluecard', 'Blue Card'),
+                      ('registration', 'Teacher Registration')]
+
+STAFF_CHANGE_ACTIONS = [('created', 'Created'),
+                        ('updated', 'Updated'),
+                        ('deleted', 'Deleted'),
+                        ('deactivated', 'Deactivated'),
+                        ('reactivated', 'Reactivated'),
+                        ('archived', 'Archived'),
+                        ('restored', 'Restored')]
+
+COMPLIANCE_STATUSES = [('expired', 'Expired'),
+                       ('expiring', 'Expiring Soon'),
+                       ('missing', 'Missing'),
+                       ('valid', 'Valid'),
+                       ('not_required', 'Not Required')]
+
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday')
+# schedule of a staff member who works every weekday
+ALL_WEEKDAYS = (1 << len(WEEKDAYS)) - 1
+# Weekly hours of a full time staff member, one FTE
+FULL_TIME_HOURS = 38
+
+# Age from which staff are reported as eligible to retire
+RETIREMENT_AGE = 60
+
+
+def day_bit(day):
+    '''The schedule bit for a date or a weekday number, Monday is 0. Zero for
+    weekends.'''
+    weekday = day.weekday() if hasattr(day, 'weekday') else day
+    return 1 << weekday if 0 <= weekday < len(WEEKDAYS) else 0
+
+
+def masks_with(bit):
+    '''Every schedule value that includes bit'''
+    return [mask for mask in range(ALL_WEEKDAYS + 1) if mask & bit]
+
+
+class WorkingDaysField(models.PositiveSmallIntegerField):
+    '''A bit per weekday worked, Monday is bit 0. Computed from the works_*
+    booleans whenever a staff member is saved or bulk created, like auto_now.
+    Updates of the booleans with QuerySet.update need sync_computed_columns.'''
+    def pre_save(self, model_instance, add):
+        value = sum(day_bit(index) for index, day in enumerate(WEEKDAYS) if getattr(model_instance, 'works_' + day))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def birthday_key(day):
+    '''A date's month and day as a number, 1231 for the 31st of December'''
+    return day.month * 100 + day.day
+
+
+def is_leap_year(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def last_birthday_key(day):
+    '''The latest birthday_key that has been reached by day, 29 February
+    birthdays fall on 28 February in other years, as relativedelta has them'''
+    if day.month == 2 and day.day == 28 and not is_leap_year(day.year):
+        return 229
+    return birthday_key(day)
+
+
+def years_before(day, years):
+    '''The latest date of birth of someone years old on day'''
+    before = day - relativedelta(years=years)
+    if last_birthday_key(day) == 229 and is_leap_year(before.year):
+        before = before.replace(day=29)
+    return before
+
+
+class BirthdayField(models.PositiveSmallIntegerField):
+    '''The birthday_key of dob, so birthdays in a range of days are an indexed
+    lookup whatever year staff were born in. Computed whenever a staff member
+    is saved or bulk created, updates of dob with QuerySet.update need
+    sync_computed_columns.'''
+    def pre_save(self, model_instance, add):
+        value = birthday_key(model_instance.dob) if model_instance.dob else 0
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+# Sent by bulk operations that change staff or their related rows without
+# saving each instance, so no post_save signals are sent for them
+staff_changed = Signal(providing_args=['staff_ids'])
+
+
+class ComplianceQuerySet(models.query.QuerySet):
+    '''Compliance annotations for models with the StaffMember blue card and
+    teacher registration columns'''
+    def with_compliance_status(self, days=EXPIRY_WARNING_DAYS, on=None):
+        '''Annotate bluecard_status and registration_status, one of the
+        COMPLIANCE_STATUSES keys, computed in SQL'''
+        on = on or date.today()
+        warning = on + timedelta(days=days)
+        quote_name = connections[self.db].ops.quote_name
+
+        def column(name):
+            return '{}.{}'.format(quote_name(self.model._meta.db_table), quote_name(name))
+
+        bluecard = ("CASE WHEN {expiry} IS NULL THEN 'missing' "
+                    "WHEN {expiry} <= %s THEN 'expired' "
+                    "WHEN {expiry} <= %s THEN 'expiring' "
+                    "ELSE 'valid' END").format(expiry=column('bluecard_expiry'))
+        registration = ("CASE WHEN {expiry} IS NULL THEN "
+                        "CASE WHEN {code} IS NULL AND {number} IS NULL THEN 'not_required' ELSE 'missing' END "
+                        "WHEN {expiry} <= %s THEN 'expired' "
+                        "WHEN {expiry} <= %s THEN 'expiring' "
+                        "ELSE 'valid' END").format(expiry=column('teacher_registration_expiry'),
+                                                   code=column('timetable_code'),
+                                                   number=column('teacher_registration_number'))
+        return self.extra(select=OrderedDict([('bluecard_status', bluecard), ('registration_status', registration)]),
+                          select_params=(on, warning, on, warning))
+
+
+class StaffMemberQuerySet(ComplianceQuerySet):
+    def _set_active(self, active, user=None, comment=''):
+        '''Set the active flag on every staff member in this queryset with set based
+        UPDATEs and record the change as a single revision. Returns the number of
+        staff members changed.'''
+        # read and write the primary database, as QuerySet.update does
+        self._for_write = True
+        pks = list(self.exclude(active=active).values_list('pk', flat=True))
+        changed = []
+        with transaction.atomic(using=self.db):
+            for start in range(0, len(pks), BULK_BATCH_SIZE):
+                batch = StaffMemberQuerySet(self.model, using=self.db).filter(pk__in=pks[start:start + BULK_BATCH_SIZE])
+                batch.update(active=active, updated=date.today())
+                changed.extend(batch)
+            if changed:
+                reversion.default_revision_manager.save_revision(changed, user=user, comment=comment)
+                StaffChange.objects.db_manager(self.db).record(self.model, [s.pk for s in changed],
+                                                               'reactivated' if active else 'deactivated')
+        if changed:
+            staff_changed.send(sender=self.model, staff_ids=[s.pk for s in changed])
+        return len(changed)
+
+    def deactivate(self, user=None, comment='Deactivated.'):
+        return self._set_active(False, user=user, comment=comment)
+
+    def reactivate(self, user=None, comment='Reactivated.'):
+        return self._set_active(True, user=user, comment=comment)
+
+    def delete(self, user=None, comment='Deactivated.'):
+        '''Staff members are never deleted, deactivate them instead'''
+        return self.deactivate(user=user, comment=comment)
+
+    # Expiry dates are compared in the database so these filters can use the
+    # indexes on bluecard_expiry and teacher_registration_expiry. A card or
+    # registration is expired on its expiry date, as in valid_bluecard.
+
+    def bluecard_valid(self, on=None):
+        return self.filter(bluecard_expiry__gt=on or date.today())
+
+    def bluecard_expired(self, on=None):
+        return self.filter(bluecard_expiry__lte=on or date.today())
+
+    def bluecard_expiring(self, days=EXPIRY_WARNING_DAYS, on=None):
+        on = on or date.today()
+        return self.filter(bluecard_expiry__gt=on, bluecard_expiry__lte=on + timedelta(days=days))
+
+    def registration_expired(self, on=None):
+        return self.filter(teacher_registration_expiry__lte=on or date.today())
+
+    def registration_expiring(self, days=EXPIRY_WARNING_DAYS, on=None):
+        on = on or date.today()
+        return self.filter(teacher_registration_expiry__gt=on,
+                           teacher_registration_expiry__lte=on + timedelta(days=days))
+
+    def registration_missing(self):
+        '''Staff with a timetable code or registration number but no registration expiry'''
+        return self.filter(models.Q(timetable_code__isnull=False) | models.Q(teacher_registration_number__isnull=False),
+                           teacher_registration_expiry__isnull=True)
+
+    def working_on(self, day):
+        '''Staff who work on day, a date or weekday number. Filters on the indexed
+        schedule with the 16 values that include the day.'''
+        return self.filter(schedule__in=masks_with(day_bit(day)))
+
+    def _column(self, name):
+        quote_name = connections[self.db].ops.quote_name
+        return '{}.{}'.format(quote_name(self.model._meta.db_table), quote_name(name))
+
+    def _years_since(self, name, key, on):
+        '''SQL for the whole years from the date in column name to on, key is the
+        SQL for the column's birthday_key'''
+        year = connections[self.db].ops.date_extract_sql('year', self._column(name))
+        return ('%s - {year} - CASE WHEN {key} > %s THEN 1 ELSE 0 END'.format(year=year, key=key),
+                [on.year, last_birthday_key(on)])
+
+    def with_age(self, on=None):
+        '''Annotate age_years, the whole years old on the date on, computed in SQL
+        from dob and the precomputed birthday'''
+        sql, params = self._years_since('dob', self._column('birthday'), on or date.today())
+        return self.extra(select={'age_years': sql}, select_params=params)
+
+    def with_service(self, on=None):
+        '''Annotate service_years, the whole years since the staff member was
+        created, computed in SQL'''
+        extract = connections[self.db].ops.date_extract_sql
+        created = self._column('created')
+        key = '{} * 100 + {}'.format(extract('month', created), extract('day', created))
+        sql, params = self._years_since('created', key, on or date.today())
+        return self.extra(select={'service_years': sql}, select_params=params)
+
+    def aged(self, minimum=None, maximum=None, on=None):
+        '''Staff at least minimum and at most maximum years old on the date on, a
+        range filter on the indexed dob'''
+        on = on or date.today()
+        queryset = self
+        if minimum is not None:
+            queryset = queryset.filter(dob__lte=years_before(on, minimum))
+        if maximum is not None:
+            queryset = queryset.filter(dob__gt=years_before(on, maximum + 1))
+        return queryset
+
+    def served(self, minimum=None, maximum=None, on=None):
+        '''Staff created at least minimum and at most maximum whole years before
+        the date on, a range filter on the indexed created'''
+        on = on or date.today()
+        queryset = self
+        if minimum is not None:
+            queryset = queryset.filter(created__lte=years_before(on, minimum))
+        if maximum is not None:
+            queryset = queryset.filter(created__gt=years_before(on, maximum + 1))
+        return queryset
+
+    def retirement_eligible(self, on=None):
+        return self.aged(minimum=RETIREMENT_AGE, on=on)
+
+    def birthdays_between(self, start, end):
+        '''Staff with a birthday from start to end inclusive, which may span the
+        new year, ordered by the next birthday from start. A 29 February
+        birthday falls on 28 February in other years.'''
+        first, last = birthday_key(start), last_birthday_key(end)
+        if (end - start).days >= 365:
+            queryset = self
+        elif first <= last:
+            queryset = self.filter(birthday__gte=first, birthday__lte=last)
+        else:
+            queryset = self.filter(models.Q(birthday__gte=first) | models.Q(birthday__lte=last))
+        return (queryset.extra(select={'birthday_wrapped': 'CASE WHEN {} < %s THEN 1 ELSE 0 END'.format(
+                                   self._column('birthday'))}, select_params=[first])
+                        .order_by('birthday_wrapped', 'birthday'))
+
+    def sync_computed_columns(self):
+        '''Recompute schedule from the works_* booleans and birthday from dob, one
+        UPDATE per BULK_BATCH_SIZE staff, for rows changed with QuerySet.update
+        or created before the columns existed. Returns the number of staff
+        updated.'''
+        self._for_write = True
+        quote_name = connections[self.db].ops.quote_name
+        extract = connections[self.db].ops.date_extract_sql
+        dob = quote_name('dob')
+        schedule = ' + '.join('CASE WHEN {} THEN {} ELSE 0 END'.format(quote_name('works_' + day), day_bit(index))
+                              for index, day in enumerate(WEEKDAYS))
+        birthday = '{} * 100 + {}'.format(extract('month', dob), extract('day', dob))
+        pks = list(self.values_list('pk', flat=True))
+        with transaction.atomic(using=self.db):
+            cursor = connections[self.db].cursor()
+            for start in range(0, len(pks), BULK_BATCH_SIZE):
+                batch = pks[start:start + BULK_BATCH_SIZE]
+                cursor.execute('UPDATE {table} SET {schedule} = {schedule_value}, {birthday} = {birthday_value} '
+                               'WHERE {pk} IN ({params})'.format(
+                                   table=quote_name(self.model._meta.db_table),
+                                   schedule=quote_name('schedule'), schedule_value=schedule,
+                                   birthday=quote_name('birthday'), birthday_value=birthday,
+                                   pk=quote_name('id'), params=', '.join(['%s'] * len(batch))), batch)
+        return len(pks)
+
+    def with_primary_contacts(self):
+        '''Annotate primary_email_address and primary_phone_number from correlated
+        subqueries, so lists of staff can show them without a query per row'''
+        quote_name = connections[self.db].ops.quote_name
+        subquery = ('SELECT {value} FROM {table} WHERE {table}.{fk} = {staff}.{pk} '
+                    'AND {table}.{primary} ORDER BY {table}.{pk} LIMIT 1')
+        select = OrderedDict()
+        for name, model, value in [('primary_email_address', EmailAddress, 'address'),
+                                   ('primary_phone_number', StaffPhoneNumber, 'value')]:
+            select[name] = subquery.format(value=quote_name(value),
+                                           table=quote_name(model._meta.db_table),
+                                           fk=quote_name('staff_member_id'),
+                                           staff=quote_name(self.model._meta.db_table),
+                                           pk=quote_name('id'),
+                                           primary=quote_name('primary'))
+        return self.extra(select=select)
+
+    def with_change_sequence(self):
+        '''Annotate change_sequence, the sequence number of each staff member's
+        latest change feed entry or None, from a correlated subquery'''
+        quote_name = connections[self.db].ops.quote_name
+        subquery = 'SELECT MAX({table}.{pk}) FROM {table} WHERE {table}.{staff_id} = {staff}.{pk}'
+        return self.extra(select={'change_sequence': subquery.format(table=quote_name(StaffChange._meta.db_table),
+                                                                     pk=quote_name('id'),
+                                                                     staff_id=quote_name('staff_id'),
+                                                                     staff=quote_name(self.model._meta.db_table))})
+
+
+def primary_contact(owner, related_name):
+    '''The primary contact in one of owner's related sets, or None. Uses the
+    prefetched set when there is one, otherwise a single indexed query.'''
+    prefetched = getattr(owner, '_prefetched_objects_cache', {})
+    if related_name in prefetched:
+        return next((c for c in prefetched[related_name] if c.primary), None)
+    return getattr(owner, related_name).filter(primary=True).first()
 
 
 class StaffMemberModelManager(models.Manager):
@@ -60,8 +375,13 @@ class StaffMemberModelManager(models.Manager):
         return StaffMemberQuerySet(self.model, using=self._db).filter(active=True)
 
 
+class AllStaffMemberModelManager(models.Manager):
+    def get_queryset(self):
+        return StaffMemberQuerySet(self.model, using=self._db)
+
+
 class StaffMember(models.Model):
-    created = models.DateField(auto_now_add=True)
+    created = models.DateField(auto_now_add=True, db_index=True)
     updated = models.DateField(auto_now=True)
     title = models.CharField(max_length=50, choices=COMMON_TITLES)
     prefered_given_name = models.CharField(max_length=255, blank=True, null=True,
@@ -81,13 +401,14 @@ class StaffMember(models.Model):
     # addresses back reference
     # phone_numbers back reference
     # email_addresses back reference
-    dob = models.DateField(verbose_name='Date of Birth')
+    dob = models.DateField(verbose_name='Date of Birth', db_index=True)
+    birthday = BirthdayField(default=0, editable=False, db_index=True)
     religion = models.CharField(max_length=255, blank=True, null=True,
                                 help_text='Leave blank if religion is unknown')
     teacher_registration_number = models.IntegerField(unique=True, blank=True, null=True,
                                                       help_text='Leave blank if unknown or not applicable',
                                                       verbose_name='Teacher Registration Number')
-    teacher_registration_expiry = models.DateField(blank=True, null=True,
+    teacher_registration_expiry = models.DateField(blank=True, null=True, db_index=True,
                                                    help_text='Leave blank if unknown or not applicable',
                                                    verbose_name='Teacher Registration Expiry')
     # subjects taught
@@ -100,12 +421,17 @@ class StaffMember(models.Model):
     bluecard_number = models.CharField(max_length=255, unique=True,
                                        help_text='Blue Card Registration Number',
                                        verbose_name='Blue Card Number')
-    bluecard_expiry = models.DateField(help_text='Blue Card Expiry',
+    bluecard_expiry = models.DateField(db_index=True,
+                                       help_text='Blue Card Expiry',
                                        verbose_name='Blue Card Expiry')
     # next_of_kin back reference
     vehicle_registration = models.CharField(max_length=50, blank=True, null=True,
                                             help_text='Vehicle registration number if applicable',
                                             verbose_name='Vehicle Registration')
+    supervisor = models.ForeignKey('self', blank=True, null=True, related_name='supervised_staff',
+                                   on_delete=models.SET_NULL,
+                                   help_text='Also sent blue card and teacher registration expiry reminders',
+                                   verbose_name='Supervisor')
     media_consent_form = models.BooleanField(default=False,
                                              help_text='Check if your media consent form has been flled out and returned to the school',
                                              verbose_name='Media Consent Form')
@@ -117,11 +443,30 @@ class StaffMember(models.Model):
     works_wednesday = models.BooleanField(default=True, verbose_name='Works Wednesday')
     works_thursday = models.BooleanField(default=True, verbose_name='Works Thrusday')
     works_friday = models.BooleanField(default=True, verbose_name='Works Friday')
+    schedule = WorkingDaysField(default=ALL_WEEKDAYS, editable=False, db_index=True)
     # qualifications back reference
     active = models.BooleanField(default=True)
 
     # Custom object manager, only shows active staff members
     objects = StaffMemberModelManager()
+    # Includes inactive staff members, used to reactivate them
+    all_objects = AllStaffMemberModelManager()
+
+    def __init__(self, *args, **kwargs):
+        super(StaffMember, self).__init__(*args, **kwargs)
+        # whether the database row is active, so the change feed can tell
+        # deactivations from other saves
+        self._saved_active = self.__dict__.get('active') if self.pk else None
+
+    def __unicode__(self):
+        return self.display_name
+
+    def save(self, *args, **kwargs):
+        # Django 1.6 sends post_save after the save's own transaction, so the
+        # change feed entry written by changes.py would commit separately
+        with transaction.atomic(using=kwargs.get('using')):
+            super(StaffMember, self).save(*args, **kwargs)
+        self._saved_active = self.active
 
     @property
     def display_name(self):
@@ -140,6 +485,18 @@ class StaffMember(models.Model):
     def age(self):
         return relativedelta(date.today(), self.dob)
 
+    @property
+    def primary_address(self):
+        return primary_contact(self, 'addresses')
+
+    @property
+    def primary_email(self):
+        return primary_contact(self, 'email_addresses')
+
+    @property
+    def primary_phone(self):
+        return primary_contact(self, 'phone_numbers')
+
     @property
     def working_days(self):
         return {'monday': self.works_monday,
@@ -157,12 +514,106 @@ class StaffMember(models.Model):
         verbose_name = 'Staff'
         verbose_name_plural = 'Staff'
         ordering = ('legal_surname', 'legal_given_name')
+        # objects filters on active and orders by name
+        index_together = [('active', 'legal_surname', 'legal_given_name')]
 
 
 reversion.register(StaffMember)
 
 
-class Address(models.Model):
+class PrimaryContactQuerySet(models.query.QuerySet):
+    # each contact id is sent twice, keeps every statement under BULK_BATCH_SIZE parameters
+    primary_batch_size = BULK_BATCH_SIZE // 3
+
+    def set_primary(self, contacts):
+        '''Make each of contacts the only primary contact of its owner. Every batch
+        is a single UPDATE, so concurrent edits can not leave an owner with two
+        primary contacts.'''
+        contacts = list(contacts)
+        if not contacts:
+            return
+        self._for_write = True
+        staff_ids = self.model.owner_staff_ids(contacts)
+        with transaction.atomic(using=self.db):
+            for start in range(0, len(contacts), self.primary_batch_size):
+                self._set_primary_batch(contacts[start:start + self.primary_batch_size])
+            StaffChange.objects.db_manager(self.db).record(self.model, staff_ids)
+        for contact in contacts:
+            contact.primary = True
+        staff_changed.send(sender=self.model, staff_ids=staff_ids)
+
+    def _set_primary_batch(self, contacts):
+        if not contacts:
+            return
+        meta = self.model._meta
+        owner = meta.get_field(self.model.owner_field)
+        quote_name = connections[self.db].ops.quote_name
+        ids = [c.pk for c in contacts]
+        owners = list(set(getattr(c, owner.attname) for c in contacts))
+        sql = ('UPDATE {table} SET {primary} = CASE WHEN {pk} IN ({ids}) THEN %s ELSE %s END '
+               'WHERE {owner} IN ({owners}) AND ({primary} = %s OR {pk} IN ({ids}))')
+        sql = sql.format(table=quote_name(meta.db_table),
+                         primary=quote_name('primary'),
+                         pk=quote_name(meta.pk.column),
+                         owner=quote_name(owner.column),
+                         ids=', '.join(['%s'] * len(ids)),
+                         owners=', '.join(['%s'] * len(owners)))
+        connections[self.db].cursor().execute(sql, ids + [True, False] + owners + [True] + ids)
+
+
+class PrimaryContactManager(models.Manager):
+    def get_queryset(self):
+        return PrimaryContactQuerySet(self.model, using=self._db)
+
+    def set_primary(self, contacts):
+        return self.get_queryset().set_primary(contacts)
+
+
+class PrimaryContact(models.Model):
+    '''Base for contacts where one contact per owner, the object named by
+    owner_field, is marked primary.
+
+    Saving a primary contact demotes its siblings in the same UPDATE that
+    promotes it, even when it was read as primary, as a sibling may have been
+    promoted since. Deleting the primary contact promotes the
+    oldest remaining sibling with an UPDATE rather than a save.'''
+    owner_field = 'staff_member'
+
+    objects = PrimaryContactManager()
+
+    @classmethod
+    def owner_staff_ids(cls, contacts):
+        '''Primary keys of the staff members that own contacts'''
+        return list(set(c.staff_member_id for c in contacts))
+
+    def siblings(self):
+        '''Contacts with the same owner, including this one'''
+        return type(self).objects.filter(**{self.owner_field: getattr(self, self._owner_attname())})
+
+    def _owner_attname(self):
+        return self._meta.get_field(self.owner_field).attname
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(PrimaryContact, self).save(*args, **kwargs)
+            if self.primary:
+                # the change feed and staff_changed are left to post_save
+                type(self).objects.using(self._state.db).all()._set_primary_batch([self])
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            siblings = self.siblings().exclude(pk=self.pk)
+            super(PrimaryContact, self).delete(*args, **kwargs)
+            if self.primary:
+                replacement = siblings.aggregate(pk=models.Min('pk'))['pk']
+                if replacement is not None:
+                    siblings.filter(pk=replacement).update(primary=True)
+
+    class Meta:
+        abstract = True
+
+
+class Address(PrimaryContact):
     created = models.DateField(auto_now_add=True)
     updated = models.DateField(auto_now=True)
     rel = models.IntegerField(choices=ADDRESS_RELS, verbose_name='Kind')
@@ -183,33 +634,17 @@ class Address(models.Model):
     street = models.CharField(max_length=255)
     staff_member = models.ForeignKey('StaffMember', related_name='addresses')
 
-    def save(self, *args, **kwargs):
-        '''If this email address is chosen as the primary address then update any
-        other EmailAddress for this staff member that is marked as primary'''
-        if self.primary is True:
-            Address.objects.filter(primary=True, staff_member=self.staff_member).update(primary=False)
-        super(Address, self).save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        if self.primary is True:
-            try:
-                e = Address.objects.filter(primary=False, staff_member=self.staff_member).all()[0]
-                e.primary = True
-                e.save()
-            except IndexError:
-                pass
-        super(Address, self).delete(*args, **kwargs)
-
     class Meta:
         verbose_name = 'Staff Address'
         verbose_name_plural = 'Staff Addresses'
         ordering = ('primary', 'updated')
+        index_together = [('staff_member', 'primary')]
 
 
 reversion.register(Address)
 
 
-class PhoneNumber(models.Model):
+class PhoneNumber(PrimaryContact):
     created = models.DateField(auto_now_add=True)
     updated = models.DateField(auto_now=True)
     rel = models.IntegerField(choices=PHONE_RELS, verbose_name='Kind')
@@ -225,26 +660,10 @@ class PhoneNumber(models.Model):
 class StaffPhoneNumber(PhoneNumber):
     staff_member = models.ForeignKey('StaffMember', related_name='phone_numbers')
 
-    def save(self, *args, **kwargs):
-        '''If this email address is chosen as the primary address then update any
-        other EmailAddress for this staff member that is marked as primary'''
-        if self.primary is True:
-            StaffPhoneNumber.objects.filter(primary=True, staff_member=self.staff_member).update(primary=False)
-        super(StaffPhoneNumber, self).save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        if self.primary is True:
-            try:
-                e = StaffPhoneNumber.objects.filter(primary=False, staff_member=self.staff_member).all()[0]
-                e.primary = True
-                e.save()
-            except IndexError:
-                pass
-        super(StaffPhoneNumber, self).delete(*args, **kwargs)
-
     class Meta:
         verbose_name = 'Staff Phone Number'
         verbose_name_plural = 'Staff Phone Numbers'
+        index_together = [('staff_member', 'primary')]
 
 
 reversion.register(StaffPhoneNumber)
@@ -253,26 +672,17 @@ reversion.register(StaffPhoneNumber)
 class NOKPhoneNumber(PhoneNumber):
     next_of_kin = models.ForeignKey('NextOfKin', related_name='phone_numbers')
 
-    def save(self, *args, **kwargs):
-        '''If this email address is chosen as the primary address then update any
-        other EmailAddress for this staff member that is marked as primary'''
-        if self.primary is True:
-            NOKPhoneNumber.objects.filter(primary=True, next_of_kin=self.next_of_kin).update(primary=False)
-        super(NOKPhoneNumber, self).save(*args, **kwargs)
+    owner_field = 'next_of_kin'
 
-    def delete(self, *args, **kwargs):
-        if self.primary is True:
-            try:
-                e = NOKPhoneNumber.objects.filter(primary=False, next_of_kin=self.next_of_kin).all()[0]
-                e.primary = True
-                e.save()
-            except IndexError:
-                pass
-        super(NOKPhoneNumber, self).delete(*args, **kwargs)
+    @classmethod
+    def owner_staff_ids(cls, contacts):
+        next_of_kin = set(c.next_of_kin_id for c in contacts)
+        return list(NextOfKin.objects.filter(pk__in=next_of_kin).values_list('staff_member', flat=True).distinct())
 
     class Meta:
         verbose_name = 'Next of Kin Phone Number'
         verbose_name_plural = 'Next of Kin Phone Numbers'
+        index_together = [('next_of_kin', 'primary')]
 
 
 reversion.register(NOKPhoneNumber)
@@ -290,6 +700,14 @@ class NextOfKin(models.Model):
     # phone_numbers back reference
     staff_member = models.ForeignKey('StaffMember', related_name='next_of_kin')
 
+    @property
+    def primary_phone(self):
+        return primary_contact(self, 'phone_numbers')
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(NextOfKin, self).save(*args, **kwargs)
+
     class Meta:
         unique_together = [('staff_member', 'priority')]
         verbose_name = 'Next of Kin'
@@ -308,6 +726,10 @@ class Qualification(models.Model):
     date_awarded = models.DateField(help_text='The date this qualification was awarded to you')
     staff_member = models.ForeignKey('StaffMember', related_name='qualifications')
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            super(Qualification, self).save(*args, **kwargs)
+
     class Meta:
         verbose_name = 'Qualification'
         verbose_name_plural = 'Qualifications'
@@ -316,7 +738,7 @@ class Qualification(models.Model):
 reversion.register(Qualification)
 
 
-class EmailAddress(models.Model):
+class EmailAddress(PrimaryContact):
     created = models.DateField(auto_now_add=True)
     updated = models.DateField(auto_now=True)
     address = models.EmailField(max_length=255, verbose_name='Email Address')
@@ -325,27 +747,167 @@ class EmailAddress(models.Model):
     primary = models.BooleanField(default=False)
     staff_member = models.ForeignKey('StaffMember', related_name='email_addresses')
 
-    def save(self, *args, **kwargs):
-        '''If this email address is chosen as the primary address then update any
-        other EmailAddress for this staff member that is marked as primary'''
-        if self.primary is True:
-            EmailAddress.objects.filter(primary=True, staff_member=self.staff_member).update(primary=False)
-        super(EmailAddress, self).save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        if self.primary is True:
-            try:
-                e = EmailAddress.objects.filter(primary=False, staff_member=self.staff_member).all()[0]
-                e.primary = True
-                e.save()
-            except IndexError:
-                pass
-        super(EmailAddress, self).delete(*args, **kwargs)
-
     class Meta:
         verbose_name = 'Staff Email Address'
         verbose_name_plural = 'Staff Email Addresses'
         ordering = ('primary', 'updated')
+        index_together = [('staff_member', 'primary')]
 
 
 reversion.register(EmailAddress)
+
+
+class SearchTerm(models.Model):
+    '''Search index entry for a staff member, maintained by StaffInformation.search.
+    Each normalised word from a staff member's names, identifiers, email
+    addresses and phone numbers is stored once as a term, name words are also
+    stored as one term per trigram so misspelt names can be matched.'''
+    staff_member = models.ForeignKey('StaffMember', related_name='search_terms')
+    term = models.CharField(max_length=255)
+    word = models.CharField(max_length=255)
+    trigram = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = [('trigram', 'term')]
+
+
+class StaffSnapshotQuerySet(ComplianceQuerySet):
+    def as_of(self, moment):
+        '''The snapshot of each staff member that was current at moment'''
+        return self.filter(models.Q(valid_to__gt=moment) | models.Q(valid_to__isnull=True), valid_from__lte=moment)
+
+
+class StaffSnapshotManager(models.Manager):
+    def get_queryset(self):
+        return StaffSnapshotQuerySet(self.model, using=self._db)
+
+    def as_of(self, moment):
+        return self.get_queryset().as_of(moment)
+
+
+class StaffSnapshot(models.Model):
+    '''A staff member's roster details from valid_from until valid_to, or until
+    now when valid_to is null. Maintained by StaffInformation.roster from each
+    StaffMember version reversion saves. Snapshots outlive the staff rows of
+    archived staff, so past rosters keep them, and rejoin them on restore.'''
+    # no constraint so archiving can delete the staff row and keep its
+    # snapshots
+    staff_member = models.ForeignKey('StaffMember', related_name='snapshots', db_constraint=False)
+    valid_from = models.DateTimeField()
+    valid_to = models.DateTimeField(blank=True, null=True)
+    title = models.CharField(max_length=50, choices=COMMON_TITLES)
+    prefered_given_name = models.CharField(max_length=255, blank=True, null=True)
+    legal_given_name = models.CharField(max_length=255)
+    prefered_surname = models.CharField(max_length=255, blank=True, null=True)
+    legal_surname = models.CharField(max_length=255)
+    employee_number = models.CharField(max_length=255)
+    timetable_code = models.CharField(max_length=50, blank=True, null=True)
+    teacher_registration_number = models.IntegerField(blank=True, null=True)
+    teacher_registration_expiry = models.DateField(blank=True, null=True)
+    bluecard_number = models.CharField(max_length=255)
+    bluecard_expiry = models.DateField()
+    active = models.BooleanField(default=True)
+
+    objects = StaffSnapshotManager()
+
+    display_name = StaffMember.display_name
+
+    class Meta:
+        # not by staff_member, which would join away archived staff
+        ordering = ('legal_surname', 'legal_given_name', 'pk')
+        index_together = [('valid_from', 'valid_to'), ('staff_member', 'valid_to')]
+
+
+class ExpiryNotification(models.Model):
+    '''A blue card or teacher registration expiry reminder that has been sent,
+    recorded by StaffInformation.notifications so each reminder is sent once'''
+    staff_member = models.ForeignKey('StaffMember', related_name='expiry_notifications')
+    kind = models.CharField(max_length=20, choices=NOTIFICATION_KINDS)
+    expiry = models.DateField()
+    # the reminder day, days before expiry, the reminder was sent for
+    days = models.SmallIntegerField()
+    sent = models.DateTimeField(auto_now_add=True)
+    recipients = models.TextField()
+
+    class Meta:
+        unique_together = [('staff_member', 'kind', 'expiry', 'days')]
+
+
+class StaffChangeManager(models.Manager):
+    def record(self, model, staff_ids, action='updated', object_id=None):
+        '''Append an entry for each of staff_ids to the change feed, for a change
+        to their model rows. Call it inside the transaction making the change so
+        the entries are committed, or rolled back, with it.'''
+        label = '{}.{}'.format(model._meta.app_label, model._meta.object_name)
+        self.bulk_create([StaffChange(staff_id=pk, model=label, action=action, object_id=object_id)
+                          for pk in sorted(set(staff_ids)) if pk is not None], batch_size=BULK_BATCH_SIZE)
+
+    def since(self, sequence, settle_seconds=0):
+        '''Entries after sequence in the order they were written, leaving out
+        those written in the last settle_seconds'''
+        entries = self.filter(pk__gt=sequence).order_by('pk')
+        if settle_seconds:
+            entries = entries.filter(created__lte=timezone.now() - timedelta(seconds=settle_seconds))
+        return entries
+
+
+class StaffChange(models.Model):
+    '''An entry in the append only change feed of staff members and their
+    related rows, maintained by StaffInformation.changes and the bulk
+    operations. The primary key is the entry's sequence number.'''
+    # not a foreign key, entries outlive the rows they describe
+    staff_id = models.IntegerField(db_index=True)
+    model = models.CharField(max_length=100)
+    # the changed row, null for changes to many rows
+    object_id = models.IntegerField(blank=True, null=True)
+    action = models.CharField(max_length=20, choices=STAFF_CHANGE_ACTIONS)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = StaffChangeManager()
+
+    class Meta:
+        ordering = ('pk',)
+
+
+class ArchivedStaff(models.Model):
+    '''A staff member moved out of the live tables by StaffInformation.archive,
+    with every row that belonged to them and their reversion versions kept as
+    serialized JSON until they are restored'''
+    # the staff member's primary key, which they get back when restored
+    staff_id = models.IntegerField(unique=True)
+    employee_number = models.CharField(max_length=255, db_index=True)
+    title = models.CharField(max_length=50, choices=COMMON_TITLES)
+    prefered_given_name = models.CharField(max_length=255, blank=True, null=True)
+    legal_given_name = models.CharField(max_length=255)
+    prefered_surname = models.CharField(max_length=255, blank=True, null=True)
+    legal_surname = models.CharField(max_length=255)
+    dob = models.DateField()
+    # the staff member's last change before they were archived
+    departed = models.DateField()
+    archived = models.DateTimeField(auto_now_add=True)
+    # normalised words of their names, identifiers and email addresses, each
+    # preceded by a space for prefix matching
+    search_text = models.TextField()
+    rows = models.TextField()
+    versions = models.TextField()
+
+    display_name = StaffMember.display_name
+
+    def __unicode__(self):
+        return self.display_name
+
+    class Meta:
+        verbose_name = 'Archived Staff'
+        verbose_name_plural = 'Archived Staff'
+        ordering = ('legal_surname', 'legal_given_name')
+
+
+# Connect the signal handlers that keep SearchTerm, the profile cache and the
+# API's last modified dates up to date, that leave unchanged versions out of
+# revisions and that record staff snapshots from new versions
+import search
+import changes
+import profiles
+import api
+import history
+import roster
@@ -0,0 +1,137 @@
+'''Blue card and teacher registration expiry reminders.
+
+ExpiryNotifier emails each active staff member whose blue card or teacher
+registration expires within the largest of the EXPIRY_REMINDER_DAYS, copying
+in their supervisor. A reminder is due for the smallest of those days the
+expiry is within, so staff hear about an expiry once at each reminder day and
+once more when it has passed. Sent reminders are recorded as
+ExpiryNotifications and never sent again, so the job can be rerun safely.
+
+Staff are read batch_size at a time with range queries on the indexed expiry
+columns, together with what has already been sent to them and their
+supervisors' email addresses, so a run costs a few queries per batch. Each
+batch's messages are sent over the one SMTP connection held open for the run
+and recorded as soon as they are sent, a run that fails part way through only
+resends the batch it failed on.
+'''
+from __future__ import unicode_literals
+
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Q
+from django.template import Context
+from django.template.loader import get_template
+
+from models import StaffMember, EmailAddress, ExpiryNotification, NOTIFICATION_KINDS, BULK_BATCH_SIZE
+
+# Days before expiry that reminders are sent, 0 sends one once it has expired
+REMINDER_DAYS = (60, 30, 7, 0)
+
+EXPIRY_FIELDS = {'bluecard': 'bluecard_expiry', 'registration': 'teacher_registration_expiry'}
+
+
+def reminder_days():
+    return sorted(getattr(settings, 'EXPIRY_REMINDER_DAYS', REMINDER_DAYS))
+
+
+def due_reminder(expiry, on, days):
+    '''The smallest of the reminder days, in ascending order, that expiry is
+    within on the date on, None when no reminder is due'''
+    left = (expiry - on).days
+    for day in days:
+        if left <= day:
+            return day
+    return None
+
+
+class ExpiryNotifier(object):
+    def __init__(self, on=None, days=None, batch_size=BULK_BATCH_SIZE, connection=None):
+        self.on = on or date.today()
+        self.days = sorted(days) if days is not None else reminder_days()
+        self.batch_size = batch_size
+        self.connection = connection
+        self.template = get_template('StaffInformation/email/expiry_reminder.txt')
+
+    def candidates(self):
+        '''Active staff with an expiry within the largest reminder day'''
+        horizon = self.on + timedelta(days=self.days[-1])
+        return (StaffMember.objects.filter(Q(bluecard_expiry__lte=horizon) |
+                                           Q(teacher_registration_expiry__lte=horizon))
+                                   .with_primary_contacts()
+                                   .order_by('pk'))
+
+    def batches(self):
+        '''Lists of (staff, reminders, supervisor email) of staff with reminders
+        due, reminders are (kind, expiry, reminder day) not already sent'''
+        candidates = self.candidates()
+        last_pk = 0
+        while True:
+            staff = list(candidates.filter(pk__gt=last_pk)[:self.batch_size])
+            if not staff:
+                break
+            last_pk = staff[-1].pk
+            sent = set(ExpiryNotification.objects.filter(staff_member__in=[s.pk for s in staff])
+                                                 .values_list('staff_member', 'kind', 'expiry', 'days'))
+            supervisors = set(s.supervisor_id for s in staff if s.supervisor_id)
+            supervisor_emails = dict(EmailAddress.objects.filter(staff_member__in=supervisors, primary=True,
+                                                                 staff_member__active=True)
+                                                         .values_list('staff_member', 'address'))
+            batch = []
+            for member in staff:
+                reminders = []
+                for kind, _ in NOTIFICATION_KINDS:
+                    expiry = getattr(member, EXPIRY_FIELDS[kind])
+                    day = due_reminder(expiry, self.on, self.days) if expiry else None
+                    if day is not None and (member.pk, kind, expiry, day) not in sent:
+                        reminders.append((kind, expiry, day))
+                if reminders:
+                    batch.append((member, reminders, supervisor_emails.get(member.supervisor_id)))
+            yield batch
+
+    def message(self, staff, reminders, supervisor_email):
+        '''The reminder email for staff, None when they and their supervisor have
+        no primary email address'''
+        to = [staff.primary_email_address] if staff.primary_email_address else []
+        cc = [supervisor_email] if supervisor_email else []
+        if not to and not cc:
+            return None
+        labels = dict(NOTIFICATION_KINDS)
+        items = [{'label': labels[kind], 'expiry': expiry, 'days_left': (expiry - self.on).days}
+                 for kind, expiry, _ in reminders]
+        subject = '{} expiry reminder for {}'.format(' and '.join(item['label'] for item in items),
+                                                     staff.display_name)
+        body = self.template.render(Context({'staff': staff, 'reminders': items, 'on': self.on}))
+        return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, to or cc, cc=cc if to else [])
+
+    def send(self, dry_run=False):
+        '''Send every due reminder, returns the number of messages sent, reminders
+        they contained and staff skipped for having no one to send to'''
+        counts = {'messages': 0, 'reminders': 0, 'unreachable': 0}
+        connection = self.connection or get_connection()
+        if not dry_run:
+            connection.open()
+        try:
+            for batch in self.batches():
+                messages = []
+                records = []
+                for staff, reminders, supervisor_email in batch:
+                    message = self.message(staff, reminders, supervisor_email)
+                    if message is None:
+                        counts['unreachable'] += 1
+                        continue
+                    messages.append(message)
+                    recipients = ', '.join(message.recipients())
+                    records.extend(ExpiryNotification(staff_member=staff, kind=kind, expiry=expiry, days=day,
+                                                      recipients=recipients)
+                                   for kind, expiry, day in reminders)
+                if not dry_run and messages:
+                    connection.send_messages(messages)
+                    ExpiryNotification.objects.bulk_create(records, batch_size=BULK_BATCH_SIZE)
+                counts['messages'] += len(messages)
+                counts['reminders'] += len(records)
+        finally:
+            if not dry_run:
+                connection.close()
+        return counts
@@ -0,0 +1,146 @@
+'''Cached staff profile documents.
+
+A profile is a dictionary holding a staff member's details and every related
+contact, next of kin, qualification, key and inservice record. Profiles are
+stored in the cache named by the STAFF_PROFILE_CACHE setting and are deleted
+when staff_changed is sent for the staff member, which changes.py does whenever
+they or one of their related rows is saved or deleted.
+Values that depend on the current date, such as age, are added when a profile
+is read so cached profiles never go stale overnight.
+'''
+from __future__ import unicode_literals
+
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import get_cache
+from django.dispatch import receiver
+
+from counters import incr_counter
+from exporter import keyset_batches, related_dict
+from models import StaffMember, BULK_BATCH_SIZE, staff_changed
+from routing import use_primary
+
+
+RELATED_SETS = ('addresses', 'phone_numbers', 'email_addresses', 'next_of_kin', 'qualifications',
+                'keys', 'inservice_records')
+PREFETCH = RELATED_SETS + ('next_of_kin__phone_numbers', 'inservice_records__session__standards')
+
+STAFF_FIELDS = ('title', 'prefered_given_name', 'legal_given_name', 'middle_name', 'prefered_surname',
+                'legal_surname', 'dob', 'religion', 'teacher_registration_number', 'teacher_registration_expiry',
+                'timetable_code', 'employee_number', 'bluecard_number', 'bluecard_expiry',
+                'vehicle_registration', 'media_consent_form', 'weekly_hours_worked', 'active')
+
+KEY_PREFIX = 'staff_profile'
+HITS_KEY = KEY_PREFIX + ':hits'
+MISSES_KEY = KEY_PREFIX + ':misses'
+
+
+def profile_cache():
+    return get_cache(getattr(settings, 'STAFF_PROFILE_CACHE', 'default'))
+
+
+def _key(pk):
+    return '{}:{}'.format(KEY_PREFIX, pk)
+
+
+def build_profile(staff):
+    '''The cacheable profile document for a staff member, related sets should be
+    prefetched with PREFETCH when building many profiles'''
+    profile = {'id': staff.pk, 'display_name': staff.display_name, 'working_days': staff.working_days}
+    for field in STAFF_FIELDS:
+        value = getattr(staff, field)
+        profile[field] = value.isoformat() if isinstance(value, date) else value
+    for name in RELATED_SETS:
+        profile[name] = [related_dict(r) for r in getattr(staff, name).all()]
+    return profile
+
+
+def with_current_values(profile, today=None):
+    '''Add the values of a profile that depend on the current date'''
+    today = today or date.today()
+    profile = dict(profile)
+    age = relativedelta(today, _parse_date(profile['dob']))
+    profile['age'] = {'years': age.years, 'months': age.months}
+    profile['valid_bluecard'] = _parse_date(profile['bluecard_expiry']) > today
+    return profile
+
+
+def _parse_date(value):
+    return date(*map(int, value.split('-')))
+
+
+def get_profiles(pks):
+    '''Profiles for the staff members with the given primary keys, in the same
+    order, building and caching any that are missing in batches. Inactive or
+    unknown staff are left out.'''
+    pks = list(pks)
+    cache = profile_cache()
+    cached = cache.get_many([_key(pk) for pk in pks])
+    profiles = dict((pk, cached[_key(pk)]) for pk in pks if _key(pk) in cached)
+    missing = [pk for pk in pks if pk not in profiles]
+    incr_counter(cache, HITS_KEY, len(profiles))
+    incr_counter(cache, MISSES_KEY, len(missing))
+    # a profile built from a replica that has not caught up with the change
+    # that invalidated it would be cached until the next change
+    with use_primary():
+        for start in range(0, len(missing), BULK_BATCH_SIZE):
+            built = cache_profiles(StaffMember.objects.filter(pk__in=missing[start:start + BULK_BATCH_SIZE]),
+                                   cache=cache)
+            profiles.update(built)
+    today = date.today()
+    return [with_current_values(profiles[pk], today) for pk in pks if pk in profiles]
+
+
+def get_profile(pk):
+    '''The profile for one staff member, None if there is no active staff member
+    with that primary key'''
+    profiles = get_profiles([pk])
+    return profiles[0] if profiles else None
+
+
+def _build_batches(queryset, cache, batch_size):
+    for batch in keyset_batches(queryset.prefetch_related(*PREFETCH), batch_size=batch_size):
+        profiles = dict((staff.pk, build_profile(staff)) for staff in batch)
+        cache.set_many(dict((_key(pk), profile) for pk, profile in profiles.items()))
+        yield profiles
+
+
+def cache_profiles(queryset, cache=None, batch_size=BULK_BATCH_SIZE):
+    '''Build and cache profiles for every staff member in queryset, returns them
+    keyed by primary key'''
+    cache = cache or profile_cache()
+    built = {}
+    for profiles in _build_batches(queryset, cache, batch_size):
+        built.update(profiles)
+    return built
+
+
+def warm(batch_size=BULK_BATCH_SIZE):
+    '''Cache profiles for every active staff member, returns how many were built'''
+    return sum(len(profiles) for profiles in
+               _build_batches(StaffMember.objects.all(), profile_cache(), batch_size))
+
+
+def invalidate(staff_ids):
+    staff_ids = [pk for pk in set(staff_ids) if pk is not None]
+    profile_cache().delete_many([_key(pk) for pk in staff_ids])
+
+
+def stats():
+    '''Cache hits and misses counted by get_profiles'''
+    cache = profile_cache()
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    return {'hits': hits, 'misses': misses,
+            'hit_rate': float(hits) / (hits + misses) if hits + misses else None}
+
+
+def reset_stats():
+    profile_cache().delete_many([HITS_KEY, MISSES_KEY])
+
+
+@receiver(staff_changed)
+def invalidate_changed_staff(sender, staff_ids, **kwargs):
+    invalidate(staff_ids)
@@ -0,0 +1,125 @@
+'''Point in time staff rosters from the reversion history.
+
+Each StaffMember version reversion saves closes the staff member's current
+StaffSnapshot and opens a new one from the version's data, so the roster as of
+any moment is a single indexed query on StaffSnapshot rather than a history
+lookup per staff member. rebuild_snapshots fills the table from the versions
+already saved. Run it before compact_history thins old versions, since a
+rebuild afterwards only sees the versions that were kept.
+'''
+from __future__ import unicode_literals
+
+import json
+from datetime import datetime, time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core import serializers
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from reversion.models import Version, post_revision_commit
+
+from compliance import ComplianceReport
+from models import StaffMember, StaffSnapshot, ArchivedStaff, BULK_BATCH_SIZE, EXPIRY_WARNING_DAYS
+
+
+SNAPSHOT_FIELDS = ('title', 'prefered_given_name', 'legal_given_name', 'prefered_surname', 'legal_surname',
+                   'employee_number', 'timetable_code', 'teacher_registration_number', 'teacher_registration_expiry',
+                   'bluecard_number', 'bluecard_expiry', 'active')
+
+
+def snapshot(staff_id, version_format, serialized_data, valid_from):
+    '''An unsaved StaffSnapshot from a StaffMember version's serialized data'''
+    if version_format == 'json':
+        # much faster than deserializing a model instance for each version
+        fields = json.loads(serialized_data)[0]['fields']
+        values = dict((name, StaffMember._meta.get_field(name).to_python(fields.get(name)))
+                      for name in SNAPSHOT_FIELDS)
+    else:
+        staff = next(serializers.deserialize(version_format, serialized_data, ignorenonexistent=True)).object
+        values = dict((name, getattr(staff, name)) for name in SNAPSHOT_FIELDS)
+    return StaffSnapshot(staff_member_id=staff_id, valid_from=valid_from, **values)
+
+
+def end_of_day(day):
+    '''The last moment of day in the current time zone'''
+    moment = datetime.combine(day, time.max)
+    if settings.USE_TZ:
+        moment = timezone.make_aware(moment, timezone.get_current_timezone())
+    return moment
+
+
+def roster_as_of(moment):
+    '''Snapshots of every staff member known at moment, active or not, a date
+    means the end of that day'''
+    if not isinstance(moment, datetime):
+        moment = end_of_day(moment)
+    return StaffSnapshot.objects.as_of(moment)
+
+
+def compliance_as_of(day, days=EXPIRY_WARNING_DAYS):
+    '''A ComplianceReport of the staff who were active at the end of day, with
+    statuses as they stood on day'''
+    return ComplianceReport(days=days, on=day, queryset=roster_as_of(day).filter(active=True))
+
+
+def record_versions(versions, valid_from):
+    '''Close the current snapshots of the staff members in versions and open new
+    ones from the versions'''
+    staff_versions = dict((int(v.object_id), v) for v in versions)
+    staff_ids = list(staff_versions)
+    with transaction.atomic():
+        for start in range(0, len(staff_ids), BULK_BATCH_SIZE):
+            (StaffSnapshot.objects.filter(staff_member__in=staff_ids[start:start + BULK_BATCH_SIZE],
+                                          valid_to__isnull=True)
+                                  .update(valid_to=valid_from))
+        StaffSnapshot.objects.bulk_create([snapshot(pk, v.format, v.serialized_data, valid_from)
+                                           for pk, v in staff_versions.items()], batch_size=BULK_BATCH_SIZE)
+
+
+def rebuild_snapshots(batch_size=BULK_BATCH_SIZE):
+    '''Replace every snapshot with ones built from the saved StaffMember
+    versions, reading batch_size versions at a time. Archived staff have no
+    versions, their snapshots are kept. Returns the number of snapshots
+    created.'''
+    content_type = ContentType.objects.get_for_model(StaffMember)
+    versions = (Version.objects.filter(content_type=content_type)
+                               .order_by('pk')
+                               .values_list('pk', 'object_id', 'format', 'serialized_data',
+                                            'revision__date_created'))
+    # the latest snapshot of each staff member, saved once the next version
+    # closes it or at the end
+    current = {}
+    pending = []
+    created = 0
+    last_pk = 0
+    with transaction.atomic():
+        archived = ArchivedStaff.objects.values_list('staff_id', flat=True)
+        StaffSnapshot.objects.exclude(staff_member__in=archived).delete()
+        while True:
+            batch = list(versions.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            for pk, object_id, version_format, data, valid_from in batch:
+                staff_id = int(object_id)
+                if staff_id in current:
+                    current[staff_id].valid_to = valid_from
+                    pending.append(current[staff_id])
+                current[staff_id] = snapshot(staff_id, version_format, data, valid_from)
+            if len(pending) >= batch_size:
+                StaffSnapshot.objects.bulk_create(pending, batch_size=BULK_BATCH_SIZE)
+                created += len(pending)
+                pending = []
+        pending.extend(current.values())
+        StaffSnapshot.objects.bulk_create(pending, batch_size=BULK_BATCH_SIZE)
+    return created + len(pending)
+
+
+@receiver(post_revision_commit)
+def snapshot_staff_versions(sender, revision, versions, **kwargs):
+    content_type = ContentType.objects.get_for_model(StaffMember)
+    staff_versions = [v for v in versions if v.content_type_id == content_type.pk]
+    if staff_versions:
+        record_versions(staff_versions, revision.date_created)
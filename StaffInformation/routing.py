@@ -0,0 +1,100 @@
+'''Sends reads to read replicas and writes to the primary database.
+
+PrimaryReplicaRouter routes reads to one of the database aliases named by the
+READ_REPLICAS setting, and every write, reversion's included, to the default
+database. Reads go to the primary instead when they cannot be allowed to miss
+a recent write:
+
+- inside a transaction on the primary, so a transaction reads its own writes
+  and rows it is about to change
+- in a thread that has written, for the rest of the request, or for good in a
+  management command
+- in the REPLICA_PIN_SECONDS after a browser's last write, so the page it is
+  redirected to after saving shows the change, marked with a cookie by
+  PrimaryPinningMiddleware
+
+With no READ_REPLICAS every query uses the primary, as before.
+'''
+from __future__ import unicode_literals
+
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+PRIMARY = DEFAULT_DB_ALIAS
+PIN_COOKIE = 'pin_primary'
+PIN_SECONDS = 10
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+_state = threading.local()
+
+
+def read_replicas():
+    return getattr(settings, 'READ_REPLICAS', [])
+
+
+def pinned():
+    '''Whether reads in this thread must go to the primary'''
+    return getattr(_state, 'pinned', False) or connections[PRIMARY].in_atomic_block
+
+
+def pin(wrote=False):
+    '''Send this thread's reads to the primary until reset'''
+    _state.pinned = True
+    _state.wrote = getattr(_state, 'wrote', False) or wrote
+
+
+def reset():
+    _state.pinned = False
+    _state.wrote = False
+
+
+@contextmanager
+def use_primary():
+    '''Read from the primary within the block'''
+    was_pinned = getattr(_state, 'pinned', False)
+    _state.pinned = True
+    try:
+        yield
+    finally:
+        _state.pinned = was_pinned
+
+
+class PrimaryReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        replicas = read_replicas()
+        if not replicas or pinned():
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        pin(wrote=True)
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db == PRIMARY
+
+
+class PrimaryPinningMiddleware(object):
+    '''Place before SessionMiddleware, so the session is read from the primary
+    after a login, and after RequestInstrumentationMiddleware'''
+    def process_request(self, request):
+        reset()
+        if request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES:
+            pin()
+
+    def process_response(self, request, response):
+        if request.method not in SAFE_METHODS or getattr(_state, 'wrote', False):
+            seconds = getattr(settings, 'REPLICA_PIN_SECONDS', PIN_SECONDS)
+            response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True)
+        # streamed content is read after this, from the replicas
+        reset()
+        return response
@@ -0,0 +1,64 @@
+'''Weekday coverage and relief planning from the staff schedule bits.
+
+Coverage is computed from one query grouping staff by schedule, which has at
+most 32 distinct values, so the per weekday headcount and FTE cost the same
+however many staff there are. A staff member's FTE on a day they work is their
+weekly hours spread evenly over the days they work, as a share of a full time
+day.
+'''
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.db.models import Count, Sum
+
+from models import StaffMember, WEEKDAYS, FULL_TIME_HOURS, day_bit
+
+
+# Hours of a full time staff member each day
+FULL_TIME_DAY = float(FULL_TIME_HOURS) / len(WEEKDAYS)
+
+
+def days_worked(schedule):
+    return bin(schedule).count('1')
+
+
+def daily_fte(weekly_hours, schedule):
+    '''The FTE on each day worked of a staff member working weekly_hours over
+    the days in schedule'''
+    if not schedule:
+        return 0.0
+    return float(weekly_hours or 0) / days_worked(schedule) / FULL_TIME_DAY
+
+
+def coverage(queryset=None):
+    '''An OrderedDict of weekday name to a dict of the headcount and FTE of the
+    staff in queryset, active staff by default, working that day'''
+    queryset = queryset if queryset is not None else StaffMember.objects.all()
+    groups = (queryset.order_by()
+                      .values('schedule')
+                      .annotate(headcount=Count('pk'), hours=Sum('weekly_hours_worked')))
+    days = OrderedDict((day, {'headcount': 0, 'fte': 0.0}) for day in WEEKDAYS)
+    for group in groups:
+        # hours is the group's total, so this is the FTE of the whole group
+        fte = daily_fte(group['hours'], group['schedule'])
+        for index, day in enumerate(WEEKDAYS):
+            if group['schedule'] & day_bit(index):
+                days[day]['headcount'] += group['headcount']
+                days[day]['fte'] += fte
+    return days
+
+
+class ReliefPlan(object):
+    '''The teachers rostered on day and the part time teachers who are not and
+    so may be able to cover classes, from one query'''
+    def __init__(self, day):
+        self.day = day
+        bit = day_bit(day)
+        teachers = list(StaffMember.objects.filter(timetable_code__isnull=False)
+                                           .only('title', 'prefered_given_name', 'legal_given_name',
+                                                 'prefered_surname', 'legal_surname', 'timetable_code',
+                                                 'weekly_hours_worked', 'schedule'))
+        self.rostered = [t for t in teachers if t.schedule & bit]
+        self.available = [t for t in teachers if not t.schedule & bit]
+        self.rostered_fte = sum(daily_fte(t.weekly_hours_worked, t.schedule) for t in self.rostered)
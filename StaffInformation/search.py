@@ -0,0 +1,214 @@
+'''Ranked, typo tolerant staff search backed by the SearchTerm table.
+
+Every query word is matched against the index in two queries: a prefix match
+on indexed words using a range lookup, and a trigram lookup returning the
+indexed name words that share a trigram with it, which are then scored by edit
+distance. Staff must match every query word and are ranked by the sum of their
+best score for each word.
+'''
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from models import StaffMember, StaffPhoneNumber, EmailAddress, SearchTerm, BULK_BATCH_SIZE
+
+
+NAME_FIELDS = ('prefered_given_name', 'legal_given_name', 'middle_name', 'prefered_surname', 'legal_surname')
+IDENTIFIER_FIELDS = ('employee_number', 'timetable_code', 'bluecard_number', 'teacher_registration_number')
+
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.9
+# Fuzzy matches score their similarity scaled by this, so they rank below
+# prefix matches, and must be at least MIN_SIMILARITY alike
+FUZZY_SCALE = 0.8
+MIN_SIMILARITY = 0.6
+MIN_FUZZY_LENGTH = 3
+
+DEFAULT_LIMIT = 20
+
+
+def normalise(text):
+    '''Lower case text with accents removed'''
+    text = unicodedata.normalize('NFKD', '{}'.format(text))
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def words(text):
+    return re.findall(r'\w+', normalise(text), re.UNICODE)
+
+
+def trigrams(word):
+    padded = '  {} '.format(word)
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a, b):
+    '''Optimal string alignment similarity, 1 for equal words and 0 for words
+    with nothing in common'''
+    previous2, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        previous2, previous = previous, current
+    return 1.0 - float(previous[-1]) / max(len(a), len(b), 1)
+
+
+def staff_terms(staff, email_addresses, phone_numbers):
+    '''SearchTerm instances for a staff member and their contacts'''
+    names = set()
+    for field in NAME_FIELDS:
+        names.update(words(getattr(staff, field) or ''))
+    others = set()
+    for field in IDENTIFIER_FIELDS:
+        value = getattr(staff, field)
+        if value is not None:
+            # both the words of an identifier and the identifier without punctuation
+            others.update(words(value))
+            others.add(''.join(words(value)))
+    for email in email_addresses:
+        others.update(words(email.address))
+    for phone in phone_numbers:
+        others.add('{}'.format(phone.value))
+    terms = [SearchTerm(staff_member=staff, term=w[:255], word=w[:255]) for w in names | others]
+    for name in names:
+        for gram in trigrams(name):
+            terms.append(SearchTerm(staff_member=staff, term=gram, word=name[:255], trigram=True))
+    return terms
+
+
+def index_staff(staff_members):
+    '''Replace the index entries for staff_members, four queries per batch of
+    BULK_BATCH_SIZE staff'''
+    staff_members = list(staff_members)
+    with transaction.atomic():
+        for start in range(0, len(staff_members), BULK_BATCH_SIZE):
+            batch = staff_members[start:start + BULK_BATCH_SIZE]
+            emails = defaultdict(list)
+            for email in EmailAddress.objects.filter(staff_member__in=batch):
+                emails[email.staff_member_id].append(email)
+            phones = defaultdict(list)
+            for phone in StaffPhoneNumber.objects.filter(staff_member__in=batch):
+                phones[phone.staff_member_id].append(phone)
+            SearchTerm.objects.filter(staff_member__in=batch).delete()
+            terms = []
+            for staff in batch:
+                terms.extend(staff_terms(staff, emails[staff.pk], phones[staff.pk]))
+            SearchTerm.objects.bulk_create(terms, batch_size=BULK_BATCH_SIZE)
+
+
+def rebuild_index(queryset=None, batch_size=BULK_BATCH_SIZE):
+    '''Index every staff member in queryset, all staff when not given. Returns
+    the number of staff indexed.'''
+    # imported here as the exporter imports the models that import this module
+    from exporter import keyset_batches
+    if queryset is None:
+        SearchTerm.objects.all().delete()
+        queryset = StaffMember.all_objects.all()
+    count = 0
+    for batch in keyset_batches(queryset, batch_size=batch_size):
+        index_staff(batch)
+        count += len(batch)
+    return count
+
+
+def query_words(query):
+    '''Words of a search query, digits separated by spaces or dashes as in phone
+    numbers are joined'''
+    return list(set(words(re.sub(r'(?<=\d)[\s-]+(?=\d)', '', query))))
+
+
+def search_scores(query):
+    '''Map of staff member pk to score for staff matching every word of query'''
+    terms = query_words(query)
+    if not terms:
+        return {}
+    scores = defaultdict(dict)
+    # phone numbers are stored without their leading zero
+    alternatives = dict((term, set([term, term.lstrip('0') or term])) for term in terms)
+    prefixes = reduce(or_, [Q(term__gte=a, term__lt=a + '\uffff') for t in terms for a in alternatives[t]])
+    for staff_pk, word in SearchTerm.objects.filter(prefixes, trigram=False).values_list('staff_member', 'word'):
+        for term in terms:
+            for alternative in alternatives[term]:
+                if word == alternative:
+                    score = EXACT_SCORE
+                elif word.startswith(alternative):
+                    score = PREFIX_SCORE
+                else:
+                    continue
+                scores[staff_pk][term] = max(score, scores[staff_pk].get(term, 0))
+    fuzzy = [t for t in terms if len(t) >= MIN_FUZZY_LENGTH and not t.isdigit()]
+    grams = dict((term, trigrams(term)) for term in fuzzy)
+    all_grams = set().union(*grams.values()) if grams else set()
+    if all_grams:
+        matches = (SearchTerm.objects.filter(trigram=True, term__in=all_grams)
+                                     .values_list('staff_member', 'word', 'term'))
+        shared = defaultdict(set)
+        for staff_pk, word, gram in matches:
+            shared[(staff_pk, word)].add(gram)
+        for (staff_pk, word), word_grams in shared.items():
+            for term in fuzzy:
+                if not word_grams & grams[term]:
+                    continue
+                score = similarity(term, word)
+                if score >= MIN_SIMILARITY:
+                    scores[staff_pk][term] = max(score * FUZZY_SCALE, scores[staff_pk].get(term, 0))
+    return dict((pk, sum(matched.values())) for pk, matched in scores.items() if len(matched) == len(terms))
+
+
+def search_ids(query, limit=BULK_BATCH_SIZE):
+    '''Primary keys of the best limit staff matching query, best first'''
+    scores = search_scores(query)
+    return sorted(scores, key=lambda pk: -scores[pk])[:limit]
+
+
+def search(query, queryset=None, limit=DEFAULT_LIMIT):
+    '''Staff members matching query, best matches first. Each result has a
+    search_score attribute.'''
+    scores = search_scores(query)
+    if not scores:
+        return []
+    queryset = queryset if queryset is not None else StaffMember.objects.all()
+    ranked = sorted(scores, key=lambda pk: -scores[pk])
+    results = []
+    # fetch in ranked batches until limit active staff are found
+    for start in range(0, len(ranked), BULK_BATCH_SIZE):
+        staff = queryset.in_bulk(ranked[start:start + BULK_BATCH_SIZE])
+        for pk in ranked[start:start + BULK_BATCH_SIZE]:
+            if pk in staff:
+                staff[pk].search_score = scores[pk]
+                results.append(staff[pk])
+        if limit and len(results) >= limit:
+            return results[:limit]
+    return results
+
+
+@receiver(post_save, sender=StaffMember)
+def index_saved_staff(sender, instance, raw=False, **kwargs):
+    if not raw:
+        index_staff([instance])
+
+
+@receiver(post_save, sender=EmailAddress)
+@receiver(post_delete, sender=EmailAddress)
+@receiver(post_save, sender=StaffPhoneNumber)
+@receiver(post_delete, sender=StaffPhoneNumber)
+def index_contact_staff(sender, instance, raw=False, **kwargs):
+    if not raw:
+        try:
+            staff = StaffMember.all_objects.get(pk=instance.staff_member_id)
+        except StaffMember.DoesNotExist:
+            return
+        index_staff([staff])
@@ -1,3 +1,1436 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
 
-# Create your tests here.
+from datetime import date, datetime, timedelta
+from io import BytesIO
+import json
+import logging
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from dateutil.relativedelta import relativedelta
+import reversion
+from reversion.models import Revision
+
+from archive import ARCHIVED_ROWS, DERIVED_ROWS, RestoreError, archive_staff, restore_staff, search_archive
+from benchmark import Benchmark, change_form_data, section_form_data
+from compliance import ComplianceReport
+from demographics import DemographicsReport
+from duplicates import DuplicateFinder, find_duplicates, merge_staff, soundex
+from exporter import COMPUTED_COLUMNS, FIELD_COLUMNS, RELATED_COLUMNS, StaffExporter
+from generator import StaffGenerator
+from history import RetentionPolicy, compact_history
+from importer import ImportFileError, StaffImporter, import_staff, read_json, read_json_array
+from instrumentation import RequestRecorder, request_stats, reset_request_stats
+from roster import compliance_as_of, rebuild_snapshots, roster_as_of
+from routing import PIN_COOKIE, PrimaryPinningMiddleware, PrimaryReplicaRouter, reset, use_primary
+from schedule import ReliefPlan, coverage
+from profiles import get_profile, get_profiles, profile_cache, stats, reset_stats
+from notifications import ExpiryNotifier
+from models import (StaffMember,
+                    Address,
+                    StaffPhoneNumber,
+                    NOKPhoneNumber,
+                    NextOfKin,
+                    Qualification,
+                    EmailAddress,
+                    SearchTerm,
+                    StaffSnapshot,
+                    StaffChange,
+                    ArchivedStaff,
+                    ExpiryNotification)
+from search import search, rebuild_index
+from timetabler import TimetablerSync, parse_days, read_export
+from InserviceTracker.hours import rebuild as rebuild_hours
+from InserviceTracker.models import InserviceHours, InserviceRecord, InserviceSession, InserviceStandard
+from KeyRegistry.models import DoorKey
+
+
+def make_staff(n, **kwargs):
+    '''Create a staff member with unique identifiers derived from n'''
+    fields = dict(title='Ms',
+                  legal_given_name='Given{}'.format(n),
+                  legal_surname='Surname{}'.format(n),
+                  dob=date(1980, 1, 1),
+                  employee_number='E{}'.format(n),
+                  bluecard_number='B{}'.format(n),
+                  bluecard_expiry=date(2030, 1, 1))
+    fields.update(kwargs)
+    return StaffMember.objects.create(**fields)
+
+
+class StaffMemberQuerySetTest(TestCase):
+    def setUp(self):
+        self.staff = [make_staff(n) for n in range(5)]
+
+    def test_delete_deactivates(self):
+        count = StaffMember.objects.filter(pk__in=[s.pk for s in self.staff[:3]]).delete()
+        self.assertEqual(count, 3)
+        self.assertEqual(StaffMember.objects.count(), 2)
+        self.assertEqual(StaffMember.all_objects.count(), 5)
+
+    def test_deactivate_records_one_revision(self):
+        StaffMember.objects.all().deactivate(comment='End of term')
+        versions = reversion.get_for_object(self.staff[0])
+        self.assertEqual(versions.count(), 1)
+        revision = versions[0].revision
+        self.assertEqual(revision.comment, 'End of term')
+        self.assertEqual(revision.version_set.count(), 5)
+
+    def test_reactivate(self):
+        StaffMember.objects.all().deactivate()
+        count = StaffMember.all_objects.filter(pk=self.staff[0].pk).reactivate()
+        self.assertEqual(count, 1)
+        self.assertEqual(list(StaffMember.objects.all()), [self.staff[0]])
+
+    def test_deactivate_skips_inactive(self):
+        StaffMember.objects.filter(pk=self.staff[0].pk).deactivate()
+        self.assertEqual(StaffMember.all_objects.all().deactivate(), 4)
+
+
+class StaffMemberAdminTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+
+    def test_deactivate_selected_action(self):
+        staff = [make_staff(n) for n in range(3)]
+        response = self.client.post(reverse('admin:StaffInformation_staffmember_changelist'),
+                                    {'action': 'deactivate_selected',
+                                     '_selected_action': [s.pk for s in staff[:2]]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(StaffMember.objects.all()), staff[2:])
+
+    def test_mark_inservice_attendance_action(self):
+        staff = [make_staff(n) for n in range(3)]
+        session = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P', title='PD Day')
+        data = {'action': 'mark_inservice_attendance', '_selected_action': [s.pk for s in staff[:2]]}
+        url = reverse('admin:StaffInformation_staffmember_changelist')
+        self.assertContains(self.client.post(url, data), 'Record the 2 selected staff')
+        data.update(apply='Record attendance', session=session.pk)
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        self.assertEqual(sorted(session.attendance.values_list('staff_member', flat=True)),
+                         [s.pk for s in staff[:2]])
+
+
+IMPORT_CSV = '''employee_number,bluecard_number,title,legal_given_name,legal_surname,dob,bluecard_expiry,email_addresses.0.address,email_addresses.0.label,email_addresses.0.rel,email_addresses.0.primary,email_addresses.1.address,email_addresses.1.label,email_addresses.1.rel,email_addresses.1.primary,next_of_kin.0.title,next_of_kin.0.given_name,next_of_kin.0.surname,next_of_kin.0.relationship,next_of_kin.0.priority,next_of_kin.0.phone_numbers.0.rel,next_of_kin.0.phone_numbers.0.value
+E1,B1,Ms,Jane,Citizen,1980-02-01,2030-01-01,jane@example.com,Work,2,True,jane@home.example.com,Home,1,True,Mr,John,Citizen,Spouse,1,7,412345678
+E2,B2,Mr,Joe,Bloggs,1975-05-06,2030-01-01,joe@example.com,Work,2,,,,,,,,,,,,
+'''
+
+
+class StaffImporterTest(TestCase):
+    def test_import_csv(self):
+        result = import_staff(BytesIO(IMPORT_CSV.encode('utf-8')))
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.staff_created, 2)
+        jane = StaffMember.objects.get(employee_number='E1')
+        self.assertEqual([(e.address, e.primary) for e in jane.email_addresses.order_by('address')],
+                         [('jane@example.com', False), ('jane@home.example.com', True)])
+        nok = jane.next_of_kin.get()
+        self.assertEqual(nok.phone_numbers.get().value, 412345678)
+        self.assertEqual(reversion.get_for_object(jane)[0].revision.version_set.count(), 7)
+
+    def test_dry_run_reports_errors(self):
+        make_staff(1)
+        records = [(1, {'employee_number': 'E1', 'bluecard_number': 'B9', 'title': 'Ms',
+                        'legal_given_name': 'A', 'legal_surname': 'B', 'dob': 'not a date',
+                        'bluecard_expiry': '2030-01-01', 'shoe_size': 9})]
+        result = StaffImporter(dry_run=True).run(records)
+        self.assertEqual(sorted(e.field for e in result.errors), ['dob', 'employee_number', 'shoe_size'])
+        self.assertEqual(StaffMember.objects.count(), 1)
+
+    def test_json_lines(self):
+        data = '\n'.join(json.dumps({'employee_number': 'E{}'.format(n), 'bluecard_number': 'B{}'.format(n),
+                                     'title': 'Ms', 'legal_given_name': 'A', 'legal_surname': 'B',
+                                     'dob': '198{}-01-01'.format(n), 'bluecard_expiry': '2030-01-01'})
+                         for n in range(5))
+        result = import_staff(BytesIO(data.encode('utf-8')), format='jsonl', chunk_size=2)
+        self.assertEqual(result.staff_created, 5)
+        self.assertEqual(StaffMember.objects.count(), 5)
+        # a line that cannot be parsed is a row error
+        result = import_staff(BytesIO(b'{"employee_number": \n[]\n'), format='jsonl', dry_run=True)
+        self.assertEqual([(e.line, e.field) for e in result.errors], [(1, None), (2, None)])
+        self.assertTrue(result.errors[0].message.startswith('Invalid JSON:'))
+
+    def test_json_array(self):
+        records = [{'employee_number': 'E{}'.format(n), 'legal_given_name': 'A\u00e9', 'dob': '1980-01-01'}
+                   for n in range(5)]
+        data = BytesIO(json.dumps(records, ensure_ascii=False, indent=1).encode('utf-8'))
+        self.assertEqual(data.read(1), b'[')
+        self.assertEqual(list(read_json_array(data, chunk_size=7)), records)
+        self.assertEqual(list(read_json_array(BytesIO(b' ]'))), [])
+        with self.assertRaisesRegexp(ImportFileError, 'at offset 9'):
+            list(read_json_array(BytesIO(b'{"a": 1} {"b": 2}]')))
+        with self.assertRaisesRegexp(ImportFileError, 'at offset 11'):
+            list(read_json(BytesIO(b' [{"a": 1},')))
+
+    def test_command_dry_run(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(IMPORT_CSV.encode('utf-8'))
+            f.flush()
+            stdout = StringIO()
+            call_command('import_staff', f.name, dry_run=True, stdout=stdout)
+        self.assertIn('2 valid records, 0 errors', stdout.getvalue())
+        self.assertEqual(StaffMember.objects.count(), 0)
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            f.write(b'[{"employee_number": "E1"} {}]')
+            f.flush()
+            with self.assertRaisesRegexp(CommandError, 'at offset 27'):
+                call_command('import_staff', f.name, dry_run=True, stdout=StringIO())
+
+
+class StaffExporterTest(TestCase):
+    def setUp(self):
+        for n in range(7):
+            staff = make_staff(n, bluecard_expiry=date.today() + timedelta(days=10 * n))
+            EmailAddress.objects.create(staff_member=staff, address='s{}@example.com'.format(n),
+                                        label='Work', rel=2, primary=True)
+
+    def test_query_count_is_fixed_per_batch(self):
+        DoorKey.objects.create(owner=StaffMember.objects.get(employee_number='E0'), kind='0', number=12)
+        exporter = StaffExporter(columns=['employee_number', 'email_addresses', 'keys'], batch_size=3)
+        # three batches, each one staff query and two prefetch queries
+        with self.assertNumQueries(9):
+            lines = list(exporter.csv())
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(lines[1].strip(), 'E0,s0@example.com,MK12')
+
+    def test_every_column(self):
+        supervisor = StaffMember.objects.get(employee_number='E0')
+        StaffMember.objects.filter(employee_number='E1').update(supervisor=supervisor)
+        exporter = StaffExporter(columns=FIELD_COLUMNS + sorted(RELATED_COLUMNS) + sorted(COMPUTED_COLUMNS))
+        # the staff query and one for each related set, none per staff member
+        with self.assertNumQueries(8):
+            lines = list(exporter.csv())
+        self.assertEqual(len(lines), 8)
+        records = json.loads(''.join(exporter.json()))
+        self.assertEqual([r['supervisor_id'] for r in records[:3]], [None, supervisor.pk, None])
+
+    def test_filters(self):
+        exporter = StaffExporter(columns=['employee_number'], bluecard_expires_within=25)
+        self.assertEqual([s.employee_number for s in exporter.staff()], ['E1', 'E2'])
+
+    def test_json(self):
+        exporter = StaffExporter(columns=['employee_number', 'email_addresses'])
+        records = json.loads(''.join(exporter.json()))
+        self.assertEqual(len(records), 7)
+        self.assertEqual(records[0]['email_addresses'][0]['rel'], 'Work')
+
+    def test_export_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('export_staff'), {'columns': 'employee_number', 'active': 'all'})
+        self.assertEqual(b''.join(response.streaming_content).split(), [b'employee_number'] + [
+            'E{}'.format(n).encode('ascii') for n in range(7)])
+        response = self.client.get(reverse('export_staff'), {'columns': 'shoe_size'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('export_staff', format='json', columns='employee_number', bluecard_expired=True, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()), [{'employee_number': 'E0'}])
+
+
+class ComplianceTest(TestCase):
+    def setUp(self):
+        today = date.today()
+        make_staff(1, bluecard_expiry=today - timedelta(days=1), timetable_code='AB')
+        make_staff(2, bluecard_expiry=today + timedelta(days=10),
+                   teacher_registration_number=2, teacher_registration_expiry=today + timedelta(days=365))
+        make_staff(3, bluecard_expiry=today + timedelta(days=365))
+
+    def test_queryset_filters(self):
+        self.assertEqual([s.employee_number for s in StaffMember.objects.all().bluecard_expired()], ['E1'])
+        self.assertEqual([s.employee_number for s in StaffMember.objects.all().bluecard_expiring(30)], ['E2'])
+        self.assertEqual([s.employee_number for s in StaffMember.objects.all().bluecard_valid()], ['E2', 'E3'])
+        self.assertEqual([s.employee_number for s in StaffMember.objects.all().registration_missing()], ['E1'])
+
+    def test_report(self):
+        with self.assertNumQueries(2):
+            report = ComplianceReport(days=30)
+            attention = list(report.attention())
+        self.assertEqual(report.total, 3)
+        self.assertEqual(report.bluecard['expired'], 1)
+        self.assertEqual(report.bluecard['expiring'], 1)
+        self.assertEqual(report.registration['missing'], 1)
+        self.assertEqual(report.registration['not_required'], 1)
+        self.assertEqual([(s.employee_number, s.bluecard_status, s.registration_status) for s in attention],
+                         [('E1', 'expired', 'missing'), ('E2', 'expiring', 'valid')])
+
+    def test_views(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('compliance_report'), {'days': 30})
+        self.assertContains(response, 'Ms Given1 Surname1')
+        stdout = StringIO()
+        call_command('compliance_report', days=30, stdout=stdout)
+        self.assertIn('E2\tMs Given2 Surname2\tblue card expiring', stdout.getvalue())
+
+
+class StaffMemberAdminQueryCountTest(TestCase):
+    '''Admin pages should cost a fixed number of queries however many rows they show'''
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+
+    def add_contacts(self, staff, n, start=0):
+        for i in range(start, start + n):
+            EmailAddress.objects.create(staff_member=staff, address='s{}.{}@example.com'.format(staff.pk, i),
+                                        label='Work', rel=2, primary=i == 0)
+            StaffPhoneNumber.objects.create(staff_member=staff, rel=7, value=400000000 + i, primary=i == 0)
+            Address.objects.create(staff_member=staff, rel=1, label='Home', primary=i == 0, postcode=4000,
+                                   state='QLD', suburb='Brisbane', city='Brisbane', number=str(i), street='Street')
+            NextOfKin.objects.create(staff_member=staff, title='Mr', given_name='Kin', surname='Kin',
+                                     relationship='Spouse', priority=i)
+            Qualification.objects.create(staff_member=staff, label='BEd', institution='QUT',
+                                         date_awarded=date(2000, 1, 1))
+
+    def count_queries(self, url):
+        # warm the content type cache so only per page queries are counted
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist(self):
+        url = reverse('admin:StaffInformation_staffmember_changelist')
+        for n in range(2):
+            self.add_contacts(make_staff(n), 2)
+        few = self.count_queries(url)
+        for n in range(2, 20):
+            self.add_contacts(make_staff(n), 2)
+        self.assertEqual(self.count_queries(url), few)
+        self.assertContains(self.client.get(url), 's{}.0@example.com'.format(StaffMember.objects.get(employee_number='E19').pk))
+
+    def test_change_view(self):
+        staff = make_staff(1)
+        url = reverse('admin:StaffInformation_staffmember_change', args=(staff.pk,))
+        self.add_contacts(staff, 1)
+        few = self.count_queries(url)
+        self.add_contacts(staff, 10, start=1)
+        self.assertEqual(self.count_queries(url), few)
+
+    def test_related_changelists(self):
+        for n in range(2):
+            self.add_contacts(make_staff(n), 1)
+        urls = [reverse('admin:StaffInformation_{}_changelist'.format(name))
+                for name in ('address', 'staffphonenumber', 'nextofkin', 'qualification', 'emailaddress')]
+        few = [self.count_queries(url) for url in urls]
+        for n in range(2, 10):
+            self.add_contacts(make_staff(n), 1)
+        self.assertEqual([self.count_queries(url) for url in urls], few)
+
+
+class StaffSectionTest(TestCase):
+    '''Related rows are fetched and saved a section at a time'''
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.staff = make_staff(1)
+        for n in range(25):
+            Qualification.objects.create(staff_member=self.staff, label='Qualification{}'.format(n),
+                                         institution='QUT', date_awarded=date(2000, 1, 1))
+        self.email = EmailAddress.objects.create(staff_member=self.staff, address='a@example.com', label='Work',
+                                                 rel=2, primary=True)
+
+    def url(self, section):
+        return reverse('admin:StaffInformation_staffmember_section', args=(self.staff.pk, section))
+
+    def test_change_view_defers_sections(self):
+        response = self.client.get(reverse('admin:StaffInformation_staffmember_change', args=(self.staff.pk,)))
+        self.assertNotContains(response, 'Qualification0')
+        self.assertNotContains(response, 'qualifications-TOTAL_FORMS')
+        self.assertContains(response, self.url('qualifications'))
+        # new staff are still added with their inlines
+        response = self.client.get(reverse('admin:StaffInformation_staffmember_add'))
+        self.assertContains(response, 'qualifications-TOTAL_FORMS')
+
+    def test_pages(self):
+        response = self.client.get(self.url('qualifications'))
+        self.assertContains(response, 'Qualification19')
+        self.assertNotContains(response, 'Qualification20')
+        self.assertContains(response, 'Page 1 of 2')
+        response = self.client.get(self.url('qualifications'), {'page': 2})
+        self.assertContains(response, 'Qualification24')
+        self.assertNotContains(response, 'Qualification19')
+        self.assertEqual(self.client.get(self.url('qualifications'), {'page': 3}).status_code, 404)
+        self.assertEqual(self.client.get(self.url('salaries')).status_code, 404)
+        session = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P', title='PD Day')
+        session.mark_attendance([self.staff.pk])
+        self.assertContains(self.client.get(self.url('inservice_records')), 'PD Day')
+
+    def test_save_versions_edited_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url('qualifications'), section_form_data(self.staff, 'qualifications'))
+        self.assertContains(response, 'Saved qualifications.')
+        writes = [q['sql'] for q in queries.captured_queries if 'SELECT' not in q['sql'][:20]]
+        self.assertFalse([sql for sql in writes if 'emailaddress' in sql])
+        # the first page was saved, the second left as it was
+        self.assertEqual(Qualification.objects.filter(label='Benchmark').count(), 20)
+        revision = Revision.objects.get()
+        self.assertEqual(revision.user.username, 'admin')
+        self.assertEqual(sorted(v.object.label for v in revision.version_set.all()), ['Benchmark'] * 20)
+        self.assertFalse(reversion.get_for_object(self.staff).exists())
+        # an unchanged page saves nothing
+        data = section_form_data(self.staff, 'email_addresses', label='Work')
+        self.assertContains(self.client.post(self.url('email_addresses'), data), 'Saved email addresses.')
+        self.assertEqual(Revision.objects.count(), 1)
+
+
+class PrimaryContactTest(TestCase):
+    def setUp(self):
+        self.staff = make_staff(1)
+
+    def email(self, n, primary=False):
+        return EmailAddress.objects.create(staff_member=self.staff, address='{}@example.com'.format(n),
+                                           label='Work', rel=2, primary=primary)
+
+    def primaries(self):
+        return list(self.staff.email_addresses.filter(primary=True).values_list('address', flat=True))
+
+    def email_updates(self, queries):
+        return [q for q in queries.captured_queries
+                if 'UPDATE "StaffInformation_emailaddress"' in q['sql']]
+
+    def test_new_primary_demotes_others_in_one_update(self):
+        self.email(1, primary=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.email(2, primary=True)
+        self.assertEqual(len(self.email_updates(queries)), 1)
+        self.assertEqual(self.primaries(), ['2@example.com'])
+        self.assertEqual(self.staff.primary_email.address, '2@example.com')
+
+    def test_resaving_primary_demotes_concurrent_primary(self):
+        email = self.email(1, primary=True)
+        # another request promotes a sibling after email was read
+        EmailAddress.objects.set_primary([self.email(2)])
+        email.label = 'Home'
+        with CaptureQueriesContext(connection) as queries:
+            email.save()
+        # the save itself and the one UPDATE of the primary flags
+        self.assertEqual(len(self.email_updates(queries)), 2)
+        self.assertEqual(self.primaries(), ['1@example.com'])
+
+    def test_delete_promotes_replacement(self):
+        first = self.email(1, primary=True)
+        self.email(2)
+        self.email(3)
+        first.delete()
+        self.assertEqual(self.primaries(), ['2@example.com'])
+
+    def test_set_primary_bulk(self):
+        other = make_staff(2)
+        emails = [self.email(n, primary=n == 0) for n in range(3)]
+        other_email = EmailAddress.objects.create(staff_member=other, address='other@example.com',
+                                                  label='Work', rel=2, primary=True)
+        with CaptureQueriesContext(connection) as queries:
+            EmailAddress.objects.set_primary([emails[2]])
+        self.assertEqual(len(self.email_updates(queries)), 1)
+        self.assertEqual(self.primaries(), ['2@example.com'])
+        self.assertTrue(EmailAddress.objects.get(pk=other_email.pk).primary)
+
+    def test_primary_from_prefetch(self):
+        self.email(1, primary=True)
+        staff = StaffMember.objects.prefetch_related('email_addresses').get(pk=self.staff.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(staff.primary_email.address, '1@example.com')
+        with self.assertNumQueries(1):
+            self.assertIsNone(staff.primary_address)
+
+
+class StaffSearchTest(TestCase):
+    def setUp(self):
+        self.jane = make_staff(1, legal_given_name='Janet', prefered_given_name='Jane', legal_surname='Smith',
+                               timetable_code='SMJ')
+        self.john = make_staff(2, legal_given_name='John', legal_surname='Smithers', employee_number='E-200')
+        self.zoe = make_staff(3, legal_given_name='Zo\xeb', legal_surname='Citizen')
+        EmailAddress.objects.create(staff_member=self.zoe, address='zcitizen@example.com',
+                                    label='Work', rel=2, primary=True)
+        StaffPhoneNumber.objects.create(staff_member=self.zoe, rel=7, value=412345678, primary=True)
+
+    def results(self, query):
+        return [s.employee_number for s in search(query)]
+
+    def test_prefix_and_rank(self):
+        self.assertEqual(self.results('smith'), ['E1', 'E-200'])
+        self.assertEqual(self.results('jane smi'), ['E1'])
+        self.assertEqual(self.results('smj'), ['E1'])
+
+    def test_typo(self):
+        self.assertEqual(self.results('smtih jnae'), ['E1'])
+        self.assertEqual(self.results('jhon'), ['E-200'])
+
+    def test_identifiers_and_contacts(self):
+        self.assertEqual(self.results('E-200'), ['E-200'])
+        self.assertEqual(self.results('zoe'), ['E3'])
+        self.assertEqual(self.results('zcitizen@example'), ['E3'])
+        self.assertEqual(self.results('0412 345'), ['E3'])
+
+    def test_kept_in_sync(self):
+        self.jane.legal_surname = 'Brown'
+        self.jane.prefered_surname = None
+        self.jane.save()
+        self.assertEqual(self.results('smith'), ['E-200'])
+        self.zoe.email_addresses.get().delete()
+        self.assertEqual(self.results('example'), [])
+        StaffMember.objects.filter(pk=self.john.pk).deactivate()
+        self.assertEqual(self.results('john'), [])
+
+    def test_query_count(self):
+        with self.assertNumQueries(3):
+            self.results('smtih jnae')
+
+    def test_rebuild(self):
+        SearchTerm.objects.all().delete()
+        self.assertEqual(rebuild_index(), 3)
+        self.assertEqual(self.results('smith'), ['E1', 'E-200'])
+
+    def test_admin_search(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('admin:StaffInformation_staffmember_changelist'), {'q': 'smtih'})
+        self.assertContains(response, 'Ms Jane Smith')
+        self.assertNotContains(response, 'Citizen')
+        response = self.client.get(reverse('search_staff'), {'q': 'jon'})
+        self.assertEqual([r['id'] for r in json.loads(response.content.decode('utf-8'))['results']], [self.john.pk])
+
+
+class StaffProfileTest(TestCase):
+    def setUp(self):
+        profile_cache().clear()
+        self.staff = [make_staff(n) for n in range(3)]
+        for staff in self.staff:
+            EmailAddress.objects.create(staff_member=staff, address='s{}@example.com'.format(staff.pk),
+                                        label='Work', rel=2, primary=True)
+        self.kin = NextOfKin.objects.create(staff_member=self.staff[0], title='Mr', given_name='Kin',
+                                            surname='Surname0', relationship='Brother', priority=1)
+        self.standard = InserviceStandard.objects.create(number=1, label='First Aid')
+        self.session = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P',
+                                                       title='CPR')
+        self.session.mark_attendance([self.staff[0]])
+        reset_stats()
+
+    def test_profile(self):
+        profile = get_profile(self.staff[0].pk)
+        self.assertEqual(profile['display_name'], 'Ms Given0 Surname0')
+        self.assertEqual(profile['age']['years'], self.staff[0].age.years)
+        self.assertTrue(profile['valid_bluecard'])
+        self.assertEqual(profile['email_addresses'][0]['address'], 's{}@example.com'.format(self.staff[0].pk))
+        self.assertEqual(profile['next_of_kin'][0]['given_name'], 'Kin')
+        self.assertEqual(profile['inservice_records'][0]['title'], 'CPR')
+        self.assertEqual(get_profile(0), None)
+
+    def test_served_from_cache(self):
+        pks = [s.pk for s in self.staff]
+        get_profiles(pks)
+        with self.assertNumQueries(0):
+            self.assertEqual([p['id'] for p in get_profiles(pks)], pks)
+        self.assertEqual((stats()['hits'], stats()['misses']), (3, 3))
+
+    def test_build_query_count(self):
+        # staff, seven related sets, next of kin phones, inservice sessions and
+        # their standards
+        with self.assertNumQueries(11):
+            get_profiles([s.pk for s in self.staff])
+
+    def assertInvalidated(self, change, staff=None):
+        staff = staff or self.staff[0]
+        get_profiles([s.pk for s in self.staff])
+        change()
+        cache = profile_cache()
+        self.assertEqual(cache.get('staff_profile:{}'.format(staff.pk)), None)
+        for other in self.staff:
+            if other != staff:
+                self.assertNotEqual(cache.get('staff_profile:{}'.format(other.pk)), None)
+
+    def test_invalidation(self):
+        staff = self.staff[0]
+        self.assertInvalidated(staff.save)
+        self.assertInvalidated(lambda: EmailAddress.objects.create(staff_member=staff, address='x@example.com',
+                                                                   label='Home', rel=1))
+        self.assertInvalidated(lambda: self.kin.phone_numbers.create(rel=7, value=412345678))
+        self.assertInvalidated(lambda: DoorKey.objects.create(owner=staff, number=1, kind=0))
+        self.assertInvalidated(self.session.save)
+        self.assertInvalidated(lambda: self.session.standards.add(self.standard))
+        self.assertInvalidated(lambda: self.standard.sessions.clear())
+        self.session.standards.add(self.standard)
+        self.assertInvalidated(lambda: self.standard.delete())
+        self.assertInvalidated(lambda: EmailAddress.objects.set_primary([staff.email_addresses.last()]))
+        self.assertInvalidated(lambda: StaffMember.objects.filter(pk=self.staff[1].pk).deactivate(),
+                               staff=self.staff[1])
+        self.assertEqual(len(get_profiles([s.pk for s in self.staff])), 2)
+
+    def test_views(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('staff_directory'))
+        self.assertContains(response, 'Ms Given1 Surname1')
+        response = self.client.get(reverse('staff_profile', args=[self.staff[0].pk]))
+        self.assertContains(response, 'Kin Surname0')
+        self.assertContains(response, 'CPR')
+        self.assertEqual(self.client.get(reverse('staff_profile', args=[0])).status_code, 404)
+
+    def test_warm_command(self):
+        out = StringIO()
+        call_command('warm_profiles', stdout=out)
+        self.assertIn('Cached 3 staff profiles.', out.getvalue())
+        with self.assertNumQueries(0):
+            get_profiles([s.pk for s in self.staff])
+
+
+class StaffApiTest(TestCase):
+    def setUp(self):
+        profile_cache().clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.staff = [make_staff(n, legal_surname='Surname{:02}'.format(n % 7)) for n in range(12)]
+        EmailAddress.objects.create(staff_member=self.staff[0], address='s0@example.com', label='Work', rel=2,
+                                    primary=True)
+
+    def get(self, url, data=None, **headers):
+        response = self.client.get(url, data or {}, **headers)
+        content = json.loads(response.content.decode('utf-8')) if response.status_code == 200 else None
+        return response, content
+
+    def test_keyset_pages(self):
+        url, seen = reverse('api_staff'), []
+        data = {'limit': 5, 'fields': 'employee_number'}
+        while url:
+            response, content = self.get(url, data)
+            seen.extend(r['employee_number'] for r in content['results'])
+            self.assertEqual(set(content['results'][0]), set(['id', 'employee_number']))
+            url, data = content['next'], None
+        expected = sorted(self.staff, key=lambda s: (s.legal_surname, s.legal_given_name, s.pk))
+        self.assertEqual(seen, [s.employee_number for s in expected])
+
+    def test_deep_page_queries(self):
+        # the page and its validators, the staff and one related set
+        _, first = self.get(reverse('api_staff'), {'limit': 2, 'fields': 'email_addresses'})
+        # and the session and user for staff_member_required
+        with self.assertNumQueries(5):
+            response, second = self.get(first['next'])
+        self.assertEqual(len(second['results']), 2)
+        self.assertEqual(self.client.get(reverse('api_staff'), {'cursor': 'bad'}).status_code, 400)
+        self.assertEqual(self.client.get(reverse('api_staff'), {'fields': 'password'}).status_code, 400)
+
+    def test_every_field(self):
+        StaffMember.objects.filter(pk=self.staff[1].pk).update(supervisor=self.staff[0])
+        fields = FIELD_COLUMNS + sorted(RELATED_COLUMNS) + sorted(COMPUTED_COLUMNS)
+        _, content = self.get(reverse('api_staff_detail', args=[self.staff[1].pk]), {'fields': ','.join(fields)})
+        self.assertEqual(content['supervisor_id'], self.staff[0].pk)
+
+    def test_conditional_get(self):
+        url = reverse('api_staff_detail', args=[self.staff[0].pk])
+        response, content = self.get(url, {'fields': 'display_name,email_addresses'})
+        self.assertEqual(content['email_addresses'][0]['address'], 's0@example.com')
+        etag = response['ETag']
+        with self.assertNumQueries(3):
+            response, _ = self.get(url, {'fields': 'display_name,email_addresses'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # the ETag comes from the database, not from one process's cache
+        profile_cache().clear()
+        response, _ = self.get(url, {'fields': 'display_name,email_addresses'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # other fields and changed related rows give a new ETag
+        response, _ = self.get(url, {'fields': 'display_name'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        EmailAddress.objects.create(staff_member=self.staff[0], address='x@example.com', label='Home', rel=1)
+        response, _ = self.get(url, {'fields': 'display_name,email_addresses'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_last_modified(self):
+        StaffMember.objects.update(updated=date(2014, 1, 1))
+        url = reverse('api_staff')
+        response, _ = self.get(url)
+        self.assertEqual(response['Last-Modified'], 'Wed, 01 Jan 2014 00:00:00 GMT')
+        response, _ = self.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        # related changes count as changes to the staff member
+        EmailAddress.objects.create(staff_member=self.staff[3], address='x@example.com', label='Home', rel=1)
+        self.assertEqual(StaffMember.objects.get(pk=self.staff[3].pk).updated, date.today())
+        response, _ = self.get(url, HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2014 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('api_staff_detail', args=[0])).status_code, 404)
+
+
+class GeneratorBenchmarkTest(TestCase):
+    def test_generate(self):
+        counts = StaffGenerator(seed=1).generate(20, keys_per_staff=2, sessions=3)
+        self.assertEqual(counts['errors'], [])
+        self.assertEqual(StaffMember.objects.count(), 20)
+        self.assertEqual(DoorKey.objects.count(), counts['keys'])
+        self.assertEqual(InserviceRecord.objects.count(), counts['attendance'])
+        self.assertEqual(EmailAddress.objects.filter(primary=True).count(), 20)
+        staff = StaffMember.objects.order_by('pk')[0]
+        self.assertEqual(len(reversion.get_for_object(staff)), 1)
+        self.assertIn(staff.pk, [s.pk for s in search(staff.legal_surname)])
+        # the same seed generates the same staff, numbered after the existing ones
+        StaffGenerator(seed=1).generate(20, keys_per_staff=2, sessions=3)
+        surnames = list(StaffMember.objects.order_by('pk').values_list('legal_surname', flat=True))
+        self.assertEqual(surnames[20:], surnames[:20])
+
+    def test_benchmark(self):
+        StaffGenerator().generate(5, sessions=1)
+        staff = StaffMember.objects.order_by('pk')[0]
+        results = Benchmark(repeat=2, batch_size=3).run()
+        self.assertEqual(results['staff'], 5)
+        for name, result in results['scenarios'].items():
+            self.assertIn(result['status'], [None, 200, 302], name)
+            self.assertEqual(len(result['runs']), 2)
+            self.assertGreater(result['queries'], 0, name)
+        # every run was rolled back
+        self.assertEqual(StaffMember.objects.count(), 5)
+        self.assertEqual(staff.email_addresses.get(primary=True).label, 'Work')
+        self.assertFalse(User.objects.exists())
+
+    def test_commands(self):
+        stdout = StringIO()
+        call_command('generate_staff', count=3, sessions=1, stdout=stdout)
+        self.assertIn('Generated 3 staff', stdout.getvalue())
+        with tempfile.NamedTemporaryFile(suffix='.json') as f:
+            call_command('benchmark_staff', 'changelist', 'change_save', repeat=1, output=f.name, stdout=StringIO())
+            results = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(list(results['scenarios']), ['changelist', 'change_save'])
+        self.assertEqual(results['scenarios']['change_save']['status'], 302)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RequestInstrumentationTest(TestCase):
+    def setUp(self):
+        reset_request_stats()
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.staff = make_staff(1)
+
+    def stats(self):
+        return dict((row['view'], row) for row in request_stats())
+
+    def test_duplicates(self):
+        recorder = RequestRecorder()
+        recorder.install()
+        try:
+            for pk in [1, 1, 2]:
+                list(StaffMember.objects.filter(pk=pk))
+            with CaptureQueriesContext(connection) as queries:
+                list(StaffMember.objects.all())
+        finally:
+            recorder.uninstall()
+        self.assertEqual(len(queries), 1)
+        summary = recorder.summary()
+        self.assertEqual((summary['queries'], summary['duplicates']), (4, 1))
+        self.assertEqual([n for sql, n in summary['repeated']], [3])
+
+    def test_stats_per_view(self):
+        url = reverse('admin:StaffInformation_staffmember_change', args=(self.staff.pk,))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.client.post(url, dict(change_form_data(self.staff), middle_name='Changed'))
+        stats = self.stats()['admin:StaffInformation_staffmember_change']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreaterEqual(stats['queries'], len(queries))
+        self.assertEqual(stats['revisions'], 1)
+        self.assertEqual(stats['slow'], 0)
+        out = StringIO()
+        call_command('request_stats', reset=True, stdout=out)
+        self.assertIn('admin:StaffInformation_staffmember_change', out.getvalue())
+        self.assertEqual(request_stats(), [])
+
+    def test_slow_request_log(self):
+        handler = ListHandler()
+        logger = logging.getLogger('StaffInformation.instrumentation')
+        # replace the slow request log file while testing
+        handlers, logger.handlers = logger.handlers, [handler]
+        try:
+            with override_settings(SLOW_REQUEST_MS=0):
+                self.client.get(reverse('admin:StaffInformation_staffmember_changelist'))
+        finally:
+            logger.handlers = handlers
+        self.assertEqual(len(handler.records), 1)
+        self.assertIn('Slow request GET /admin/StaffInformation/staffmember/', handler.records[0].getMessage())
+        self.assertIn('SELECT', handler.records[0].getMessage())
+        self.assertNotIn('args=', handler.records[0].getMessage())
+        self.assertEqual(self.stats()['admin:StaffInformation_staffmember_changelist']['slow'], 1)
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        self.staff = make_staff(1)
+        self.email = EmailAddress.objects.create(staff_member=self.staff, address='a@example.com', label='Work', rel=2)
+
+    def save_revision(self, *objects, **kwargs):
+        return reversion.default_revision_manager.save_revision(list(objects), **kwargs)
+
+    def test_skip_unchanged(self):
+        self.save_revision(self.staff, self.email)
+        self.email.label = 'Home'
+        self.email.save()
+        revision = self.save_revision(self.staff, self.email)
+        self.assertEqual([v.object for v in revision.version_set.all()], [self.email])
+        # a revision of objects that are all unchanged keeps them
+        revision = self.save_revision(self.staff)
+        self.assertEqual(revision.version_set.count(), 1)
+        with self.settings(REVERSION_SKIP_UNCHANGED=False):
+            self.assertEqual(self.save_revision(self.staff, self.email).version_set.count(), 2)
+
+    def test_compact(self):
+        created = [datetime(2013, 6, 3), datetime(2013, 6, 20), datetime(2013, 7, 1),
+                   datetime(2014, 8, 1, 10), datetime(2014, 8, 1, 15), datetime(2014, 12, 20), datetime(2014, 12, 21)]
+        revisions = []
+        for n, when in enumerate(created):
+            self.staff.middle_name = 'Version{}'.format(n)
+            self.staff.save()
+            revision = self.save_revision(self.staff)
+            Revision.objects.filter(pk=revision.pk).update(date_created=when.replace(tzinfo=timezone.utc))
+            revisions.append(revision.pk)
+        policy = RetentionPolicy(keep_all_days=30, keep_daily_days=365)
+        self.assertEqual(compact_history(policy, today=date(2014, 12, 31), batch_size=2, dry_run=True),
+                         {'versions': 2, 'revisions': 0})
+        self.assertEqual(compact_history(policy, today=date(2014, 12, 31), batch_size=2),
+                         {'versions': 2, 'revisions': 2})
+        self.assertEqual(sorted(Revision.objects.values_list('pk', flat=True)),
+                         [pk for n, pk in enumerate(revisions) if n not in (0, 3)])
+        self.assertEqual(reversion.get_for_object(self.staff).order_by('-pk')[0].field_dict['middle_name'], 'Version6')
+        self.assertEqual(compact_history(policy, today=date(2014, 12, 31)), {'versions': 0, 'revisions': 0})
+        out = StringIO()
+        call_command('compact_history', keep_all_days=0, keep_daily_days=0, stdout=out)
+        self.assertIn('Deleted 1 versions and 1 revisions.', out.getvalue())
+
+
+class StaffRosterTest(TestCase):
+    def setUp(self):
+        self.a = make_staff(1, bluecard_expiry=date(2014, 6, 1))
+        self.b = make_staff(2, timetable_code='BB')
+        self.revisions = [self.save_revision(self.a, self.b)]
+        self.between = timezone.now()
+        self.a.bluecard_expiry = date(2017, 6, 1)
+        self.a.save()
+        self.revisions.append(self.save_revision(self.a))
+        StaffMember.objects.filter(pk=self.b.pk).deactivate()
+
+    def save_revision(self, *objects):
+        return reversion.default_revision_manager.save_revision(list(objects))
+
+    def roster(self, moment):
+        return sorted((s.employee_number, s.bluecard_expiry, s.active) for s in roster_as_of(moment))
+
+    def test_snapshots_follow_revisions(self):
+        self.assertEqual(self.roster(self.between), [('E1', date(2014, 6, 1), True), ('E2', date(2030, 1, 1), True)])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.roster(timezone.now()), [('E1', date(2017, 6, 1), True),
+                                                          ('E2', date(2030, 1, 1), False)])
+        self.assertEqual(StaffSnapshot.objects.count(), 4)
+
+    def test_rebuild_and_report(self):
+        for revision, when in zip(Revision.objects.order_by('pk'), [datetime(2014, 1, 10), datetime(2014, 5, 15),
+                                                                     datetime(2014, 8, 1)]):
+            Revision.objects.filter(pk=revision.pk).update(date_created=when.replace(tzinfo=timezone.utc))
+        self.assertEqual(rebuild_snapshots(batch_size=1), 4)
+        self.assertEqual(self.roster(date(2014, 1, 9)), [])
+        self.assertEqual(self.roster(date(2014, 5, 15)), [('E1', date(2017, 6, 1), True),
+                                                          ('E2', date(2030, 1, 1), True)])
+        report = compliance_as_of(date(2014, 5, 1))
+        self.assertEqual((report.total, report.bluecard['expiring'], report.registration['missing']), (2, 1, 1))
+        self.assertEqual(compliance_as_of(date(2014, 9, 1)).total, 1)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('staff_roster'), {'date': '2014-05-01'})
+        self.assertContains(response, 'Given2')
+        self.assertContains(response, 'expiring')
+        self.assertEqual(self.client.get(reverse('staff_roster'), {'date': 'May'}).status_code, 400)
+        out = StringIO()
+        call_command('staff_roster', date='2014-09-01', all=True, stdout=out)
+        self.assertIn('1 active staff as at 2014-09-01', out.getvalue())
+        self.assertIn('E2\tMs Given2 Surname2\tinactive', out.getvalue())
+
+
+class StaffScheduleTest(TestCase):
+    def setUp(self):
+        self.full = make_staff(1, timetable_code='FT')
+        # works Monday, Wednesday and Friday, 19 hours a week
+        self.part = make_staff(2, timetable_code='PT', weekly_hours_worked=19,
+                               works_tuesday=False, works_thursday=False)
+        self.office = make_staff(3, works_friday=False)
+
+    def employee_numbers(self, queryset):
+        return sorted(queryset.values_list('employee_number', flat=True))
+
+    def test_schedule_follows_working_days(self):
+        self.assertEqual(StaffMember.objects.get(pk=self.part.pk).schedule, 0b10101)
+        StaffMember.objects.bulk_create([StaffMember(title='Mr', legal_given_name='Bulk', legal_surname='Created',
+                                                     dob=date(1980, 1, 1), employee_number='E4',
+                                                     bluecard_expiry=date(2030, 1, 1), works_monday=False)])
+        self.assertEqual(StaffMember.objects.get(employee_number='E4').schedule, 0b11110)
+        # 2014-06-05 is a Thursday, 2014-06-07 a Saturday
+        self.assertEqual(self.employee_numbers(StaffMember.objects.all().working_on(date(2014, 6, 5))), ['E1', 'E3', 'E4'])
+        self.assertEqual(self.employee_numbers(StaffMember.objects.all().working_on(0)), ['E1', 'E2', 'E3'])
+        self.assertEqual(self.employee_numbers(StaffMember.objects.all().working_on(date(2014, 6, 7))), [])
+
+        StaffMember.objects.filter(pk=self.full.pk).update(works_thursday=False)
+        out = StringIO()
+        call_command('sync_computed_columns', stdout=out)
+        self.assertIn('Updated the computed columns of 4 staff.', out.getvalue())
+        self.assertEqual(StaffMember.objects.get(pk=self.full.pk).schedule, 0b10111)
+        self.assertEqual(self.employee_numbers(StaffMember.objects.all().working_on(3)), ['E3', 'E4'])
+
+    def test_coverage_and_relief(self):
+        with self.assertNumQueries(1):
+            days = coverage()
+        self.assertEqual([days[day]['headcount'] for day in days], [3, 2, 3, 2, 2])
+        # 19 hours over three days is 5/6 of a full time day, 38 over four 5/4
+        self.assertAlmostEqual(days['monday']['fte'], 1 + 5 / 6.0 + 5 / 4.0)
+        self.assertAlmostEqual(days['tuesday']['fte'], 1 + 5 / 4.0)
+
+        with self.assertNumQueries(1):
+            plan = ReliefPlan(date(2014, 6, 5))
+        self.assertEqual([t.timetable_code for t in plan.rostered], ['FT'])
+        self.assertEqual([t.timetable_code for t in plan.available], ['PT'])
+        self.assertAlmostEqual(plan.rostered_fte, 1.0)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('relief_planning'), {'date': '2014-06-05'})
+        self.assertContains(response, 'Given2')
+        self.assertContains(response, '1 teachers rostered')
+        self.assertEqual(self.client.get(reverse('relief_planning'), {'date': 'Thursday'}).status_code, 400)
+
+
+class DemographicsTest(TestCase):
+    def setUp(self):
+        self.on = date(2015, 12, 30)
+        make_staff(1, dob=date(1950, 1, 2))
+        make_staff(2, dob=date(1984, 2, 29))
+        make_staff(3, dob=date(1990, 12, 30))
+        make_staff(4, dob=date(1995, 6, 15))
+        StaffMember.objects.filter(employee_number='E1').update(created=date(1994, 12, 31))
+        StaffMember.objects.filter(employee_number='E2').update(created=date(2010, 12, 30))
+
+    def ages(self, queryset):
+        return dict(queryset.values_list('employee_number', 'age_years'))
+
+    def test_ages_match_relativedelta(self):
+        for on in [self.on, date(2016, 2, 28), date(2016, 2, 29), date(2017, 2, 28), date(2017, 3, 1)]:
+            ages = self.ages(StaffMember.objects.all().with_age(on=on))
+            for staff in StaffMember.objects.all():
+                self.assertEqual(ages[staff.employee_number], relativedelta(on, staff.dob).years)
+                self.assertEqual(StaffMember.objects.all().aged(ages[staff.employee_number],
+                                                                ages[staff.employee_number], on=on)
+                                                          .filter(pk=staff.pk).exists(), True)
+        self.assertEqual(sorted(StaffMember.objects.all().aged(25, 31, on=self.on)
+                                                  .values_list('employee_number', flat=True)), ['E2', 'E3'])
+        self.assertEqual(list(StaffMember.objects.all().retirement_eligible(on=self.on)
+                                                 .values_list('employee_number', flat=True)), ['E1'])
+        service = dict(StaffMember.objects.all().with_service(on=self.on)
+                                              .values_list('employee_number', 'service_years'))
+        self.assertEqual((service['E1'], service['E2']), (20, 5))
+        self.assertEqual(list(StaffMember.objects.all().served(minimum=10, on=self.on)
+                                                 .values_list('employee_number', flat=True)), ['E1'])
+
+    def test_birthdays_wrap_the_year(self):
+        birthdays = StaffMember.objects.all().birthdays_between(self.on, date(2016, 1, 5))
+        self.assertEqual([s.employee_number for s in birthdays], ['E3', 'E1'])
+        leap = StaffMember.objects.all().birthdays_between(date(2017, 2, 20), date(2017, 2, 28))
+        self.assertEqual([s.employee_number for s in leap], ['E2'])
+        StaffMember.objects.filter(employee_number='E4').update(dob=date(1995, 6, 16))
+        self.assertEqual(StaffMember.objects.all().birthdays_between(date(2016, 6, 16), date(2016, 6, 16)).count(), 0)
+        StaffMember.objects.all().sync_computed_columns()
+        self.assertEqual(StaffMember.objects.all().birthdays_between(date(2016, 6, 16), date(2016, 6, 16)).count(), 1)
+
+    def test_report(self):
+        with self.assertNumQueries(2):
+            report = DemographicsReport(on=self.on)
+        self.assertEqual(report.total, 4)
+        self.assertEqual(list(report.age_bands.values()), [1, 2, 0, 0, 0, 1])
+        self.assertEqual(list(report.service_bands.values()), [2, 0, 1, 0, 1])
+        self.assertEqual(report.retirement_eligible, 1)
+        self.assertEqual([(s.employee_number, s.age_years) for s in report.birthdays()], [('E3', 25), ('E1', 66)])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('demographics_report'), {'date': '2015-12-30'})
+        self.assertContains(response, '4 active staff as at')
+        self.assertContains(response, 'Given1')
+        self.assertEqual(self.client.get(reverse('demographics_report'), {'date': 'soon'}).status_code, 400)
+
+
+class CountingEmailBackend(EmailBackend):
+    '''The test email backend, counting the connections opened'''
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class ExpiryNotificationTest(TestCase):
+    def setUp(self):
+        self.on = date(2014, 6, 1)
+        self.supervisor = make_staff(1)
+        self.add_email(self.supervisor, 'boss@example.com')
+        self.expiring = make_staff(2, bluecard_expiry=date(2014, 6, 20), supervisor=self.supervisor,
+                                   timetable_code='EX', teacher_registration_expiry=date(2014, 7, 20))
+        self.add_email(self.expiring, 'expiring@example.com')
+        self.expired = make_staff(3, bluecard_expiry=date(2014, 5, 1))
+        # no email address and no supervisor
+        make_staff(4, bluecard_expiry=date(2014, 6, 2))
+        CountingEmailBackend.opened = 0
+
+    def add_email(self, staff, address):
+        EmailAddress.objects.create(staff_member=staff, address=address, label='Work', rel=2, primary=True)
+
+    def send(self, on, **kwargs):
+        mail.outbox = []
+        return ExpiryNotifier(on=on, connection=CountingEmailBackend(), **kwargs).send()
+
+    def test_reminders_sent_once(self):
+        counts = self.send(self.on, batch_size=2)
+        self.assertEqual(counts, {'messages': 1, 'reminders': 2, 'unreachable': 2})
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        message = mail.outbox[0]
+        self.assertEqual((message.to, message.cc), (['expiring@example.com'], ['boss@example.com']))
+        self.assertEqual(message.subject, 'Blue Card and Teacher Registration expiry reminder for Ms Given2 Surname2')
+        self.assertIn('Your blue card expires on 20 June 2014, in 19 days.', message.body)
+        self.assertEqual(set(ExpiryNotification.objects.values_list('kind', 'days')),
+                         set([('bluecard', 30), ('registration', 60)]))
+
+        self.assertEqual(self.send(self.on)['messages'], 0)
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(self.send(date(2014, 6, 14))['reminders'], 1)
+        self.assertIn('in 6 days', mail.outbox[0].body)
+
+        # the expired blue card is reminded about once it has an address
+        self.add_email(self.expired, 'expired@example.com')
+        self.assertEqual(self.send(date(2014, 6, 14))['reminders'], 1)
+        self.assertIn('expired on 1 May 2014', mail.outbox[0].body)
+
+    def test_queries_per_batch(self):
+        # staff, reminders sent, supervisor emails, the insert and the empty next batch
+        with self.assertNumQueries(5):
+            self.send(self.on)
+        for n in range(5, 15):
+            self.add_email(make_staff(n, bluecard_expiry=date(2014, 6, 10), supervisor=self.supervisor),
+                           'staff{}@example.com'.format(n))
+        with self.assertNumQueries(5):
+            counts = self.send(date(2014, 6, 15))
+        self.assertEqual(counts['messages'], 11)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('send_expiry_reminders', date='2014-06-01', dry_run=True, stdout=out)
+        self.assertIn('Would send 1 emails with 2 reminders, 2 staff', out.getvalue())
+        self.assertEqual(ExpiryNotification.objects.count(), 0)
+        call_command('send_expiry_reminders', date='2014-06-01', stdout=out)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(ExpiryNotification.objects.count(), 2)
+
+
+class DuplicateTest(TestCase):
+    def setUp(self):
+        self.robert = make_staff(1, legal_given_name='Robert', legal_surname='Smith', dob=date(1970, 3, 4))
+        # entered again under his preferred name
+        self.bob = make_staff(2, prefered_given_name='Bob', legal_given_name='Rob', legal_surname='Smith',
+                              dob=date(1970, 3, 4))
+        self.jane = make_staff(3, legal_given_name='Jane', legal_surname='Doe', dob=date(1985, 6, 7))
+        # a typo in the surname, day and month swapped, the same email address
+        self.jane_again = make_staff(4, legal_given_name='Jane', legal_surname='Do', dob=date(1985, 7, 6))
+        # same surname and date of birth, a different person
+        make_staff(5, legal_given_name='Zachary', legal_surname='Smith', dob=date(1970, 3, 4))
+        for staff in (self.jane, self.jane_again):
+            EmailAddress.objects.create(staff_member=staff, address='jane@example.com', label='Work', rel=2,
+                                        primary=True)
+
+    def test_soundex(self):
+        self.assertEqual([soundex(name) for name in ('robert', 'rupert', 'ashcraft', 'tymczak', 'a')],
+                         ['R163', 'R163', 'A261', 'T522', 'A000'])
+
+    def test_find_duplicates(self):
+        with self.assertNumQueries(3):
+            matches = find_duplicates()
+        self.assertEqual([(m.first.key, m.second.key, m.reasons) for m in matches],
+                         [(self.robert.pk, self.bob.pk, ['similar name', 'same date of birth']),
+                          (self.jane.pk, self.jane_again.pk, ['similar name', 'similar date of birth',
+                                                              'shared email address'])])
+        # blocks larger than max_block_size are not compared
+        self.assertEqual(DuplicateFinder(max_block_size=1).load().matches(), [])
+        out = StringIO()
+        call_command('find_duplicates', stdout=out)
+        self.assertIn('2 possible duplicates.', out.getvalue())
+
+    def test_import_check(self):
+        records = [(1, {'employee_number': 'E9', 'bluecard_number': 'B9', 'title': 'Mr', 'legal_given_name': 'Robert',
+                        'legal_surname': 'Smith', 'dob': '1970-03-04', 'bluecard_expiry': '2030-01-01'}),
+                   (2, {'employee_number': 'E10', 'bluecard_number': 'B10', 'title': 'Ms', 'legal_given_name': 'Ann',
+                        'legal_surname': 'Lee', 'dob': '1990-01-01', 'bluecard_expiry': '2030-01-01'}),
+                   (3, {'employee_number': 'E11', 'bluecard_number': 'B11', 'title': 'Ms', 'legal_given_name': 'Anne',
+                        'legal_surname': 'Lee', 'dob': '1990-01-01', 'bluecard_expiry': '2030-01-01'})]
+        result = StaffImporter(dry_run=True).run(records)
+        self.assertEqual([(e.line, e.message) for e in result.errors],
+                         [(1, 'Possibly the same person as Ms Robert Smith (E1), scoring 0.80 '
+                              '(same name, same date of birth).'),
+                          (3, 'Possibly the same person as line 2, scoring 0.78 (similar name, same date of birth).')])
+        self.assertEqual(StaffImporter(dry_run=True, check_duplicates=False).run(records).errors, [])
+
+    def test_merge(self):
+        EmailAddress.objects.create(staff_member=self.robert, address='robert@example.com', label='Work', rel=2,
+                                    primary=True)
+        EmailAddress.objects.create(staff_member=self.bob, address='bob@example.com', label='Home', rel=1,
+                                    primary=True)
+        for staff in (self.robert, self.bob):
+            NextOfKin.objects.create(staff_member=staff, title='Mrs', given_name='Kin', surname='Smith',
+                                     relationship='Spouse', priority=1)
+        DoorKey.objects.create(owner=self.bob, number=7, kind=0)
+        make_staff(6, supervisor=self.bob)
+        both = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P', title='PD Day')
+        only_bob = InserviceSession.objects.create(date=date(2014, 2, 1), duration=30, presenter='P', title='CPR')
+        both.mark_attendance([self.robert, self.bob])
+        only_bob.mark_attendance([self.bob])
+
+        self.assertEqual(merge_staff(self.robert, [self.bob]), 5)
+        self.assertFalse(StaffMember.all_objects.get(pk=self.bob.pk).active)
+        self.assertEqual(sorted(self.robert.email_addresses.values_list('address', 'primary')),
+                         [('bob@example.com', False), ('robert@example.com', True)])
+        self.assertEqual(list(self.robert.next_of_kin.values_list('priority', flat=True)), [1, 2])
+        self.assertEqual(DoorKey.objects.get().owner_id, self.robert.pk)
+        self.assertEqual(StaffMember.objects.get(employee_number='E6').supervisor_id, self.robert.pk)
+        self.assertEqual(sorted(self.robert.inservice_records.values_list('session__title', flat=True)),
+                         ['CPR', 'PD Day'])
+        self.assertFalse(InserviceRecord.objects.filter(staff_member=self.bob).exists())
+        hours = sorted(InserviceHours.objects.values_list('staff_member', 'year', 'minutes', 'records'))
+        rebuild_hours()
+        self.assertEqual(hours, sorted(InserviceHours.objects.values_list('staff_member', 'year', 'minutes',
+                                                                          'records')))
+        self.assertEqual([s.pk for s in search('bob@example.com')], [self.robert.pk])
+
+    def test_merge_clashing_attendance(self):
+        standard = InserviceStandard.objects.create(number=1, label='First Aid')
+        session = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P', title='CPR')
+        session.standards.add(standard)
+        session.mark_attendance([self.robert, self.bob])
+        merge_staff(self.robert, [self.bob])
+        self.assertEqual(sorted(InserviceHours.objects.values_list('staff_member', 'standard', 'year', 'minutes',
+                                                                   'records')),
+                         [(self.robert.pk, None, 2014, 60, 1), (self.robert.pk, standard.pk, 2014, 60, 1)])
+
+    def test_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('duplicate_staff'))
+        self.assertContains(response, 'Ms Bob Smith (E2)')
+        response = self.client.post(reverse('duplicate_staff'), {'keep': self.jane.pk, 'merge': self.jane_again.pk})
+        self.assertRedirects(response, reverse('duplicate_staff'))
+        self.assertFalse(StaffMember.all_objects.get(pk=self.jane_again.pk).active)
+        self.assertEqual(len(self.client.get(reverse('duplicate_staff')).context['matches']), 1)
+        self.assertEqual(self.client.post(reverse('duplicate_staff'), {'keep': 'x'}).status_code, 400)
+
+
+TIMETABLER_CSV = '''Code,Title,First Name,Last Name,Days
+AB,Ms,Alice,Brown,Mon Tue Wed Thu Fri
+CD,Mr,Chris,Dean,"M,W,F"
+EF,Ms,Eve,Field,Mon Tue Wed Thu Fri
+ZZ,Mr,Nobody,Known,
+'''
+
+
+class TimetablerSyncTest(TestCase):
+    def setUp(self):
+        self.alice = make_staff(1, legal_given_name='Alice', legal_surname='Brown', timetable_code='AB')
+        # known as Chris, works every day in StaffMinder
+        self.chris = make_staff(2, title='Mr', legal_given_name='Christopher', legal_surname='Dean',
+                                timetable_code='CD')
+        self.gone = make_staff(3, legal_given_name='Gina', legal_surname='Gone', timetable_code='GG')
+        # no code yet
+        self.eve = make_staff(4, legal_given_name='Eve', legal_surname='Field')
+
+    def read(self, text=TIMETABLER_CSV):
+        teachers, errors, unreadable = read_export(BytesIO(text.encode('utf-8')))
+        self.assertEqual((errors, unreadable), ([], []))
+        return teachers
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days('Tu Thurs'), {'works_monday': False, 'works_tuesday': True,
+                                                  'works_wednesday': False, 'works_thursday': True,
+                                                  'works_friday': False})
+        self.assertIsNone(parse_days(''))
+        self.assertRaises(ValueError, parse_days, 'T')
+
+    def test_diff_and_apply(self):
+        sync = TimetablerSync()
+        with self.assertNumQueries(2):
+            diff = sync.diff(self.read())
+        self.assertEqual([(c.kind, c.code, list(c.fields)) for c in diff.changes],
+                         [('changed', 'CD', ['prefered_given_name', 'works_thursday', 'works_tuesday']),
+                          ('new', 'EF', ['timetable_code']),
+                          ('departed', 'GG', ['timetable_code'])])
+        self.assertEqual(([t.code for t in diff.unmatched], diff.unchanged), (['ZZ'], 1))
+
+        revisions = Revision.objects.count()
+        self.assertEqual(sync.apply(diff), 3)
+        self.assertEqual(Revision.objects.count(), revisions + 1)
+        chris = StaffMember.objects.get(pk=self.chris.pk)
+        self.assertEqual((chris.display_name, chris.schedule), ('Mr Chris Dean', 0b10101))
+        self.assertEqual(StaffMember.objects.get(pk=self.eve.pk).timetable_code, 'EF')
+        gone = StaffMember.objects.get(pk=self.gone.pk)
+        self.assertEqual((gone.timetable_code, gone.active), (None, True))
+        self.assertEqual([s.pk for s in search('chris')], [self.chris.pk])
+
+        # a second sync of the same file changes nothing
+        diff = sync.diff(self.read())
+        self.assertEqual((diff.changes, diff.unchanged), ([], 3))
+        self.assertEqual(sync.apply(diff), 0)
+        self.assertEqual(Revision.objects.count(), revisions + 1)
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(TIMETABLER_CSV.encode('utf-8'))
+            f.flush()
+            out = StringIO()
+            call_command('sync_timetabler', f.name, dry_run=True, stdout=out)
+            self.assertIn('Dry run: 1 new, 1 changed, 1 departed, 1 unmatched, 1 unchanged.', out.getvalue())
+            self.assertIn('unmatched\tZZ\tNobody Known', out.getvalue())
+            self.assertIsNone(StaffMember.objects.get(pk=self.eve.pk).timetable_code)
+            call_command('sync_timetabler', f.name, deactivate_departures=True, stdout=out)
+        self.assertFalse(StaffMember.all_objects.get(pk=self.gone.pk).active)
+        self.assertEqual(StaffMember.objects.get(pk=self.eve.pk).timetable_code, 'EF')
+
+    def test_unreadable_row_is_not_a_departure(self):
+        text = TIMETABLER_CSV + 'GG,Ms,Gina,Gone,Mon Someday\n'
+        teachers, errors, unreadable = read_export(BytesIO(text.encode('utf-8')))
+        self.assertEqual(([e.field for e in errors], unreadable), (['days'], ['GG']))
+        diff = TimetablerSync(deactivate_departures=True).diff(teachers, unreadable)
+        self.assertEqual(diff.kind('departed'), [])
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            f.write(text.encode('utf-8'))
+            f.flush()
+            with self.assertRaises(CommandError):
+                call_command('sync_timetabler', f.name, deactivate_departures=True, stdout=StringIO(),
+                             stderr=StringIO())
+            self.assertIsNone(StaffMember.objects.get(pk=self.eve.pk).timetable_code)
+            call_command('sync_timetabler', f.name, deactivate_departures=True, ignore_errors=True,
+                         stdout=StringIO(), stderr=StringIO())
+        gone = StaffMember.objects.get(pk=self.gone.pk)
+        self.assertEqual((gone.timetable_code, gone.active), ('GG', True))
+        self.assertEqual(StaffMember.objects.get(pk=self.eve.pk).timetable_code, 'EF')
+
+
+@override_settings(CHANGE_FEED_SETTLE_SECONDS=0)
+class StaffChangeFeedTest(TestCase):
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        self.staff = make_staff(1)
+
+    def entries(self):
+        return list(StaffChange.objects.values_list('staff_id', 'model', 'action'))
+
+    def test_saves_and_deactivations(self):
+        email = EmailAddress.objects.create(staff_member=self.staff, address='s1@example.com', label='Work', rel=2)
+        email.delete()
+        DoorKey.objects.create(owner=self.staff, kind='1', number=7)
+        self.staff.legal_given_name = 'Renamed'
+        self.staff.save()
+        self.staff.delete()
+        StaffMember.all_objects.filter(pk=self.staff.pk).reactivate()
+        pk = self.staff.pk
+        self.assertEqual(self.entries(), [(pk, 'StaffInformation.StaffMember', 'created'),
+                                          (pk, 'StaffInformation.EmailAddress', 'created'),
+                                          (pk, 'StaffInformation.EmailAddress', 'deleted'),
+                                          (pk, 'KeyRegistry.DoorKey', 'created'),
+                                          (pk, 'StaffInformation.StaffMember', 'updated'),
+                                          (pk, 'StaffInformation.StaffMember', 'deactivated'),
+                                          (pk, 'StaffInformation.StaffMember', 'reactivated')])
+
+    def test_rolled_back_with_the_change(self):
+        before = StaffChange.objects.count()
+        try:
+            with transaction.atomic():
+                make_staff(2)
+                StaffMember.objects.all().deactivate()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(StaffChange.objects.count(), before)
+
+    def test_saves_commit_with_their_entries(self):
+        def fail(sender, **kwargs):
+            raise ValueError
+        post_save.connect(fail, sender=StaffMember)
+        post_save.connect(fail, sender=DoorKey)
+        try:
+            for save in [lambda: make_staff(2), lambda: DoorKey.objects.create(owner=self.staff, kind='1', number=7)]:
+                with self.assertRaises(ValueError):
+                    save()
+        finally:
+            post_save.disconnect(fail, sender=StaffMember)
+            post_save.disconnect(fail, sender=DoorKey)
+        self.assertEqual(list(StaffMember.all_objects.values_list('pk', flat=True)), [self.staff.pk])
+        self.assertFalse(DoorKey.objects.exists())
+
+    def test_api_pages_since_cursor(self):
+        others = [make_staff(n) for n in range(2, 7)]
+        url, data, seen = reverse('api_changes'), {'limit': 2}, []
+        while url:
+            content = json.loads(self.client.get(url, data).content.decode('utf-8'))
+            seen.extend(r['staff_id'] for r in content['results'])
+            cursor = content['cursor']
+            url, data = content['next'], {}
+        self.assertEqual(seen, [self.staff.pk] + [s.pk for s in others])
+        # only what changed since the last cursor, in one query and the session
+        # and user for staff_member_required
+        Qualification.objects.create(staff_member=others[0], label='BEd', institution='QUT',
+                                     date_awarded=date(2005, 12, 1))
+        with self.assertNumQueries(3):
+            content = json.loads(self.client.get(reverse('api_changes'), {'since': cursor}).content.decode('utf-8'))
+        self.assertEqual([(r['staff_id'], r['model'], r['action']) for r in content['results']],
+                         [(others[0].pk, 'StaffInformation.Qualification', 'created')])
+        self.assertIsNone(content['next'])
+        self.assertEqual(self.client.get(reverse('api_changes'), {'since': 'x'}).status_code, 400)
+        # recent entries are held back until earlier transactions have committed
+        with self.settings(CHANGE_FEED_SETTLE_SECONDS=60):
+            content = json.loads(self.client.get(reverse('api_changes')).content.decode('utf-8'))
+        self.assertEqual((content['results'], content['cursor']), ([], 0))
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.gone = make_staff(1, legal_given_name='Gwen', legal_surname='Long')
+        EmailAddress.objects.create(staff_member=self.gone, address='gwen@example.com', label='Work', rel=2,
+                                    primary=True)
+        kin = NextOfKin.objects.create(staff_member=self.gone, title='Mr', given_name='Kin', surname='Long',
+                                       relationship='Brother', priority=1)
+        NOKPhoneNumber.objects.create(next_of_kin=kin, rel=7, value=412345678, primary=True)
+        DoorKey.objects.create(owner=self.gone, number=7, kind=0)
+        standard = InserviceStandard.objects.create(number=1, label='First Aid')
+        self.session = InserviceSession.objects.create(date=date(2014, 1, 1), duration=60, presenter='P',
+                                                       title='CPR')
+        self.session.standards.add(standard)
+        self.session.mark_attendance([self.gone])
+        with reversion.create_revision():
+            self.gone.save()
+            kin.save()
+        # a departed supervisor of active staff stays
+        self.boss = make_staff(2)
+        make_staff(3, supervisor=self.boss)
+        # a departed supervisor of recently departed staff goes, they stay
+        self.supervised = make_staff(5, supervisor=self.gone)
+        StaffMember.all_objects.filter(pk__in=[self.gone.pk, self.boss.pk, self.supervised.pk]).deactivate()
+        StaffMember.all_objects.filter(active=False).exclude(pk=self.supervised.pk).update(updated=date(2010, 1, 1))
+
+    def test_archive_and_restore(self):
+        self.assertEqual(archive_staff(dry_run=True), 1)
+        self.assertEqual(archive_staff(), 1)
+        pk = self.gone.pk
+        self.assertFalse(StaffMember.all_objects.filter(pk=pk).exists())
+        self.assertTrue(StaffMember.all_objects.filter(pk=self.boss.pk).exists())
+        supervised = StaffMember.all_objects.get(pk=self.supervised.pk)
+        self.assertIsNone(supervised.supervisor_id)
+        self.assertIsNone(reversion.get_for_object(supervised)[0].object_version.object.supervisor_id)
+        self.assertTrue(StaffChange.objects.filter(staff_id=supervised.pk, action='updated').exists())
+        for model in (EmailAddress, NextOfKin, NOKPhoneNumber, DoorKey, InserviceRecord):
+            self.assertFalse(model.objects.exists())
+        for model in (InserviceHours, SearchTerm):
+            self.assertFalse(model.objects.filter(staff_member=pk).exists())
+        # past rosters still list them, after a rebuild too
+        rebuild_snapshots()
+        self.assertIn(pk, [s.staff_member_id for s in roster_as_of(timezone.now())])
+        self.assertEqual(reversion.get_for_object_reference(StaffMember, pk).count(), 0)
+        archived = ArchivedStaff.objects.get()
+        self.assertEqual((archived.staff_id, archived.display_name), (pk, 'Ms Gwen Long'))
+        self.assertEqual(list(search_archive('gwe lon')), [archived])
+        self.assertEqual(list(search_archive('gwen@example')), [archived])
+        self.assertEqual(list(search_archive('bob')), [])
+
+        self.assertEqual(restore_staff([archived]), 1)
+        staff = StaffMember.all_objects.get(pk=pk)
+        self.assertFalse(staff.active)
+        self.assertEqual(staff.primary_email.address, 'gwen@example.com')
+        self.assertEqual(staff.next_of_kin.get().phone_numbers.get().value, 412345678)
+        self.assertEqual(staff.keys.get().number, 7)
+        self.assertEqual(InserviceHours.objects.filter(staff_member=pk, standard__isnull=False).get().minutes, 60)
+        self.assertEqual(len(reversion.get_for_object(staff)), 2)
+        self.assertTrue(SearchTerm.objects.filter(staff_member=pk, word='gwen').exists())
+        self.assertFalse(ArchivedStaff.objects.exists())
+        self.assertEqual(list(StaffChange.objects.filter(staff_id=pk, action__in=['archived', 'restored'])
+                                                 .values_list('action', flat=True)), ['archived', 'restored'])
+
+    def test_restore_reused_identifiers(self):
+        archive_staff()
+        make_staff(4, employee_number='E1')
+        self.session.delete()
+        with self.assertRaises(RestoreError):
+            restore_staff(ArchivedStaff.objects.all())
+        StaffMember.objects.filter(employee_number='E1').update(employee_number='E4')
+        restore_staff(ArchivedStaff.objects.all())
+        # attendance at the deleted session is left out
+        self.assertFalse(InserviceRecord.objects.exists())
+
+    def test_every_staff_relation_archived(self):
+        archived = set(model for model, _ in ARCHIVED_ROWS + DERIVED_ROWS)
+        for related in StaffMember._meta.get_all_related_objects():
+            if related.field.name != 'supervisor' and related.model is not StaffSnapshot:
+                self.assertIn(related.model, archived)
+
+
+@override_settings(READ_REPLICAS=['replica'])
+class ReplicaRoutingTest(SimpleTestCase):
+    def setUp(self):
+        reset()
+        self.router = PrimaryReplicaRouter()
+        self.middleware = PrimaryPinningMiddleware()
+
+    def tearDown(self):
+        reset()
+
+    def test_reads_follow_writes_to_the_primary(self):
+        self.assertEqual(self.router.db_for_read(StaffMember), 'replica')
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(StaffMember), 'default')
+        self.assertEqual(self.router.db_for_read(StaffMember), 'replica')
+        with transaction.atomic():
+            self.assertEqual(self.router.db_for_read(StaffMember), 'default')
+        self.assertEqual(self.router.db_for_write(StaffMember), 'default')
+        self.assertEqual(self.router.db_for_read(StaffMember), 'default')
+        reset()
+        with self.settings(READ_REPLICAS=[]):
+            self.assertEqual(self.router.db_for_read(StaffMember), 'default')
+
+    def request(self, request, write=False):
+        self.middleware.process_request(request)
+        read_from = self.router.db_for_read(StaffMember)
+        if write:
+            self.router.db_for_write(StaffMember)
+        response = self.middleware.process_response(request, HttpResponse())
+        return read_from, PIN_COOKIE in response.cookies
+
+    def test_browser_pinned_after_writing(self):
+        factory = RequestFactory()
+        self.assertEqual(self.request(factory.get('/')), ('replica', False))
+        self.assertEqual(self.request(factory.post('/'), write=True), ('default', True))
+        self.assertEqual(self.request(factory.get('/'), write=True), ('replica', True))
+        request = factory.get('/')
+        request.COOKIES[PIN_COOKIE] = '1'
+        self.assertEqual(self.request(request), ('default', False))
+        # reads after the response, such as streamed exports, use the replica
+        self.assertEqual(self.router.db_for_read(StaffMember), 'replica')
@@ -0,0 +1,231 @@
+'''Incremental sync of teacher codes, names and working days from The Timetabler.
+
+The export is a CSV file with a header row and one teacher per row, its
+columns named by the TIMETABLER_COLUMNS setting. Days lists the days a teacher
+works, as day names or abbreviations such as "Mon Tue Thu" or "M,Tu,Th".
+
+TimetablerSync.diff compares the export with every staff member holding a
+timetable code, read in one query on the unique timetable_code index:
+
+- new: a code not yet in use, matched by name to a single active staff member
+  without a code, who is given it
+- changed: a teacher whose title, names or working days differ
+- departed: an active staff member whose code is no longer in the export, their
+  code is cleared, and they are deactivated when deactivate_departures is set
+- unmatched: a new code that matched no one, or more than one staff member
+
+A row that could not be read still names its teacher's code when it has one,
+and diff is given those codes so the teacher is left alone rather than taken
+for a departure.
+
+Names in the export are the names teachers are known by, so they are compared
+with and saved as the preferred names. apply writes the changes with one
+UPDATE per distinct set of new values and records every changed staff member
+in a single revision, so a nightly sync of an unchanged file writes nothing.
+'''
+from __future__ import unicode_literals
+
+import csv
+from datetime import date
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.encoding import force_text
+import reversion
+
+from duplicates import name_key
+from importer import RowError
+from models import StaffMember, StaffChange, COMMON_TITLES, WEEKDAYS, staff_changed, BULK_BATCH_SIZE
+from search import index_staff
+
+
+COLUMNS = {'code': 'Code', 'title': 'Title', 'given_name': 'First Name', 'surname': 'Last Name', 'days': 'Days'}
+# Day names are matched on their first two letters, M, W and F alone are
+# Monday, Wednesday and Friday
+DAY_PREFIXES = OrderedDict([('mo', 'monday'), ('m', 'monday'), ('tu', 'tuesday'), ('we', 'wednesday'),
+                            ('w', 'wednesday'), ('th', 'thursday'), ('fr', 'friday'), ('f', 'friday')])
+
+Teacher = namedtuple('Teacher', ['line', 'code', 'title', 'given_name', 'surname', 'days'])
+Change = namedtuple('Change', ['kind', 'code', 'staff', 'fields'])
+
+
+def export_columns():
+    columns = dict(COLUMNS)
+    columns.update(getattr(settings, 'TIMETABLER_COLUMNS', {}))
+    return columns
+
+
+def parse_days(text):
+    '''The works_* field values for a Days column, None when it is empty'''
+    tokens = ''.join(c if c.isalpha() else ' ' for c in text.lower()).split()
+    if not tokens:
+        return None
+    days = dict(('works_' + day, False) for day in WEEKDAYS)
+    for token in tokens:
+        day = DAY_PREFIXES.get(token[:2])
+        if day is None:
+            raise ValueError('Unknown day {}.'.format(token))
+        days['works_' + day] = True
+    return days
+
+
+def read_export(fileobj, columns=None):
+    '''The Teachers in a Timetabler CSV export, RowErrors for rows that could
+    not be read and the teacher codes of those rows'''
+    columns = columns or export_columns()
+    reader = csv.reader(fileobj)
+    header = [force_text(column).strip() for column in next(reader)]
+    missing = [columns[name] for name in ('code', 'given_name', 'surname') if columns[name] not in header]
+    if missing:
+        return [], [RowError(1, None, 'Missing columns {}.'.format(', '.join(missing)))], []
+    teachers, errors, unreadable = [], [], []
+    titles = set(title for title, _ in COMMON_TITLES)
+    for row in reader:
+        values = dict(zip(header, [force_text(value).strip() for value in row]))
+        line = reader.line_num
+        code = values.get(columns['code'])
+        if not code:
+            errors.append(RowError(line, 'code', 'Missing teacher code.'))
+            continue
+        title = values.get(columns['title']) or None
+        if title is not None and title not in titles:
+            errors.append(RowError(line, 'title', 'Unknown title {}.'.format(title)))
+            unreadable.append(code)
+            continue
+        try:
+            days = parse_days(values.get(columns['days'], ''))
+        except ValueError as e:
+            errors.append(RowError(line, 'days', '{}'.format(e)))
+            unreadable.append(code)
+            continue
+        teachers.append(Teacher(line, code, title, values.get(columns['given_name']) or None,
+                                values.get(columns['surname']) or None, days))
+    return teachers, errors, unreadable
+
+
+def preferred(known_as, legal):
+    '''The preferred name to save for a teacher known_as a name, None when it
+    is their legal name'''
+    return None if known_as == legal else known_as
+
+
+class TimetablerDiff(object):
+    def __init__(self):
+        self.changes = []
+        self.unmatched = []
+        self.unchanged = 0
+
+    def kind(self, kind):
+        return [change for change in self.changes if change.kind == kind]
+
+
+class TimetablerSync(object):
+    def __init__(self, deactivate_departures=False, user=None, comment='Synced from The Timetabler.'):
+        self.deactivate_departures = deactivate_departures
+        self.user = user
+        self.comment = comment
+
+    def staff_changes(self, staff, teacher):
+        '''The fields of staff that differ from teacher, as (old, new) values'''
+        fields = OrderedDict()
+        if teacher.title and teacher.title != staff.title:
+            fields['title'] = (staff.title, teacher.title)
+        for known_as, field, legal in [(teacher.given_name, 'prefered_given_name', staff.legal_given_name),
+                                       (teacher.surname, 'prefered_surname', staff.legal_surname)]:
+            if known_as and known_as != (getattr(staff, field) or legal):
+                fields[field] = (getattr(staff, field), preferred(known_as, legal))
+        for field, value in sorted((teacher.days or {}).items()):
+            if getattr(staff, field) != value:
+                fields[field] = (getattr(staff, field), value)
+        return fields
+
+    def match_new(self, teachers):
+        '''Active staff without a code matching each teacher by name, one query
+        per BULK_BATCH_SIZE // 2 surnames as each is sent twice'''
+        surnames = list(set(t.surname for t in teachers if t.surname))
+        candidates = defaultdict(set)
+        for start in range(0, len(surnames), BULK_BATCH_SIZE // 2):
+            batch = surnames[start:start + BULK_BATCH_SIZE // 2]
+            for member in StaffMember.objects.filter(Q(legal_surname__in=batch) | Q(prefered_surname__in=batch),
+                                                     timetable_code__isnull=True):
+                for given_name in set([member.prefered_given_name, member.legal_given_name]) - set([None]):
+                    for surname in set([member.prefered_surname, member.legal_surname]) - set([None]):
+                        candidates[(name_key(given_name), name_key(surname))].add(member)
+        matches = {}
+        for teacher in teachers:
+            found = candidates.get((name_key(teacher.given_name), name_key(teacher.surname)), set())
+            if len(found) == 1:
+                matches[teacher.code] = next(iter(found))
+        return matches
+
+    def diff(self, teachers, unreadable=()):
+        '''A TimetablerDiff of teachers against the database, the codes of rows
+        that could not be read are never departures'''
+        result = TimetablerDiff()
+        coded = dict((s.timetable_code, s) for s in StaffMember.all_objects.filter(timetable_code__isnull=False))
+        new = [t for t in teachers if t.code not in coded]
+        matches = self.match_new(new)
+        claimed = set()
+        for teacher in teachers:
+            staff = coded.get(teacher.code)
+            if staff is not None:
+                fields = self.staff_changes(staff, teacher)
+                if fields:
+                    result.changes.append(Change('changed', teacher.code, staff, fields))
+                else:
+                    result.unchanged += 1
+                continue
+            staff = matches.get(teacher.code)
+            if staff is None or staff.pk in claimed:
+                result.unmatched.append(teacher)
+                continue
+            claimed.add(staff.pk)
+            fields = OrderedDict([('timetable_code', (None, teacher.code))])
+            fields.update(self.staff_changes(staff, teacher))
+            result.changes.append(Change('new', teacher.code, staff, fields))
+        codes = set(t.code for t in teachers) | set(unreadable)
+        for code, staff in sorted(coded.items()):
+            if code not in codes and staff.active:
+                fields = OrderedDict([('timetable_code', (code, None))])
+                if self.deactivate_departures:
+                    fields['active'] = (True, False)
+                result.changes.append(Change('departed', code, staff, fields))
+        return result
+
+    def apply(self, diff):
+        '''Write the changes in diff with one UPDATE per distinct set of new
+        values and save them as one revision. Returns the number of staff
+        changed.'''
+        if not diff.changes:
+            return 0
+        groups = defaultdict(list)
+        for change in diff.changes:
+            values = tuple(sorted((field, new) for field, (_, new) in change.fields.items()))
+            groups[values].append(change.staff.pk)
+        pks = [change.staff.pk for change in diff.changes]
+        # codes are unique, clear every code that changes first so codes can
+        # move between staff
+        recoded = [change.staff.pk for change in diff.changes if 'timetable_code' in change.fields]
+        with transaction.atomic():
+            for start in range(0, len(recoded), BULK_BATCH_SIZE):
+                batch = StaffMember.all_objects.filter(pk__in=recoded[start:start + BULK_BATCH_SIZE])
+                batch.update(timetable_code=None)
+            for values, group in groups.items():
+                for start in range(0, len(group), BULK_BATCH_SIZE):
+                    batch = StaffMember.all_objects.filter(pk__in=group[start:start + BULK_BATCH_SIZE])
+                    batch.update(updated=date.today(), **dict(values))
+            changed = []
+            for start in range(0, len(pks), BULK_BATCH_SIZE):
+                batch = StaffMember.all_objects.filter(pk__in=pks[start:start + BULK_BATCH_SIZE])
+                # updates do not recompute schedule
+                batch.sync_computed_columns()
+                changed.extend(batch)
+            reversion.default_revision_manager.save_revision(changed, user=self.user, comment=self.comment)
+            index_staff(changed)
+            deactivated = [change.staff.pk for change in diff.changes if 'active' in change.fields]
+            StaffChange.objects.record(StaffMember, deactivated, 'deactivated')
+            StaffChange.objects.record(StaffMember, set(pks) - set(deactivated))
+        staff_changed.send(sender=StaffMember, staff_ids=pks)
+        return len(pks)
@@ -0,0 +1,16 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('StaffInformation.views',
+    url(r'^export/$', 'export_staff', name='export_staff'),
+    url(r'^compliance/$', 'compliance_report', name='compliance_report'),
+    url(r'^demographics/$', 'demographics_report', name='demographics_report'),
+    url(r'^duplicates/$', 'duplicate_staff', name='duplicate_staff'),
+    url(r'^roster/$', 'staff_roster', name='staff_roster'),
+    url(r'^relief/$', 'relief_planning', name='relief_planning'),
+    url(r'^search/$', 'search_staff', name='search_staff'),
+    url(r'^directory/$', 'staff_directory', name='staff_directory'),
+    url(r'^(?P<pk>\d+)/$', 'staff_profile', name='staff_profile'),
+    url(r'^api/staff/$', 'api_staff', name='api_staff'),
+    url(r'^api/staff/(?P<pk>\d+)/$', 'api_staff_detail', name='api_staff_detail'),
+    url(r'^api/changes/$', 'api_changes', name='api_changes'),
+)
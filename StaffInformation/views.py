@@ -1,3 +1,252 @@
-from django.shortcuts import render
+import json
+from datetime import date, datetime
 
-# Create your views here.
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from django.views.decorators.http import require_safe
+
+from api import (ApiError, ChangePage, StaffDetail, StaffPage, parse_fields, timestamp, DEFAULT_LIMIT as API_LIMIT,
+                 MAX_LIMIT)
+from compliance import ComplianceReport
+from demographics import DemographicsReport
+from duplicates import find_duplicates, merge_staff, MIN_SCORE
+from exporter import FORMATS, ORDERING, StaffExporter
+from models import StaffMember, EXPIRY_WARNING_DAYS
+from profiles import get_profile, get_profiles
+from roster import compliance_as_of, roster_as_of
+from schedule import ReliefPlan, coverage
+from search import search, DEFAULT_LIMIT
+
+
+@staff_member_required
+def export_staff(request):
+    '''Stream the staff list as CSV or JSON.
+
+    Query parameters: format (csv or json), columns (comma separated), active
+    (active, inactive or all), bluecard_expires_within and
+    registration_expires_within (days) and bluecard_expired (1 to include only
+    expired blue cards).'''
+    format = request.GET.get('format', 'csv')
+    if format not in FORMATS:
+        return HttpResponseBadRequest('Unknown format.')
+    columns = [c for c in request.GET.get('columns', '').split(',') if c]
+    try:
+        exporter = StaffExporter(columns=columns,
+                                 active=request.GET.get('active', 'active'),
+                                 bluecard_expires_within=request.GET.get('bluecard_expires_within') or None,
+                                 bluecard_expired=request.GET.get('bluecard_expired') == '1',
+                                 registration_expires_within=request.GET.get('registration_expires_within') or None)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    content_type, render = FORMATS[format]
+    response = StreamingHttpResponse(render(exporter), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="staff.{}"'.format(format)
+    return response
+
+
+@staff_member_required
+def compliance_report(request):
+    '''Blue card and teacher registration status for all active staff, the days
+    query parameter sets how far ahead expiries are reported'''
+    try:
+        days = int(request.GET.get('days', EXPIRY_WARNING_DAYS))
+    except ValueError:
+        return HttpResponseBadRequest('days must be a number.')
+    report = ComplianceReport(days=days)
+    return render(request, 'StaffInformation/compliance_report.html',
+                  {'report': report, 'attention': report.attention()})
+
+
+@staff_member_required
+def demographics_report(request):
+    '''Age and length of service of all active staff, upcoming birthdays and
+    staff eligible to retire, as at the date query parameter, today by default'''
+    try:
+        day = datetime.strptime(request.GET['date'], '%Y-%m-%d').date() if request.GET.get('date') else date.today()
+    except ValueError:
+        return HttpResponseBadRequest('date must be YYYY-MM-DD.')
+    report = DemographicsReport(on=day)
+    return render(request, 'StaffInformation/demographics_report.html',
+                  {'report': report, 'birthdays': report.birthdays(), 'retiring': report.retiring()})
+
+
+@staff_member_required
+def duplicate_staff(request):
+    '''Pairs of active staff that may be the same person, best match first, with
+    min_score setting how alike they must be. Posting keep and merge staff ids
+    merges the staff member merge into keep.'''
+    if request.method == 'POST':
+        if not request.user.has_perm('StaffInformation.change_staffmember'):
+            raise PermissionDenied
+        try:
+            keep = StaffMember.all_objects.get(pk=int(request.POST['keep']))
+            merge = StaffMember.all_objects.get(pk=int(request.POST['merge']))
+        except (KeyError, ValueError, StaffMember.DoesNotExist):
+            return HttpResponseBadRequest('keep and merge must be staff ids.')
+        moved = merge_staff(keep, [merge], user=request.user)
+        messages.info(request, 'Merged {} into {}, moving {} records.'.format(merge.display_name,
+                                                                            keep.display_name, moved))
+        return redirect('duplicate_staff')
+    try:
+        min_score = float(request.GET.get('min_score', MIN_SCORE))
+    except ValueError:
+        return HttpResponseBadRequest('min_score must be a number.')
+    return render(request, 'StaffInformation/duplicate_staff.html',
+                  {'matches': find_duplicates(StaffMember.objects.all(), min_score=min_score),
+                   'min_score': min_score})
+
+
+@staff_member_required
+def staff_roster(request):
+    '''Every staff member as they were at the end of the date query parameter,
+    today by default, with their blue card and registration statuses on that
+    date'''
+    try:
+        day = datetime.strptime(request.GET['date'], '%Y-%m-%d').date() if request.GET.get('date') else date.today()
+        days = int(request.GET.get('days', EXPIRY_WARNING_DAYS))
+    except ValueError:
+        return HttpResponseBadRequest('date must be YYYY-MM-DD and days a number.')
+    roster = roster_as_of(day).with_compliance_status(days=days, on=day)
+    return render(request, 'StaffInformation/staff_roster.html',
+                  {'report': compliance_as_of(day, days=days), 'roster': roster})
+
+
+@staff_member_required
+def relief_planning(request):
+    '''The teachers rostered on the date query parameter, today by default, the
+    part time teachers free to cover classes and the week's teacher coverage'''
+    try:
+        day = datetime.strptime(request.GET['date'], '%Y-%m-%d').date() if request.GET.get('date') else date.today()
+    except ValueError:
+        return HttpResponseBadRequest('date must be YYYY-MM-DD.')
+    return render(request, 'StaffInformation/relief_planning.html',
+                  {'plan': ReliefPlan(day),
+                   'coverage': coverage(StaffMember.objects.filter(timetable_code__isnull=False))})
+
+
+@staff_member_required
+def search_staff(request):
+    '''Ranked staff matching the q query parameter as JSON, at most limit results'''
+    try:
+        limit = min(int(request.GET.get('limit', DEFAULT_LIMIT)), 100)
+    except ValueError:
+        return HttpResponseBadRequest('limit must be a number.')
+    results = [{'id': staff.pk,
+                'display_name': staff.display_name,
+                'employee_number': staff.employee_number,
+                'timetable_code': staff.timetable_code,
+                'score': round(staff.search_score, 3)}
+               for staff in search(request.GET.get('q', ''), limit=limit)]
+    return HttpResponse(json.dumps({'results': results}), content_type='application/json')
+
+
+@staff_member_required
+def staff_profile(request, pk):
+    '''A staff member's full profile, served from the profile cache'''
+    profile = get_profile(int(pk))
+    if profile is None:
+        raise Http404
+    return render(request, 'StaffInformation/staff_profile.html', {'profile': profile})
+
+
+@staff_member_required
+def staff_directory(request):
+    '''Active staff with their contact details, 50 to a page. Only the page of
+    primary keys is queried, the profiles come from the profile cache.'''
+    paginator = Paginator(StaffMember.objects.order_by(*ORDERING).values_list('pk', flat=True), 50)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        page = paginator.page(1)
+    except EmptyPage:
+        page = paginator.page(paginator.num_pages)
+    return render(request, 'StaffInformation/staff_directory.html',
+                  {'page': page, 'profiles': get_profiles(page.object_list)})
+
+
+def api_response(request, resource, content):
+    '''A JSON response for an API resource, or 304 Not Modified when the
+    request's If-None-Match or If-Modified-Since headers show it is unchanged.
+    content is only called for full responses.'''
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if resource.not_modified(if_none_match=parse_etags(if_none_match) if if_none_match else None,
+                             if_modified_since=parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(json.dumps(content(), sort_keys=True), content_type='application/json')
+    response['ETag'] = quote_etag(resource.etag)
+    if resource.last_modified:
+        response['Last-Modified'] = http_date(timestamp(resource.last_modified))
+    # clients may keep responses but must revalidate them
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@require_safe
+@staff_member_required
+def api_staff(request):
+    '''A page of active staff as JSON, with the URL of the next page.
+
+    Query parameters: fields (comma separated field names, related sets such as
+    email_addresses are included when named), limit (at most MAX_LIMIT) and
+    cursor (from the previous page's next URL).'''
+    try:
+        limit = min(int(request.GET.get('limit', API_LIMIT)), MAX_LIMIT)
+        page = StaffPage(fields=parse_fields(request.GET.get('fields')), cursor=request.GET.get('cursor'),
+                         limit=max(limit, 1))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    next_url = None
+    if page.next_cursor:
+        query = request.GET.copy()
+        query['cursor'] = page.next_cursor
+        next_url = request.build_absolute_uri('?' + query.urlencode())
+    response = api_response(request, page, lambda: {'results': page.records(), 'next': next_url})
+    if next_url:
+        response['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+@require_safe
+@staff_member_required
+def api_staff_detail(request, pk):
+    '''One active staff member as JSON, the fields query parameter is as for
+    api_staff'''
+    try:
+        staff = StaffDetail(int(pk), fields=parse_fields(request.GET.get('fields')))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    if not staff.exists:
+        raise Http404
+    return api_response(request, staff, lambda: staff.records()[0])
+
+
+@require_safe
+@staff_member_required
+def api_changes(request):
+    '''Change feed entries as JSON, oldest first, with the cursor to ask for the
+    next entries from and the URL of the next page when there are more.
+
+    Query parameters: since (a cursor, 0 for the start of the feed) and limit
+    (at most MAX_LIMIT).'''
+    try:
+        limit = min(int(request.GET.get('limit', API_LIMIT)), MAX_LIMIT)
+        page = ChangePage(since=int(request.GET.get('since', 0)), limit=max(limit, 1))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    next_url = None
+    if page.more:
+        query = request.GET.copy()
+        query['since'] = page.cursor
+        next_url = request.build_absolute_uri('?' + query.urlencode())
+    response = HttpResponse(json.dumps({'results': page.records, 'cursor': page.cursor, 'next': next_url},
+                                       sort_keys=True), content_type='application/json')
+    response['Cache-Control'] = 'private, no-cache'
+    if next_url:
+        response['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
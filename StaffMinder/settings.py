@@ -43,6 +43,8 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'StaffInformation.instrumentation.RequestInstrumentationMiddleware',
+    'StaffInformation.routing.PrimaryPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -67,6 +69,94 @@ DATABASES = {
     }
 }
 
+# Read replicas, see StaffInformation.routing. Reads go to one of READ_REPLICAS
+# unless they need to see a recent write, writes always go to default. To try
+# it locally with two database files, set STAFFMINDER_REPLICA_DB to the path of
+# a copy of db.sqlite3 and copy it again to catch the replica up.
+if os.environ.get('STAFFMINDER_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['STAFFMINDER_REPLICA_DB'],
+        # tests run against default only
+        'TEST_MIRROR': 'default',
+    }
+READ_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['StaffInformation.routing.PrimaryReplicaRouter']
+# Seconds a browser's reads stay on default after it writes, longer than the
+# replicas lag behind
+REPLICA_PIN_SECONDS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/1.6/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'staff_profiles': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'staff-profiles',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+
+# The cache holding staff profile documents, see StaffInformation.profiles
+STAFF_PROFILE_CACHE = 'staff_profiles'
+
+# Request instrumentation, see StaffInformation.instrumentation. Totals per URL
+# are kept in REQUEST_STATS_CACHE, which should be shared between processes in
+# production. Requests taking at least SLOW_REQUEST_MS milliseconds are logged
+# with their SQL.
+REQUEST_STATS_CACHE = 'default'
+SLOW_REQUEST_MS = 1000
+
+# Reversion history, see StaffInformation.history. compact_history keeps every
+# version for keep_all_days, then daily and after keep_daily_days monthly
+# snapshots of each object.
+REVERSION_RETENTION = {'keep_all_days': 90, 'keep_daily_days': 365}
+REVERSION_SKIP_UNCHANGED = True
+
+# Blue card and teacher registration expiry reminders, see
+# StaffInformation.notifications, sent this many days before expiry. To try
+# them against a local debugging server run
+#   python -m smtpd -n -c DebuggingServer localhost:1025
+# with EMAIL_PORT = 1025.
+EXPIRY_REMINDER_DAYS = (60, 30, 7, 0)
+
+# Column names of The Timetabler's teacher export read by sync_timetabler, see
+# StaffInformation.timetabler
+TIMETABLER_COLUMNS = {'code': 'Code', 'title': 'Title', 'given_name': 'First Name', 'surname': 'Last Name',
+                      'days': 'Days'}
+
+# Change feed entries newer than this are held back by the changes API until
+# transactions that started before them have committed, see StaffInformation.api
+CHANGE_FEED_SETTLE_SECONDS = 60
+
+# Days staff must be inactive and unchanged before archive_staff moves them
+# into the archive, see StaffInformation.archive
+ARCHIVE_AFTER_DAYS = 2 * 365
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'slow_requests': {
+            'level': 'WARNING',
+            'class': 'logging.FileHandler',
+            'filename': os.path.join(BASE_DIR, 'slow_requests.log'),
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'StaffInformation.instrumentation': {
+            'handlers': ['slow_requests'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
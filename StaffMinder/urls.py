@@ -9,4 +9,6 @@ urlpatterns = patterns('',
     # url(r'^blog/', include('blog.urls')),
 
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^staff/', include('StaffInformation.urls')),
+    url(r'^inservice/', include('InserviceTracker.urls')),
 )